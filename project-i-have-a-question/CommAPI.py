@@ -1,6 +1,6 @@
 import os, time, json, copy, socket, select, threading, sys, base64, pickle
 
-import utils
+import utils, interfaces
 from database import Database
 
 
@@ -188,14 +188,17 @@ class CommunicationModule(object):
 
         elif protocol == "UDP":
             if ip_address == "broadcast":
-                domain = self.my_ip[0:self.my_ip.find('.')]
-                if domain == '192':
-                    ip_address = '<broadcast>'
-                else:
-                    ip_address = domain + '.255.255.255'
+                # every subnet of the host, see interfaces.py
+                addresses = interfaces.broadcast_addresses()
+            else:
+                addresses = [ip_address]
             with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
                 s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST,1)
-                s.sendto(str.encode(message_str, "utf-8"), (ip_address, self.port))
+                for address in addresses:
+                    try:
+                        s.sendto(str.encode(message_str, "utf-8"), (address, self.port))
+                    except OSError:
+                        interfaces.refresh() # the interfaces may have changed
 
 
     def add_question(self, title, content):
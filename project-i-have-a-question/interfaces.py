@@ -0,0 +1,227 @@
+""" Local network interfaces.
+
+The IPv4 interfaces of the host are listed once with their netmasks and
+broadcast addresses, and listed again only every `refresh_interval` seconds
+or when a send fails, e.g. after a cable is plugged or a VPN (Hamachi) comes
+up. Broadcasts go to the broadcast address of every subnet the host is on,
+instead of guessing it from the first byte of one address.
+
+On Linux the interfaces are read with ioctl calls on a socket. Elsewhere
+only the addresses of the host are known, and broadcasts go to the limited
+broadcast address <broadcast>, which the OS sends out of its default
+interface.
+
+The same module is in workshop-4-social-torrent/ChatApp487 and
+project-i-have-a-question, keep the two copies identical.
+"""
+import socket, struct, threading, time
+
+REFRESH_INTERVAL = 30 # seconds a listing is used before the interfaces are listed again
+
+# ioctl requests of Linux, see netdevice(7)
+SIOCGIFFLAGS = 0x8913
+SIOCGIFADDR = 0x8915
+SIOCGIFBRDADDR = 0x8919
+SIOCGIFNETMASK = 0x891b
+IFF_UP = 0x1
+IFF_BROADCAST = 0x2
+IFF_LOOPBACK = 0x8
+
+
+class Interface(object):
+    def __init__(self, name, ip, netmask=None, broadcast="<broadcast>", loopback=False):
+        """ An IPv4 address of the host
+
+        Args:
+            name (str): Name of the interface, None if unknown
+            ip (str): IPv4 address
+            netmask (str, optional): Netmask, None if unknown
+            broadcast (str, optional): Broadcast address of the subnet,
+                None if the interface can't broadcast
+            loopback (bool, optional): Whether it is a loopback interface
+        """
+        self.name = name
+        self.ip = ip
+        self.netmask = netmask
+        self.broadcast = broadcast
+        self.loopback = loopback
+
+
+    def __eq__(self, other):
+        return isinstance(other, Interface) and self.__dict__ == other.__dict__
+
+
+    def __repr__(self):
+        return "Interface({}, {}, {}, {})".format(self.name, self.ip, self.netmask,
+                                                  self.broadcast)
+
+
+def _ioctl_address(sock, request, name):
+    """ Returns the address in the ifreq of an interface, or None """
+    import fcntl
+    try:
+        ifreq = fcntl.ioctl(sock.fileno(), request, struct.pack("256s", name[:15]))
+    except OSError:
+        return None
+    return socket.inet_ntoa(ifreq[20:24])
+
+
+def _scan_linux():
+    import fcntl
+    interfaces = []
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        for _, name in socket.if_nameindex():
+            ifname = name.encode()
+            try:
+                ifreq = fcntl.ioctl(s.fileno(), SIOCGIFFLAGS, struct.pack("256s", ifname[:15]))
+            except OSError:
+                continue # removed since it was listed
+            flags, = struct.unpack_from("H", ifreq, 16)
+            ip = _ioctl_address(s, SIOCGIFADDR, ifname)
+            if not flags & IFF_UP or ip is None:
+                continue # down or without an IPv4 address
+            netmask = _ioctl_address(s, SIOCGIFNETMASK, ifname)
+            broadcast = None
+            if flags & IFF_BROADCAST:
+                broadcast = _ioctl_address(s, SIOCGIFBRDADDR, ifname)
+                if broadcast is None and netmask is not None:
+                    broadcast = socket.inet_ntoa(bytes(
+                        a | (~m & 0xff) for a, m in zip(socket.inet_aton(ip),
+                                                        socket.inet_aton(netmask))))
+            interfaces.append(Interface(name, ip, netmask, broadcast,
+                                        bool(flags & IFF_LOOPBACK)))
+    return interfaces
+
+
+def _scan_addresses():
+    """ Addresses of the host name, netmasks are unknown """
+    try:
+        infos = socket.getaddrinfo(socket.gethostname(), None, socket.AF_INET)
+    except OSError:
+        infos = []
+    ips = []
+    for info in infos:
+        ip = info[4][0]
+        if ip not in ips:
+            ips.append(ip)
+    return [Interface(None, ip, loopback=ip.startswith("127.")) for ip in ips]
+
+
+def scan():
+    """ Returns the IPv4 interfaces of the host that are up """
+    try:
+        return _scan_linux()
+    except (ImportError, AttributeError, OSError):
+        # not Linux (no fcntl or if_nameindex) or the ioctls are not allowed
+        return _scan_addresses()
+
+
+def _routed_ip():
+    """ Returns the address that the default route goes out of, or None.
+    Connecting a UDP socket doesn't send anything.
+    """
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.connect(("8.8.8.8", 80))
+            return s.getsockname()[0]
+    except OSError:
+        return None # no default route
+
+
+class InterfaceTable(object):
+    def __init__(self, refresh_interval=REFRESH_INTERVAL):
+        """ Cached listing of the interfaces, safe to share between threads
+
+        Args:
+            refresh_interval (float, optional): Seconds after the
+                interfaces are listed again
+        """
+        self.refresh_interval = refresh_interval
+        self.listing = [] # Interfaces
+        self.routed_ip = None # address of the default route
+        self.listed_at = None # time of the listing
+        self.lock = threading.Lock()
+
+
+    def interfaces(self):
+        """ Returns the interfaces, lists them again if the listing is old """
+        with self.lock:
+            if self.listed_at is None or time.time() - self.listed_at >= self.refresh_interval:
+                self._list()
+            return self.listing
+
+
+    def refresh(self):
+        """ Lists the interfaces now, e.g. after a send failed
+
+        Returns:
+            bool: Whether the interfaces changed
+        """
+        with self.lock:
+            listing = self.listing
+            self._list()
+            return self.listing != listing
+
+
+    def local_ip(self, choice=None):
+        """ Returns the address of the host on the LAN: the one of the
+        default route, or else of the first interface that is not a
+        loopback, or else 127.0.0.1
+
+        Args:
+            choice (str, optional): Name (e.g. "ham0") or IPv4 address of
+                the interface to use instead
+
+        Raises:
+            ValueError: If there is no interface with the given name
+        """
+        interfaces = self.interfaces()
+        if choice:
+            for interface in interfaces:
+                if choice in (interface.name, interface.ip):
+                    return interface.ip
+            try:
+                socket.inet_aton(choice)
+            except OSError:
+                raise ValueError("No network interface named " + choice)
+            return choice # an address the listing doesn't show
+        if self.routed_ip is not None:
+            return self.routed_ip
+        ips = [interface.ip for interface in interfaces if not interface.loopback]
+        return ips[0] if ips else "127.0.0.1"
+
+
+    def broadcast_addresses(self):
+        """ Returns the broadcast addresses of the subnets of the host """
+        addresses = []
+        for interface in self.interfaces():
+            if interface.loopback or interface.broadcast is None:
+                continue
+            if interface.broadcast not in addresses:
+                addresses.append(interface.broadcast)
+        return addresses or ["<broadcast>"]
+
+
+    def _list(self):
+        """ Must be called with lock held """
+        self.listing = scan()
+        self.routed_ip = _routed_ip()
+        self.listed_at = time.time()
+
+
+_table = InterfaceTable() # shared by the whole process
+
+
+def local_ip(choice=None):
+    """ Returns the address of the host on the LAN, see InterfaceTable """
+    return _table.local_ip(choice)
+
+
+def broadcast_addresses():
+    """ Returns the broadcast addresses of the subnets of the host """
+    return _table.broadcast_addresses()
+
+
+def refresh():
+    """ Lists the interfaces again, returns whether they changed """
+    return _table.refresh()
@@ -0,0 +1,383 @@
+""" asyncio engine of a Messenger.
+
+By default a Messenger serves its sockets with blocking listener threads, a
+thread that stores and acks the received chunks and a pool of upload
+threads. With `use_asyncio=True` all of them are replaced by one event loop
+running in a single thread:
+
+- the UDP socket (DISCOVER, GOODBYE, FILE and ACK datagrams) is a datagram
+  endpoint, received chunks are stored and acked right away
+- TCP messages are framed like in connPool.py, over an asyncio server and
+  one outgoing connection per peer
+- uploads are coroutines, at most `max_uploads` of them send at a time
+
+The synchronous API of the Messenger stays the same, it hands the work over
+to the loop. Blocking work like hashing a finished download runs in the
+default executor of the loop.
+"""
+import asyncio, socket, threading, time, traceback
+
+from connPool import HEADER, MessageParser
+
+UDP_BUFFER = 4*1024*1024 # receive buffer of the UDP socket, capped by the OS
+
+
+class FrameProtocol(asyncio.Protocol):
+    def __init__(self, engine, ip=None, outgoing=False):
+        """ A TCP connection carrying length-prefixed messages
+
+        Args:
+            engine (AsyncEngine): Engine that owns the connection
+            ip (str, optional): IP address of the peer, taken from the
+                socket for accepted connections
+            outgoing (bool, optional): Whether we opened it to send messages
+        """
+        self.engine = engine
+        self.ip = ip
+        self.outgoing = outgoing
+        self.transport = None
+        self.parser = MessageParser()
+        self.last_used = time.time()
+
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.ip is None:
+            self.ip = transport.get_extra_info("peername")[0]
+        self.engine.protocols.add(self)
+
+
+    def data_received(self, data):
+        self.last_used = time.time()
+        if self.outgoing:
+            return # peers don't send on our connections
+        try:
+            messages = self.parser.feed(data)
+        except ValueError:
+            self.transport.close()
+            return
+        # handlers don't block in the loop, they run right away
+        for message in messages:
+            self.engine.handle(self.engine.messenger._handle_tcp_message, message)
+
+
+    def connection_lost(self, exc):
+        self.engine.protocols.discard(self)
+        if self.outgoing and self.engine.connections.get(self.ip) is self:
+            del self.engine.connections[self.ip]
+
+
+    def write(self, data):
+        self.last_used = time.time()
+        self.transport.write(HEADER.pack(len(data)) + data)
+
+
+class DatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, engine):
+        self.engine = engine
+
+
+    def datagram_received(self, data, addr):
+        self.engine.handle(self.engine.messenger._handle_datagram, data)
+
+
+    def error_received(self, exc):
+        pass # e.g. ICMP port unreachable of a peer that left
+
+
+class AsyncScheduler(object):
+    def __init__(self, engine, workers=4):
+        """ Runs upload coroutines on the loop of the engine, at most
+        `workers` of them at the same time. Same interface as
+        TransferScheduler.
+        """
+        self.engine = engine
+        self.workers = workers
+        self.semaphore = None # created in the loop
+        self.active = 0 # submitted jobs that haven't finished
+        self.stopped = False
+        self.lock = threading.Lock()
+
+
+    def submit(self, function, *args):
+        """ Queues the coroutine function(*args) """
+        with self.lock:
+            if self.stopped:
+                return False
+            self.active += 1
+        self.engine.call(self._start, function, args)
+        return True
+
+
+    def pending(self):
+        """ Returns the number of running and waiting jobs """
+        with self.lock:
+            return self.active
+
+
+    def stop(self):
+        """ Drops the waiting jobs, running ones stop when they are cancelled """
+        with self.lock:
+            self.stopped = True
+
+
+    def _start(self, function, args):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.workers)
+        self.engine.loop.create_task(self._run(function, args))
+
+
+    async def _run(self, function, args):
+        try:
+            async with self.semaphore:
+                with self.lock:
+                    stopped = self.stopped
+                if not stopped:
+                    await function(*args)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            with self.lock:
+                self.active -= 1
+
+
+class AsyncEngine(object):
+    def __init__(self, messenger, idle_timeout=60, connect_timeout=2):
+        """
+        Args:
+            messenger (Messenger): Messenger served by the engine
+            idle_timeout (float, optional): Seconds after an unused TCP
+                connection is closed
+            connect_timeout (float, optional): Seconds to wait for a new
+                TCP connection
+        """
+        self.messenger = messenger
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+
+        self.loop = None
+        self.thread = None
+        self.udp_transport = None
+        self.tcp_server = None
+        self.connections = {} # key: peer ip, value: outgoing FrameProtocol
+        self.connecting = {} # key: peer ip, value: Future of a connection being opened
+        self.protocols = set() # all open TCP connections
+        self.started = threading.Event()
+        self.start_error = None # exception that stopped the setup of the loop
+
+
+    def start(self):
+        """ Opens the sockets and starts the loop in a new thread. Raises
+        the error if a socket can't be opened.
+        """
+        self.thread = threading.Thread(target=self._run, args=())
+        self.thread.start()
+        self.started.wait()
+        if self.start_error is not None:
+            raise self.start_error
+
+
+    def stop(self):
+        """ Closes all sockets and stops the loop """
+        if self.loop is None:
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+    def is_loop_thread(self):
+        return threading.get_ident() == self.thread.ident
+
+
+    def call(self, function, *args):
+        """ Runs function(*args) in the loop """
+        if self.is_loop_thread():
+            function(*args)
+        else:
+            self.loop.call_soon_threadsafe(self.handle, function, *args)
+
+
+    def handle(self, function, *args):
+        """ Runs function(*args), an exception of a handler must not stop
+        the loop
+        """
+        try:
+            function(*args)
+        except Exception:
+            traceback.print_exc()
+
+
+    def run_blocking(self, function, *args):
+        """ Runs function(*args) in the executor of the loop """
+        self.loop.call_soon_threadsafe(self.loop.run_in_executor, None, self.handle,
+                                       function, *args)
+
+
+    def send_datagram(self, data, ip_address):
+        if self.is_loop_thread():
+            self.udp_transport.sendto(data, (ip_address, self.messenger.port))
+        else:
+            self.loop.call_soon_threadsafe(self.udp_transport.sendto, data,
+                                           (ip_address, self.messenger.port))
+
+
+    def send_datagrams(self, datagrams, ip_address):
+        """ Sends several datagrams with one wakeup of the loop """
+        if self.is_loop_thread():
+            self._send_datagrams(datagrams, ip_address)
+        else:
+            self.loop.call_soon_threadsafe(self._send_datagrams, datagrams, ip_address)
+
+
+    def _send_datagrams(self, datagrams, ip_address):
+        address = (ip_address, self.messenger.port)
+        for data in datagrams:
+            self.udp_transport.sendto(data, address)
+
+
+    def send_tcp(self, ip_address, data, framed=True):
+        """ Sends a message over the connection to the peer. Other threads
+        wait for the result. The loop can't wait, so its messages are
+        queued and True is returned; a peer that can't be reached is
+        reported to the messenger instead. A peer that doesn't read frames
+        gets the message on a connection of its own (see connPool.py).
+
+        Returns:
+            bool: Whether the message was written
+        """
+        send = self._send_tcp if framed else self._send_once
+        if self.is_loop_thread():
+            self.loop.create_task(send(ip_address, data, True))
+            return True
+        connection = self.connections.get(ip_address)
+        if framed and connection is not None and not connection.transport.is_closing():
+            # like a socket send, the write is done once it is queued
+            self.loop.call_soon_threadsafe(self._write, connection, ip_address, data)
+            return True
+        future = asyncio.run_coroutine_threadsafe(send(ip_address, data, False), self.loop)
+        try:
+            return future.result(self.connect_timeout + 1)
+        except Exception:
+            return False
+
+
+    def _write(self, connection, ip_address, data):
+        if connection.transport.is_closing():
+            self.loop.create_task(self._send_tcp(ip_address, data, True))
+        else:
+            connection.write(data)
+
+
+    async def _send_tcp(self, ip_address, data, report):
+        for _ in range(2):
+            connection = self.connections.get(ip_address)
+            reused = connection is not None
+            if connection is None:
+                connection = await self._connect(ip_address)
+            if connection is None:
+                break
+            if not connection.transport.is_closing():
+                connection.write(data)
+                return True
+            if not reused:
+                break
+        if report:
+            self.messenger._peer_unreachable(ip_address)
+        return False
+
+
+    async def _send_once(self, ip_address, data, report):
+        """ Sends a message on a new connection and closes it """
+        try:
+            _, writer = await asyncio.wait_for(
+                asyncio.open_connection(ip_address, self.messenger.port), self.connect_timeout)
+        except (OSError, asyncio.TimeoutError):
+            if report:
+                self.messenger._peer_unreachable(ip_address)
+            return False
+        writer.write(data)
+        writer.close() # after the data is written
+        return True
+
+
+    async def _connect(self, ip_address):
+        """ Returns a new outgoing connection, or None if the peer can't be
+        reached. Concurrent sends to the same peer share the connection.
+        """
+        pending = self.connecting.get(ip_address)
+        if pending is not None:
+            return await asyncio.shield(pending)
+        pending = self.loop.create_future()
+        self.connecting[ip_address] = pending
+        connection = None
+        try:
+            _, connection = await asyncio.wait_for(
+                self.loop.create_connection(
+                    lambda: FrameProtocol(self, ip_address, True),
+                    ip_address, self.messenger.port),
+                self.connect_timeout)
+            connection.transport.get_extra_info("socket").setsockopt(
+                socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.connections[ip_address] = connection
+        except (OSError, asyncio.TimeoutError):
+            connection = None
+        finally:
+            del self.connecting[ip_address]
+            pending.set_result(connection)
+        return connection
+
+
+    async def _evict_idle(self):
+        while True:
+            await asyncio.sleep(1)
+            now = time.time()
+            for protocol in list(self.protocols):
+                if now - protocol.last_used >= self.idle_timeout:
+                    protocol.transport.close()
+
+
+    def _run(self):
+        messenger = self.messenger
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        udp_socket = None
+        try:
+            udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            # the loop also writes the chunks, let a burst wait in the socket
+            udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_BUFFER)
+            udp_socket.bind(('' if messenger.bind_all else messenger.my_ip, messenger.port))
+            self.udp_transport, _ = self.loop.run_until_complete(
+                self.loop.create_datagram_endpoint(lambda: DatagramProtocol(self),
+                                                   sock=udp_socket))
+            self.tcp_server = self.loop.run_until_complete(
+                self.loop.create_server(lambda: FrameProtocol(self),
+                                        messenger.my_ip, messenger.port,
+                                        reuse_address=True))
+            evictor = self.loop.create_task(self._evict_idle())
+        except Exception as error:
+            self.start_error = error
+            if self.udp_transport is not None:
+                self.udp_transport.close()
+            if udp_socket is not None:
+                udp_socket.close()
+            self.loop.close()
+            self.loop = None
+            return
+        finally:
+            self.started.set()
+
+        self.loop.run_forever()
+
+        evictor.cancel()
+        self.tcp_server.close()
+        for protocol in list(self.protocols):
+            protocol.transport.close()
+        self.udp_transport.close()
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self.loop.run_until_complete(self.loop.shutdown_default_executor())
+        self.loop.close()
+        print("asyncio engine stopped")
@@ -0,0 +1,317 @@
+""" Batch transfers of all files under a folder, see the README """
+import os, bisect, threading
+from collections import OrderedDict
+
+import packets
+from fileReceiver import FileReceiver, ChunkBitmap
+from telemetry import TransferStats
+
+FEATURES = ("BINARY", "FEC", "ZLIB", "SACK") # features that a batch transfer can use
+OPEN_FILES = 8 # files of a batch kept open by the uploader
+
+
+def list_files(root):
+    """ Returns the files under a folder as [relative path, size] pairs,
+    sorted by path
+    """
+    files = []
+    for folder, dirs, names in os.walk(root):
+        dirs.sort()
+        for name in sorted(names):
+            path = os.path.join(folder, name)
+            if os.path.isfile(path):
+                relative = os.path.relpath(path, root).replace(os.sep, "/")
+                files.append([relative, os.path.getsize(path)])
+    return files
+
+
+def is_safe_path(relative):
+    """ Whether a path of a manifest stays inside the folder it is saved in """
+    return isinstance(relative, str) and "\\" not in relative and ":" not in relative and \
+        all(part not in ("", ".", "..") for part in relative.split("/"))
+
+
+def is_valid_manifest(files):
+    """ Whether the FILES field of an ALLOW_BATCH message is a list of
+    [relative path, size] pairs with distinct, safe paths
+    """
+    if not isinstance(files, list):
+        return False
+    paths = set()
+    for entry in files:
+        if not isinstance(entry, list) or len(entry) != 2:
+            return False
+        relative, size = entry
+        if not is_safe_path(relative) or relative in paths or \
+                type(size) is not int or size < 0:
+            return False
+        paths.add(relative)
+    # a path can't be both a file and the folder of another file
+    for relative in paths:
+        parts = relative.split("/")
+        if any("/".join(parts[:i]) in paths for i in range(1, len(parts))):
+            return False
+    return True
+
+
+def serial_bases(sizes, chunk_size):
+    """ Returns the first serial of every file of a batch and the number of
+    serials the batch takes
+    """
+    bases = []
+    serial = 0
+    for size in sizes:
+        bases.append(serial)
+        chunk_num = (size + chunk_size - 1) // chunk_size
+        serial += (chunk_num + packets.FEC_GROUP - 1) // packets.FEC_GROUP * packets.FEC_GROUP
+    return bases, serial
+
+
+class BatchChunks(object):
+    def __init__(self, root, files, open_chunks):
+        """ Sequence of the chunks of all files of a batch, with their
+        serials in the batch. A file is opened when its chunks are
+        requested; only the last OPEN_FILES files are kept open.
+
+        Args:
+            root (str): Path of the folder
+            files (list): [relative path, size] pairs of the ALLOW_BATCH message
+            open_chunks (function): Opens a file as binary FileChunks
+        """
+        self.root = root
+        self.files = files
+        self.open_chunks = open_chunks
+        sizes = [size for _, size in files]
+        self.bases, _ = serial_bases(sizes, packets.PAYLOAD_SIZE)
+        self.starts = [] # index of the first chunk of every file
+        self.chunk_num = 0
+        for size in sizes:
+            self.starts.append(self.chunk_num)
+            self.chunk_num += (size + packets.PAYLOAD_SIZE - 1) // packets.PAYLOAD_SIZE
+        self.opened = OrderedDict() # key: file index, value: FileChunks
+        self.lock = threading.Lock()
+
+
+    def __len__(self):
+        return self.chunk_num
+
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.chunk_num:
+            raise IndexError(index)
+        # empty files share their start with the next file
+        file_index = bisect.bisect_right(self.starts, index) - 1
+        with self.lock:
+            chunks = self.opened.get(file_index)
+            if chunks is None:
+                path = os.path.join(self.root, *self.files[file_index][0].split("/"))
+                chunks = self.open_chunks(path)
+                self.opened[file_index] = chunks
+                if len(self.opened) > OPEN_FILES:
+                    self.opened.popitem(last=False)[1].close()
+            else:
+                self.opened.move_to_end(file_index)
+            chunk = chunks[index - self.starts[file_index]]
+        chunk["SERIAL"] += self.bases[file_index]
+        return chunk
+
+
+    def close(self):
+        with self.lock:
+            for chunks in self.opened.values():
+                chunks.close()
+            self.opened.clear()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class BatchReceiver(object):
+    def __init__(self, uploader_ip, name, files, transfer_id, download_dir="Downloads"):
+        """ BatchReceiver takes the place of a FileReceiver for a batch
+        transfer. The chunks of each file go to a FileReceiver of its own,
+        which is created when the first chunk of the file arrives and saves
+        the file when its last one arrives.
+
+        Args:
+            uploader_ip (str): IP address of the uploader
+            name (str): Name of the folder
+            files (list): [relative path, size] pairs of the ALLOW_BATCH message
+            transfer_id (int): Transfer ID given in the ALLOW_BATCH message
+            download_dir (str, optional): Folder to save the folder in
+        """
+        self.uploader_ip = uploader_ip
+        self.filename = os.path.basename(name)
+        self.uploaders = {transfer_id: uploader_ip}
+        self.sack_transfers = set() # transfer ids whose uploaders accept SACK packets
+        self.binary = True
+        self.file_hash = None
+        self.delta_block = None
+        self.copying = None
+        self.path = os.path.join(download_dir, self.filename)
+        self.stats = TransferStats("download", transfer_id, uploader_ip, self.filename)
+
+        self.files = files
+        sizes = [size for _, size in files]
+        self.bases, serial_num = serial_bases(sizes, packets.PAYLOAD_SIZE)
+        self.remaining = [(size + packets.PAYLOAD_SIZE - 1) // packets.PAYLOAD_SIZE
+                          for size in sizes] # chunks each file still misses
+        self.chunk_nums = list(self.remaining)
+        # received chunks by serial in the batch; the serials between the
+        # files are never sent and count as received
+        self.received = ChunkBitmap(serial_num)
+        for base, chunk_num in zip(self.bases, self.chunk_nums):
+            end = (base + chunk_num + packets.FEC_GROUP - 1) // packets.FEC_GROUP * packets.FEC_GROUP
+            for serial in range(base + chunk_num, end):
+                self.received.add(serial)
+        self.receivers = {} # key: file index, value: FileReceiver of an unfinished file
+        self.closed = False
+        self.lock = threading.Lock()
+
+        with self.lock:
+            for index, chunk_num in enumerate(self.chunk_nums):
+                if chunk_num == 0:
+                    # empty files have no chunks, they are saved right away
+                    self._file_receiver(index).finish(0)
+                    del self.receivers[index]
+
+
+    def _locate(self, serial):
+        """ Returns the file index and the serial in the file, (None, None)
+        for a serial outside of the files
+        """
+        index = bisect.bisect_right(self.bases, serial) - 1
+        if index < 0 or serial - self.bases[index] >= self.chunk_nums[index]:
+            return None, None
+        return index, serial - self.bases[index]
+
+
+    def _file_receiver(self, index):
+        """ Returns the receiver of an unfinished file, None if the file is
+        saved or the batch is closed. Raises OSError if the file can't be
+        created. Must be called with lock held.
+        """
+        file_receiver = self.receivers.get(index)
+        if file_receiver is None and not self.closed and \
+                (self.remaining[index] or not self.chunk_nums[index]):
+            relative, size = self.files[index]
+            folder, name = os.path.split(os.path.join(self.path, *relative.split("/")))
+            file_receiver = FileReceiver(self.uploader_ip, name, binary=True, size=size,
+                                         chunk_size=packets.PAYLOAD_SIZE, download_dir=folder)
+            self.receivers[index] = file_receiver
+        return file_receiver
+
+
+    def _stored(self, index, file_receiver, serials):
+        """ Marks the chunks of a file that its receiver stored as received
+        and saves the file if it is complete
+
+        Returns:
+            list: Serials of the stored chunks in the batch
+        """
+        stored = []
+        new = size = 0
+        with self.lock:
+            for serial in serials:
+                if serial not in file_receiver.received:
+                    continue
+                stored.append(self.bases[index] + serial)
+                if self.received.add(self.bases[index] + serial):
+                    self.remaining[index] -= 1
+                    new += 1
+                    size += min(packets.PAYLOAD_SIZE,
+                                self.files[index][1] - serial*packets.PAYLOAD_SIZE)
+            if self.remaining[index] == 0 and self.receivers.get(index) is file_receiver:
+                del self.receivers[index]
+                file_receiver.finish(self.chunk_nums[index])
+        if new:
+            self.stats.received(new, size)
+        return stored
+
+
+    def write_chunk(self, serial, payload):
+        """ Writes a chunk to its file, see FileReceiver.write_chunk """
+        with self.lock:
+            if self.closed:
+                return None
+            index, file_serial = self._locate(serial)
+            try:
+                file_receiver = None if index is None else self._file_receiver(index)
+            except OSError:
+                return None # the file can't be created, not acked
+        if file_receiver is None:
+            self.stats.duplicates += 1 # its file is already saved
+            return []
+        rebuilt = file_receiver.write_chunk(file_serial, payload)
+        if rebuilt is None:
+            return None
+        self.stats.rebuilt += len(rebuilt)
+        stored = self._stored(index, file_receiver, [file_serial] + rebuilt)
+        return [other for other in stored if other != serial]
+
+
+    def add_parity(self, first, parity):
+        """ Passes a parity to the file of its group, see FileReceiver.add_parity """
+        with self.lock:
+            index, file_first = self._locate(first)
+            try:
+                file_receiver = None if index is None else self._file_receiver(index)
+            except OSError:
+                return []
+        if file_receiver is None:
+            return []
+        rebuilt = file_receiver.add_parity(file_first, parity)
+        self.stats.rebuilt += len(rebuilt)
+        return self._stored(index, file_receiver, rebuilt)
+
+
+    def sack_packets(self, transfer_id, serials, rwnd):
+        """ Returns the SACK packets that ack the given serials (see packets.py) """
+        with self.lock:
+            return packets.encode_sacks(transfer_id, serials, rwnd, self.received)
+
+
+    def buffered_bytes(self):
+        with self.lock:
+            file_receivers = list(self.receivers.values())
+        return sum(file_receiver.buffered_bytes() for file_receiver in file_receivers)
+
+
+    def pending_room(self):
+        return None # chunks are written at their offsets
+
+
+    def is_complete(self):
+        return self.received.is_full()
+
+
+    def finish(self, chunk_num, check=None):
+        """ Returns True if all files are saved. They are saved as they
+        complete, so there is nothing left to do.
+        """
+        if not self.is_complete():
+            return False
+        self.stats.finish("success")
+        return True
+
+
+    def close(self, result="stopped"):
+        """ Stops the batch. The saved files are kept, the unfinished ones
+        are removed.
+        """
+        self.stats.finish(result)
+        with self.lock:
+            self.closed = True
+            file_receivers = list(self.receivers.values())
+            self.receivers.clear()
+        for file_receiver in file_receivers:
+            file_receiver.close(result)
+
+
+    def abort(self, result="fail"):
+        self.close(result)
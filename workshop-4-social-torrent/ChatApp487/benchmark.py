@@ -0,0 +1,230 @@
+""" Loopback file transfer benchmark.
+
+Starts a sender and a receiver Messenger on two loopback addresses without
+the interactive UI and sends files of the given sizes from one to the other.
+Every transfer runs in its own process, so that CPU time and peak memory
+belong to that transfer only. One JSON object is printed per transfer:
+
+    {"mode": "binary", "size": 16777216, "content": "random", "engine": "threads",
+     "seconds": 1.2,
+     "MBps": 13.9, "packets": 11532, "bytes_sent": 17295948, "retransmits": 0,
+     "repairs": 0, "cpu_seconds": 1.1, "peak_rss_kb": 24312, "ok": true}
+
+"seconds" is measured from the start of the upload until the file is saved
+by the receiver and "MBps" is in MB/s (10^6 bytes). CPU time and RSS cover
+both messengers, they run in the same process.
+
+Usage:
+    python3 benchmark.py --sizes 1M 16M 64M --modes binary fec zlib json --repeat 3
+
+Network conditions are emulated with a LossyChannel under both messengers,
+e.g. 5% loss, 20 ms delay and 10 MB/s bandwidth in each direction:
+
+    python3 benchmark.py --sizes 16M --loss 0.05 --delay 20 --rate 10 --seed 1
+
+Linux routes the whole 127.0.0.0/8 to the loopback interface. On other
+systems the addresses given with --ips must be added to it first.
+"""
+import os, sys, time, json, argparse, subprocess, tempfile, shutil, random
+
+MODES = {"binary": ["BINARY"], "fec": ["BINARY", "FEC"], "zlib": ["BINARY", "ZLIB"],
+         "sack": ["BINARY", "SACK"],
+         "json": []} # features accepted by the receiver
+BLOCK = 1024*1024
+CHANNEL_OPTIONS = ["loss", "reorder", "duplicate", "delay", "jitter", "rate", "seed"]
+
+
+def parse_size(text):
+    """ Converts sizes like "512K", "16M" or "1G" to bytes """
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3}
+    text = text.strip().upper()
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def peak_rss_kb():
+    try:
+        import resource
+    except ImportError: # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin": # in bytes on macOS
+        peak //= 1024
+    return peak
+
+
+def write_random_file(path, size):
+    with open(path, "wb") as file:
+        for start in range(0, size, BLOCK):
+            file.write(os.urandom(min(BLOCK, size - start)))
+
+
+def write_text_file(path, size):
+    """ Writes a CSV-like log, a compressible file """
+    rand = random.Random(size)
+    with open(path, "wb") as file:
+        written = 0
+        while written < size:
+            lines = "".join("2021-05-{:02d}T{:02d}:{:02d}:{:02d},sensor-{},{:.3f},{}\n".format(
+                                rand.randint(1, 31), rand.randint(0, 23), rand.randint(0, 59),
+                                rand.randint(0, 59), rand.randint(1, 40), rand.gauss(20, 5),
+                                rand.choice(["OK", "OK", "OK", "WARN", "FAIL"]))
+                            for _ in range(1000)).encode("utf-8")
+            lines = lines[:size - written]
+            file.write(lines)
+            written += len(lines)
+
+
+def make_channels(options):
+    """ Returns the LossyChannels of the sender and the receiver, or Nones
+    if no network condition is given
+    """
+    from lossyChannel import LossyChannel
+    if not any(options[name] for name in CHANNEL_OPTIONS if name != "seed"):
+        return None, None
+    channels = []
+    for seed_offset in range(2):
+        seed = None if options["seed"] is None else options["seed"] + seed_offset
+        rate = options["rate"] * 1e6 if options["rate"] else None
+        channels.append(LossyChannel(loss=options["loss"], reorder=options["reorder"],
+                                     duplicate=options["duplicate"],
+                                     delay=options["delay"] / 1000,
+                                     jitter=options["jitter"] / 1000, rate=rate, seed=seed))
+    return channels
+
+
+def run_transfer(mode, size, sender_ip, receiver_ip, port, timeout, options,
+                 content="random", use_asyncio=False):
+    """ Sends a random file of the given size between two messengers in
+    this process. Must be run in an empty working directory.
+
+    Returns:
+        dict: Measurements of the transfer
+    """
+    from chatAPI import Messenger
+    from swarm import file_hash
+
+    os.makedirs(".db", exist_ok=True)
+    if content == "text":
+        path = os.path.abspath("benchmark.csv")
+        write_text_file(path, size)
+    else:
+        path = os.path.abspath("benchmark.bin")
+        write_random_file(path, size)
+
+    sender_channel, receiver_channel = make_channels(options)
+    sender = Messenger(sender_ip, "sender", port, bind_all=False, channel=sender_channel,
+                       use_asyncio=use_asyncio)
+    receiver = Messenger(receiver_ip, "receiver", port, bind_all=False,
+                         channel=receiver_channel, use_asyncio=use_asyncio)
+    sender.init()
+    receiver.init()
+
+    file_sender = sender.offer_file(receiver_ip, path)
+    mes = None
+    deadline = time.time() + 10
+    while mes is None and time.time() < deadline:
+        mes = receiver.next_download_request()
+        time.sleep(0.01)
+    if mes is None:
+        raise RuntimeError("ALLOW message didn't arrive")
+    file_receiver = receiver.accept_download(mes, MODES[mode])
+    yes_packet = sender.wait_permission(file_sender, 10)
+    if not yes_packet:
+        raise RuntimeError("YES message didn't arrive")
+
+    start_cpu = time.process_time()
+    start = time.time()
+    sender.start_upload(file_sender, path, yes_packet)
+    # wait until the download is saved or the upload fails
+    while not os.path.exists(file_receiver.path) and time.time() - start < timeout:
+        acked = file_sender.acked
+        if not sender.scheduler.pending() and not (acked and acked.is_full()):
+            break
+        time.sleep(0.005)
+    seconds = time.time() - start
+    cpu_seconds = time.process_time() - start_cpu
+
+    ok = os.path.exists(file_receiver.path) and \
+        file_hash(file_receiver.path) == file_hash(path)
+    sender.kill()
+    receiver.kill()
+
+    result = {"mode": mode, "size": size, "content": content,
+              "engine": "asyncio" if use_asyncio else "threads"}
+    result.update((name, options[name]) for name in CHANNEL_OPTIONS if options[name])
+    if sender_channel is not None:
+        sender_channel.close()
+        receiver_channel.close()
+        result["dropped"] = sender_channel.stats["dropped"] + receiver_channel.stats["dropped"]
+    result.update({"seconds": round(seconds, 4), "MBps": round(size / seconds / 1e6, 3),
+                   "packets": file_sender.stats.chunks_sent,
+                   "bytes_sent": file_sender.stats.bytes_sent,
+                   "retransmits": file_sender.stats.retransmits,
+                   "repairs": file_sender.stats.repairs,
+                   "suspends": file_sender.stats.suspends,
+                   "cpu_seconds": round(cpu_seconds, 3), "peak_rss_kb": peak_rss_kb(),
+                   "ok": ok})
+    return result
+
+
+def benchmark(args):
+    """ Runs every transfer in a fresh process and prints its result """
+    script = os.path.abspath(__file__)
+    for size in args.sizes:
+        for mode in args.modes:
+            for _ in range(args.repeat):
+                workdir = tempfile.mkdtemp(prefix="chatapp487-bench-")
+                command = [sys.executable, script, "--run", mode, str(size),
+                           "--ips"] + args.ips + ["--port", str(args.port),
+                           "--timeout", str(args.timeout), "--content", args.content]
+                if args.asyncio:
+                    command.append("--asyncio")
+                for name in CHANNEL_OPTIONS:
+                    if getattr(args, name) is not None:
+                        command += ["--" + name, str(getattr(args, name))]
+                try:
+                    process = subprocess.run(command, cwd=workdir, stdout=subprocess.PIPE,
+                                             timeout=args.timeout + 30)
+                    lines = process.stdout.decode("utf-8", "replace").strip().splitlines()
+                    result = json.loads(lines[-1])
+                except (subprocess.TimeoutExpired, ValueError, IndexError):
+                    result = {"mode": mode, "size": size, "ok": False}
+                finally:
+                    shutil.rmtree(workdir, ignore_errors=True)
+                print(json.dumps(result), flush=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Loopback file transfer benchmark")
+    parser.add_argument("--sizes", nargs="+", type=parse_size,
+                        default=[parse_size(s) for s in ("1M", "16M", "64M")])
+    parser.add_argument("--modes", nargs="+", choices=sorted(MODES), default=sorted(MODES))
+    parser.add_argument("--content", choices=["random", "text"], default="random",
+                        help="random bytes or a compressible CSV log")
+    parser.add_argument("--asyncio", action="store_true",
+                        help="run the messengers on the asyncio engine")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--ips", nargs=2, default=["127.0.0.2", "127.0.0.3"],
+                        metavar=("SENDER_IP", "RECEIVER_IP"))
+    parser.add_argument("--port", type=int, default=12345)
+    parser.add_argument("--timeout", type=float, default=600, help="seconds per transfer")
+    parser.add_argument("--loss", type=float, default=0.0, help="packet loss probability")
+    parser.add_argument("--reorder", type=float, default=0.0, help="reordering probability")
+    parser.add_argument("--duplicate", type=float, default=0.0,
+                        help="duplication probability")
+    parser.add_argument("--delay", type=float, default=0.0, help="one way delay in ms")
+    parser.add_argument("--jitter", type=float, default=0.0, help="max extra delay in ms")
+    parser.add_argument("--rate", type=float, default=0.0, help="bandwidth in MB/s")
+    parser.add_argument("--seed", type=int, help="seed of the emulated network")
+    parser.add_argument("--run", nargs=2, metavar=("MODE", "SIZE"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        result = run_transfer(args.run[0], int(args.run[1]), args.ips[0], args.ips[1],
+                              args.port, args.timeout, vars(args), args.content,
+                              args.asyncio)
+        print(json.dumps(result), flush=True)
+    else:
+        benchmark(args)
@@ -1,21 +1,31 @@
 import os, time, json, copy, socket, select, threading, sys, base64
+from collections import deque
 
-from inputimeout import inputimeout, TimeoutOccurred
+from fileSender import FileSender, ResumeChunks, PacketLossError
+from fileReceiver import FileReceiver, download_path, is_valid_size
+from swarm import SwarmDownload, PieceChunks, file_hash, is_valid_hash
+from batch import BatchChunks, BatchReceiver, list_files, is_safe_path
+from scheduler import TransferScheduler
+from compression import is_compressible, decompress
+from connPool import ConnectionPool
+from asyncEngine import AsyncEngine, AsyncScheduler, UDP_BUFFER
+from chatStore import ChatStore
+from ringBuffer import RingBuffer
+from telemetry import MetricsLog
+from terminal import Terminal
+import packets, interfaces, deltaSync, batch
 
-from fileSender import FileSender, PacketLossError
+CHAT_PAGE = 50 # messages shown when a chat room opens, and loaded by (o)
+ACK_EVERY = 16 # received chunks acked together by SACK packets
+ACK_DELAY = 0.005 # seconds a received chunk waits for its SACK at most
+RECEIVE_BUFFER = 2*1024*1024 # bytes of received chunks waiting to be written
 
-def get_my_ip():
-    #return '127.0.0.1'
-    if os.name == 'posix':
-        # Get the local ip using hostname (works in Ubuntu)
-        import subprocess
-        local_ip = subprocess.run(["hostname","-I"], stdout=subprocess.PIPE)
-        local_ip = local_ip.stdout.decode().split(" ")[0] # HAMACHI
-        return local_ip
-    else:   # platform independent (192.168)
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.connect(('8.8.8.8', 80))
-        return s.getsockname()[0]
+def get_my_ip(choice=None):
+    """ Returns the IPv4 address of the host on the LAN, from the cached
+    listing of the interfaces (see interfaces.py). `choice` is the name or
+    address of the interface to use instead, e.g. "ham0" for Hamachi.
+    """
+    return interfaces.local_ip(choice)
 
 def _decode_message(data):
     """ Converts given data to dict. If it cannot or data 
@@ -46,185 +56,682 @@ def _validate_packet(packet):
 
 class Messenger(object):
 
-    def __init__(self, my_ip, my_name, comm_port):
-        """ Messenger object manages the sending, receiving and updating 
+    def __init__(self, my_ip, my_name, comm_port, max_uploads=4, bind_all=True,
+                 channel=None, use_asyncio=False, metrics_path=None):
+        """ Messenger object manages the sending, receiving and updating
         messages. init() must be called after the object is created to
-        start scanning for available users in the LAN. 
-         
+        start scanning for available users in the LAN.
+
+        Several uploads and downloads may run at the same time. Each one is
+        identified by the transfer id given in its ALLOW (or PULL) message.
+
         Args:
             my_ip (str): IPv4 address of the user
             my_name (str): Username of the user
             comm_port (str): Communication port
+            max_uploads (int, optional): Number of uploads that run at the
+                same time, the others wait for their turn
+            bind_all (bool, optional): Whether the UDP listener listens on
+                all interfaces, which is needed for broadcast messages.
+                Several messengers can run on one host (e.g. on 127.0.0.x
+                addresses) if it is False.
+            channel (LossyChannel, optional): Emulated network that the
+                unicast UDP datagrams pass through, for testing
+            use_asyncio (bool, optional): Whether the sockets and uploads
+                are served by one asyncio event loop (see asyncEngine.py)
+                instead of a thread each
+            metrics_path (str, optional): JSON lines file that the metrics
+                of the transfers are appended to (see telemetry.py)
         """
         self.my_ip = my_ip 
         self.my_name = my_name
         self.port = comm_port
+        self.bind_all = bind_all
+        self.channel = channel
         
         self.udp_server_thread = None
         self.tcp_server_thread = None
+        self.engine = AsyncEngine(self) if use_asyncio else None
+        # all datagrams of the listener threads are sent from one socket,
+        # the asyncio engine sends from its UDP endpoint
+        self.send_socket = None
+        if self.engine is None:
+            self.send_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.send_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        # TCP messages go over one long-lived connection per peer
+        self.tcp_pool = None
+        if self.engine is None:
+            self.tcp_pool = ConnectionPool(comm_port, self._handle_tcp_message)
 
-        self.db_file = ".db/.chat_db"
+        self.chat_store = ChatStore()
+        self.chat_store.import_chat_db(".db/.chat_db")
+        self.terminal = Terminal() # UI, refreshed when something changes
         self.ip2name = {}
         self.message_template = {"NAME":self.my_name, "MY_IP": self.my_ip, 
                                  "TYPE": None, "PAYLOAD": None}
+        self.framed_peers = set() # peers that read TCP frames, see connPool.py
         self.ip2name_lock = threading.Lock()
-        self.permission_to_send = False
-        self.download_request = False
+        self.download_requests = deque() # ALLOW messages waiting for the user
+
+        # every transfer has its own sender or receiver, keyed by transfer id
+        self.uploads = {} # key: transfer id, value: FileSender
+        self.downloads = {} # key: transfer id, value: FileReceiver
+        self.permissions = {} # key: transfer id of an offered file, value: YES message or None
+        self.batch_files = {} # key: transfer id of an offered folder, value: its FILES
+        self.transfers_lock = threading.Lock()
+        self.permission_event = threading.Condition(self.transfers_lock)
+        if self.engine is not None:
+            self.scheduler = AsyncScheduler(self.engine, max_uploads)
+        else:
+            self.scheduler = TransferScheduler(max_uploads)
 
-        self.current_download = [None, {}, ""] # uploader ip, data, filename
-        self.file_sender = None
+        self.shared_files = {} # key: SHA-256 hash, value: path of a file we have
+        self.offered_hashes = {} # key: (path, size, mtime) of an offered file, value: its hash
+        self.swarms = {} # key: SHA-256 hash, value: SwarmDownload
+        self.pull_senders = {} # key: peer ip, value: last FileSender serving it a piece
 
-        self.ack_buffer = []
+        # (FileReceiver, FILE message) pairs waiting to be written
+        self.ack_buffer = RingBuffer(RECEIVE_BUFFER // packets.DATAGRAM_SIZE)
         self.ack_buffer_lock = threading.Lock()
+        self.ack_buffer_event = threading.Condition(self.ack_buffer_lock)
+        self.ack_sender_thread = None
+        # chunks waiting to be acked by SACK packets, used by the thread
+        # that stores the chunks only
+        self.pending_acks = {} # key: transfer id, value: [FileReceiver, uploader ip, serials, deadline]
+        self.stopped = False
+        self.metrics = MetricsLog(metrics_path) if metrics_path else None
 
 
     def init(self):
-        """ Initializes the listener and opens the database file. After, it 
-        starts the scanning LAN. 
+        """ Initializes the listeners. After, it starts the scanning LAN. 
         """
 
-        # create the db files
-        with open(self.db_file, "w+") as _:
-            pass
-
         # start listeners
-        self.udp_server_thread = threading.Thread(target=self._start_udp_listener,args=())
-        self.udp_server_thread.start()
+        if self.engine is not None:
+            self.engine.start()
+        else:
+            self.udp_server_thread = threading.Thread(target=self._start_udp_listener,args=())
+            self.udp_server_thread.start()
+
+            self.tcp_server_thread = threading.Thread(target=self._start_tcp_listener, args=())
+            self.tcp_server_thread.start()
 
-        self.tcp_server_thread = threading.Thread(target=self._start_tcp_listener, args=())
-        self.tcp_server_thread.start()
+            # a single thread stores and acks the chunks of all downloads
+            self.ack_sender_thread = threading.Thread(target=self._ack_sender, args=())
+            self.ack_sender_thread.start()
 
         print("Starting server...")
         time.sleep(2)
 
         # sends entrance messsage to all ips and fills the ip2name dict
-        message_str = json.dumps(self._generate_message("DISCOVER"))
+        message_str = json.dumps(self._presence_message("DISCOVER"))
         for _ in range(3):
             self._send_message("UDP", "broadcast", message_str) # HAMACHI
 
 
     def enter_chat_room(self, peer_ip, peer_name):
         """ This is a UI function. It displays the chat room for the given peer
-        IP.  
+        IP. New messages are appended as they arrive.
 
         Args:
             peer_ip (str): IP address of the peer.
             peer_name (str): Username of the peer.
         """
-        is_peer_offline = False
-        while True:
-            mes_list = self._read_messages(peer_ip)
-            os.system('cls' if os.name == 'nt' else 'clear')
-            print("Chat Room ({} at {} and {} at {}) - Refreshed every 3 seconds\n"\
-                            .format(self.my_name, self.my_ip, peer_name, peer_ip))
-            
+        terminal = self.terminal
+        title = "Chat Room ({} at {} and {} at {})".format(self.my_name, self.my_ip,
+                                                          peer_name, peer_ip)
+        # the last page of the history, then only the new messages
+        first = max(self.chat_store.count(peer_ip) - CHAT_PAGE, 0)
+        mes_list, cursor = self.chat_store.read_since(peer_ip, first)
+        state = {"cursor": cursor, "offline": None}
+
+        def is_peer_offline():
             with self.ip2name_lock:
-                if not (peer_ip in self.ip2name):
-                    is_peer_offline = True
-                else:
-                    is_peer_offline = False
+                return peer_ip not in self.ip2name
 
-            for mes in mes_list:
-                print("{}: {}".format(mes["NAME"], mes["PAYLOAD"]))
-            print()
+        def status_lines():
+            if state["offline"]:
+                return [title, "User is offline now! They won't get your messages!", ""]
+            return [title, "", ""]
 
-            if self.download_request:
-                mes = self.download_request
-                self.download_request = False
-                self.download_request_display(mes)
-                continue
+        def show_room():
+            state["offline"] = is_peer_offline()
+            terminal.start_view(status_lines(), scroll=True)
+            for mes in mes_list[-terminal.rows:]:
+                terminal.append("{}: {}".format(mes["NAME"], mes["PAYLOAD"]))
 
-            try:
-                if is_peer_offline:
-                    key = inputimeout(prompt="User is offline now! They won't get your messages!\n(q) to return lobby...\n",\
-                                        timeout=3)      
-                else:
-                    key = inputimeout(prompt='(m) to enter a message, (f) to send a file or (q) to return lobby...\n',\
-                                        timeout=3)
-            except TimeoutOccurred:
+        def show_new():
+            new_messages, state["cursor"] = self.chat_store.read_since(peer_ip, state["cursor"])
+            mes_list.extend(new_messages)
+            for mes in new_messages:
+                terminal.append("{}: {}".format(mes["NAME"], mes["PAYLOAD"]))
+
+        def refresh():
+            """ Stops the prompt to show a download request or a new prompt """
+            show_new()
+            offline = is_peer_offline()
+            if offline != state["offline"]:
+                state["offline"] = offline
+                terminal.set_lines(status_lines())
+                return True
+            return bool(self.download_requests)
+
+        show_room()
+        while True:
+            if state["offline"]:
+                key = terminal.prompt("(q) to return lobby...", refresh)
+            else:
+                key = terminal.prompt("(m) to enter a message, (f) to send a file, "\
+                                      "(o) to show older messages or (q) to return lobby...",
+                                      refresh)
+            if key is None:
+                mes = self.next_download_request()
+                if mes:
+                    self.download_request_display(mes)
+                    show_room()
                 continue
 
             if key == "q":
                 break
-            elif key == "m" and not is_peer_offline:
-                payload = input("Enter your message\n")
-                message_send = json.dumps(self._generate_message("MESSAGE", payload))
-                success = self._send_message("TCP", peer_ip, message_send, filename=self.db_file)
+            elif key == "o":
+                older = self.chat_store.read(peer_ip, first - CHAT_PAGE, first)
+                first -= len(older)
+                mes_list = older + mes_list
+                if older:
+                    terminal.append("--- {} older messages ---".format(len(older)))
+                    for mes in older:
+                        terminal.append("{}: {}".format(mes["NAME"], mes["PAYLOAD"]))
+                    terminal.append("--- end of older messages ---")
+                else:
+                    terminal.append("--- no older messages ---")
+            elif key == "m" and not state["offline"]:
+                payload = terminal.prompt("Enter your message", show_new)
+                message = self._generate_message("MESSAGE", payload)
+                self.chat_store.append(peer_ip, message)
+                success = self._send_message("TCP", peer_ip, json.dumps(message))
                 if not success:
-                    is_peer_offline = True
+                    terminal.append("The message couldn't be delivered")
             
-            elif key == "f" and not is_peer_offline:
-                file_path = input("Enter the path of the file\n").strip()
+            elif key == "f" and not state["offline"]:
+                file_path = terminal.prompt("Enter the path of the file or folder",
+                                            show_new).strip()
                 file_path = os.path.abspath(file_path)
-                if not os.path.isfile(file_path):
-                    print("File couldn't be found!")
-                    time.sleep(2)
+                if os.path.isdir(file_path):
+                    # all files of the folder with one permission
+                    file_sender = self.offer_folder(peer_ip, file_path)
+                elif os.path.isfile(file_path):
+                    file_sender = self.offer_file(peer_ip, file_path)
+                else:
+                    terminal.append("File couldn't be found!")
                     continue
-                self.file_sender = FileSender(self.my_ip, self.my_name, self.port, self)
-                chunks = self.file_sender.file_to_chunks(file_path)
-                allow_packet = self._generate_message("ALLOW", file_path.split(os.sep)[-1])
-                self._send_message("TCP", peer_ip, json.dumps(allow_packet))
                 # wait for permission
-                print("Waiting for permission from the peer for the file transfer...")
-                print("Press (c) to cancel...")
-                while(True):
-                    try:
-                        if self.permission_to_send:
-                            self.permission_to_send = False
-                            print("Permission granted, please wait during the transfer")
-                            try:
-                                self.file_sender.send_file(chunks, peer_ip)
-                            except PacketLossError as e:
-                                print(e.message)
-                                time.sleep(2)
-                                break
-                            print("File sent!")
-                            time.sleep(2)
-                            break
-                        key = inputimeout(timeout=3)
-                        if key == "c":
-                            break
-                    except TimeoutOccurred:
-                        continue
-                self.file_sender = None  # reset sender object
+                terminal.append("Waiting for permission from the peer for the file transfer...")
+                yes_packet = None
+                while True:
+                    key = terminal.prompt("Press (c) to cancel...",
+                                          lambda: show_new() or
+                                          self.wait_permission(file_sender, 0))
+                    yes_packet = self.wait_permission(file_sender, 0)
+                    if yes_packet or key == "c":
+                        break
+                if not yes_packet:
+                    self.cancel_offer(file_sender)
+                    terminal.append("File transfer is cancelled")
+                    continue
+                if self.start_upload(file_sender, file_path, yes_packet):
+                    terminal.append("Permission granted, the file is sent in the background")
+                else:
+                    terminal.append("Permission granted, the peer downloads the file from "\
+                                    "all peers that have it")
             else:
                 continue
     
     def kill(self):
-        """ Kills the TCP and UDP listeners and sends GOODBYE message """
+        """ Kills the TCP and UDP listeners and sends GOODBYE message. The
+        current downloads are kept to be resumed later, the uploads are
+        stopped.
+        """
+        with self.transfers_lock:
+            file_receivers = set(self.downloads.values())
+            file_receivers.update(swarm.file_receiver for swarm in self.swarms.values())
+            self.swarms.clear()
+            file_senders = list(self.uploads.values())
+        for file_receiver in file_receivers:
+            self._end_download(file_receiver)
+            file_receiver.close()
+        self.scheduler.stop()
+        for file_sender in file_senders:
+            file_sender.cancel()
+
+        if self.ack_sender_thread:
+            with self.ack_buffer_lock:
+                self.stopped = True
+                self.ack_buffer_event.notify_all()
+            self.ack_sender_thread.join()
+
         if self.tcp_server_thread:
-            self._send_message("TCP", self.my_ip, "QUIT")
+            self.tcp_pool.close()
             self.tcp_server_thread.join()
 
         if self.udp_server_thread:
             message_str = json.dumps(self._generate_message("GOODBYE"))
             for _ in range(3):
                 self._send_message("UDP", "broadcast", message_str)
+            # the broadcast doesn't reach a listener bound to a single address
+            self._send_message("UDP", self.my_ip, message_str)
             self.udp_server_thread.join()
-    
+
+        if self.engine is not None:
+            message_str = json.dumps(self._generate_message("GOODBYE"))
+            for _ in range(3):
+                self._send_message("UDP", "broadcast", message_str)
+            self.engine.stop()
+        else:
+            self.send_socket.close()
+        if self.metrics is not None:
+            self.metrics.close()
+
+
+    def offer_file(self, peer_ip, file_path):
+        """ Offers a file to the peer with an ALLOW message. The upload
+        starts with start_upload() after the peer accepts it.
+
+        Args:
+            peer_ip (str): IP address of the peer
+            file_path (str): Path of the file
+
+        Returns:
+            FileSender: Sender of the file
+        """
+        file_sender = FileSender(self.my_ip, self.my_name, self.port, self)
+        file_sender.target_ip = peer_ip
+        allow_packet = self._generate_message("ALLOW", os.path.basename(file_path))
+        allow_packet["TID"] = file_sender.transfer_id
+        allow_packet["FEATURES"] = list(packets.FEATURES)
+        allow_packet["SIZE"] = os.path.getsize(file_path)
+        allow_packet["CHUNK"] = file_sender.json_chunk_size(file_path)
+        with self.transfers_lock:
+            known_hash = self.offered_hashes.get(self._file_key(file_path))
+        if known_hash is None:
+            # hashing a large file takes a while, the hash is sent with
+            # DOWNLOAD_SUCCESS; swarm and delta downloads and resuming need
+            # it in the offer, so they wait for the next offer of the file
+            for feature in ("SWARM", "DELTA"):
+                allow_packet["FEATURES"].remove(feature)
+            self._background(self._hash_offer, file_sender, file_path)
+        else:
+            allow_packet["HASH"] = known_hash
+            file_sender.file_hash = known_hash
+            self.shared_files[known_hash] = file_path
+        file_sender.stats.name = os.path.basename(file_path)
+        file_sender.stats.peer_ip = peer_ip
+        with self.transfers_lock:
+            self.uploads[file_sender.transfer_id] = file_sender
+            self.permissions[file_sender.transfer_id] = None
+        self._track(file_sender.stats)
+        self._send_message("TCP", peer_ip, json.dumps(allow_packet))
+        return file_sender
+
+
+    def _file_key(self, file_path):
+        """ Identifies a version of a file in offered_hashes """
+        stat = os.stat(file_path)
+        return os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns
+
+
+    def _hash_offer(self, file_sender, file_path):
+        """ Computes the hash of an offered file for its DOWNLOAD_SUCCESS
+        and the next offers of the file
+        """
+        try:
+            key = self._file_key(file_path)
+            content_hash = file_hash(file_path)
+        except OSError:
+            return
+        with self.transfers_lock:
+            self.offered_hashes[key] = content_hash
+        file_sender.file_hash = content_hash
+        self.shared_files[content_hash] = file_path
+
+
+    def offer_folder(self, peer_ip, folder_path):
+        """ Offers all files under a folder with one ALLOW_BATCH message (see
+        batch.py). The upload of all files starts with start_upload() after
+        the peer accepts them.
+
+        Args:
+            peer_ip (str): IP address of the peer
+            folder_path (str): Path of the folder
+
+        Returns:
+            FileSender: Sender of the files
+        """
+        file_sender = FileSender(self.my_ip, self.my_name, self.port, self)
+        file_sender.target_ip = peer_ip
+        folder_name = os.path.basename(os.path.normpath(folder_path))
+        allow_packet = self._generate_message("ALLOW_BATCH", folder_name)
+        allow_packet["TID"] = file_sender.transfer_id
+        allow_packet["FEATURES"] = [f for f in packets.FEATURES if f in batch.FEATURES]
+        allow_packet["FILES"] = list_files(folder_path)
+        file_sender.stats.name = folder_name
+        file_sender.stats.peer_ip = peer_ip
+        with self.transfers_lock:
+            self.uploads[file_sender.transfer_id] = file_sender
+            self.permissions[file_sender.transfer_id] = None
+            self.batch_files[file_sender.transfer_id] = allow_packet["FILES"]
+        self._track(file_sender.stats)
+        self._send_message("TCP", peer_ip, json.dumps(allow_packet))
+        return file_sender
+
+
+    def wait_permission(self, file_sender, timeout=None):
+        """ Waits for the YES message of an offered file.
+
+        Returns:
+            dict: YES message, None if it didn't arrive in time.
+        """
+        transfer_id = file_sender.transfer_id
+        with self.transfers_lock:
+            self.permission_event.wait_for(lambda: self.permissions.get(transfer_id), timeout)
+            return self.permissions.get(transfer_id)
+
+
+    def cancel_offer(self, file_sender):
+        """ Withdraws an offered file that the peer didn't accept """
+        with self.transfers_lock:
+            self.permissions.pop(file_sender.transfer_id, None)
+        self._remove_upload(file_sender)
+
+
+    def start_upload(self, file_sender, file_path, yes_packet):
+        """ Queues the upload of an offered file that the peer accepted. It
+        runs in the background with the other uploads.
+
+        Returns:
+            bool: False if the peer downloads the file piece by piece with
+                PULL messages (swarm mode) instead.
+        """
+        with self.transfers_lock:
+            self.permissions.pop(file_sender.transfer_id, None)
+        if "SWARM" in yes_packet.get("FEATURES", []):
+            self._remove_upload(file_sender)
+            return False
+        upload = self._upload if self.engine is None else self._upload_async
+        self.scheduler.submit(upload, file_sender, file_path, yes_packet)
+        return True
+
+
+    def _check_compression(self, file_sender, file_path):
+        """ Turns compression off for an offered file whose chunks don't
+        get smaller. The files of a folder are always compressed.
+        """
+        with self.transfers_lock:
+            is_folder = file_sender.transfer_id in self.batch_files
+        if file_sender.compress and not is_folder and \
+                not is_compressible(file_path, packets.PAYLOAD_SIZE):
+            file_sender.compress = False
+
+
+    def _upload(self, file_sender, file_path, yes_packet):
+        file_sender.set_features(yes_packet.get("FEATURES", []))
+        self._check_compression(file_sender, file_path)
+        try:
+            with self._file_chunks(file_sender, file_path) as chunks:
+                if yes_packet.get("RESUME"):
+                    chunks = ResumeChunks(chunks, yes_packet["RESUME"])
+                elif "DELTA" in yes_packet:
+                    copies = self._find_copies(file_path, yes_packet["DELTA"])
+                    chunks = ResumeChunks(chunks, self._send_delta(
+                        file_sender, file_path, yes_packet["DELTA"], copies))
+                file_sender.send_file(chunks, file_sender.target_ip)
+            if not file_sender.cancelled:
+                self.terminal.notice("{} is sent to {}".format(os.path.basename(file_path),
+                                                               file_sender.target_ip))
+        except PacketLossError as e:
+            self.terminal.notice(e.message)
+        finally:
+            self._remove_upload(file_sender)
+
+
+    async def _upload_async(self, file_sender, file_path, yes_packet):
+        """ _upload as a coroutine of the asyncio engine """
+        file_sender.set_features(yes_packet.get("FEATURES", []))
+        await self.engine.loop.run_in_executor(None, self._check_compression,
+                                               file_sender, file_path)
+        try:
+            with self._file_chunks(file_sender, file_path) as chunks:
+                if yes_packet.get("RESUME"):
+                    chunks = ResumeChunks(chunks, yes_packet["RESUME"])
+                elif "DELTA" in yes_packet:
+                    # the search takes a while, don't block the loop
+                    copies = await self.engine.loop.run_in_executor(
+                        None, self._find_copies, file_path, yes_packet["DELTA"])
+                    chunks = ResumeChunks(chunks, self._send_delta(
+                        file_sender, file_path, yes_packet["DELTA"], copies))
+                await file_sender.send_file_async(chunks, file_sender.target_ip)
+            if not file_sender.cancelled:
+                self.terminal.notice("{} is sent to {}".format(os.path.basename(file_path),
+                                                               file_sender.target_ip))
+        except PacketLossError as e:
+            self.terminal.notice(e.message)
+        finally:
+            self._remove_upload(file_sender)
+
+
+    def _file_chunks(self, file_sender, file_path):
+        """ Opens the chunks of an offered file, or of all files of an
+        offered folder
+        """
+        with self.transfers_lock:
+            files = self.batch_files.get(file_sender.transfer_id)
+        if files is None:
+            return file_sender.file_to_chunks(file_path)
+        return BatchChunks(file_path, files, file_sender.file_to_chunks)
+
+
+    def _find_copies(self, file_path, delta):
+        """ Returns the blocks of the receiver's old copy that the file
+        contains (see deltaSync.py), [] if the signatures are malformed
+        """
+        try:
+            block = int(delta["BLOCK"])
+            sigs = base64.b64decode(delta["SIGS"])
+        except (KeyError, TypeError, ValueError):
+            return []
+        if block < deltaSync.MIN_BLOCK:
+            return []
+        return deltaSync.find_copies(file_path, block, sigs)
+
+
+    def _send_delta(self, file_sender, file_path, delta, copies):
+        """ Sends the copies in a DELTA message. It arrives before
+        DOWNLOAD_SUCCESS since both go over the TCP connection to the peer.
+
+        Returns:
+            list: [start, end) ranges of the chunks the receiver copies,
+                to be skipped like the chunks of a resumed download
+        """
+        delta_packet = self._generate_message("DELTA", deltaSync.encode_copies(copies))
+        delta_packet["TID"] = file_sender.transfer_id
+        self._send_message("TCP", file_sender.target_ip, json.dumps(delta_packet))
+        if not copies:
+            return []
+        return deltaSync.covered_chunks(copies, int(delta["BLOCK"]),
+                                        os.path.getsize(file_path), packets.PAYLOAD_SIZE)
+
+
+    def _remove_upload(self, file_sender):
+        with self.transfers_lock:
+            if self.uploads.get(file_sender.transfer_id) is file_sender:
+                del self.uploads[file_sender.transfer_id]
+                self.batch_files.pop(file_sender.transfer_id, None)
+        # withdrawn offers and swarm offers are never sent; an upload that
+        # ended keeps its result
+        file_sender.stats.finish("cancelled")
+
+
+    def next_download_request(self):
+        """ Returns the next ALLOW message waiting for the user, None if there is none """
+        try:
+            return self.download_requests.popleft()
+        except IndexError:
+            return None
+
 
     def download_request_display(self, mes):
-        
+        """ This is a UI function. It asks the user whether to accept the
+        file offered in an ALLOW message, or the folder offered in an
+        ALLOW_BATCH message.
+        """
+        terminal = self.terminal
         source_ip = mes["MY_IP"]
         source_name = mes["NAME"]
         source_payload = mes["PAYLOAD"]
-        for _ in range(20):
-            print()
-        print("!"*50)
-        res = input("{}-{} wants to send you a file named {}. If you accept "\
-                    "press (y), otherwise press any other button\n".\
-                format(source_name, source_ip, source_payload)+"!"*50+'\n')
-        print()
+        if mes["TYPE"] == "ALLOW_BATCH":
+            files = mes.get("FILES")
+            if not batch.is_valid_manifest(files):
+                return # malformed offer, declined
+            offer = "a folder named {} ({} files, {:.1f} MB)".format(
+                source_payload, len(files), sum(size for _, size in files) / 1e6)
+        else:
+            offer = "a file named {}".format(source_payload)
+        terminal.start_view(["!"*50,
+                             "{}-{} wants to send you {}.".format(
+                                 source_name, source_ip, offer),
+                             "!"*50, ""], scroll=True)
+        res = terminal.prompt("If you accept press (y), otherwise press any other button")
         if res == "y":
-            self.current_download[0] = source_ip     
-            self.current_download[-1] = source_payload       
-            ack_sender = threading.Thread(target=self._ack_sender, args=())
-            ack_sender.start()
-            yes_packet = self._generate_message("YES")
-            self._send_message("TCP", source_ip, json.dumps(yes_packet))
-            print("Download started. When finished, it will be saved in "\
-                "the 'Downloads' folder located in the application root")
-            input("Press enter to continue chatting ...")
+            file_receiver = self.accept_download(mes)
+            if file_receiver is None and mes["TYPE"] == "ALLOW_BATCH":
+                terminal.append("This folder is already being downloaded or can't be saved")
+            elif file_receiver is None:
+                terminal.append("This file is already being downloaded or can't be saved")
+            else:
+                received = file_receiver.received
+                if mes["TYPE"] == "ALLOW" and received is not None and received.count:
+                    terminal.append("Resuming the download, {}% is already downloaded"\
+                                    .format(100*received.count//received.size))
+                terminal.append("Download started. When finished, it will be saved in "\
+                                "the 'Downloads' folder located in the application root")
+            terminal.prompt("Press enter to continue chatting ...")
+
+
+    def accept_download(self, mes, features=None):
+        """ Starts the download offered in an ALLOW or ALLOW_BATCH message
+        and sends YES.
+
+        Args:
+            mes (dict): ALLOW or ALLOW_BATCH message
+            features (list, optional): Features to accept, all supported
+                ones by default
+
+        Returns:
+            FileReceiver: Receiver of the download (BatchReceiver for a
+                folder), None if the same file is already being downloaded
+                or the file or folder can't be saved.
+        """
+        source_ip = mes["MY_IP"]
+        content_hash = mes.get("HASH")
+        if not is_valid_hash(content_hash):
+            content_hash = None # an offer whose hash isn't ready yet, or a malformed one
+        if self._is_downloading(mes["PAYLOAD"], content_hash):
+            return None
+        if features is None:
+            features = packets.FEATURES
+        features = [f for f in mes.get("FEATURES", []) if f in features]
+        if mes["TYPE"] == "ALLOW_BATCH":
+            return self._accept_batch(mes, features)
+        size = mes.get("SIZE")
+        chunk_size = packets.PAYLOAD_SIZE if "BINARY" in features else mes.get("CHUNK")
+        if not is_valid_size(size, chunk_size):
+            # an older peer or a malformed offer, the JSON chunks are
+            # appended in order
+            features, size, chunk_size = [], None, None
+        binary = "BINARY" in features
+        if "DELTA" in features and "SWARM" in features and binary and \
+                os.path.isfile(download_path(mes["PAYLOAD"])):
+            # only the changes since our copy are downloaded, from the uploader
+            features.remove("SWARM")
+        swarm = None
+        if "SWARM" in features and binary and content_hash:
+            try:
+                swarm = SwarmDownload(self, content_hash, mes["PAYLOAD"], size)
+            except OSError:
+                return None # the file can't be preallocated
+            file_receiver = swarm.file_receiver
+            with self.transfers_lock:
+                self.swarms[swarm.file_hash] = swarm
+            if "DELTA" in features:
+                features.remove("DELTA")
+        else:
+            if "SWARM" in features:
+                features.remove("SWARM")
+            for feature in ("FEC", "ZLIB", "SACK", "DELTA"):
+                if feature in features and not binary:
+                    features.remove(feature)
+            try:
+                file_receiver = FileReceiver(source_ip, mes["PAYLOAD"], mes.get("TID"),
+                                             binary, size, chunk_size,
+                                             file_hash=content_hash)
+            except OSError:
+                return None
+            if "SACK" in features:
+                file_receiver.sack_transfers.add(mes["TID"])
+            signatures = None
+            if "DELTA" in features and content_hash:
+                signatures = file_receiver.delta_signatures()
+            if signatures is None and "DELTA" in features:
+                features.remove("DELTA")
+            # JSON chunks don't carry the transfer id, only one JSON upload
+            # per peer is possible
+            self._add_download(mes["TID"] if binary else source_ip, file_receiver)
+
+        yes_packet = self._generate_message("YES")
+        yes_packet["FEATURES"] = features
+        if "TID" in mes:
+            yes_packet["TID"] = mes["TID"]
+        received = file_receiver.received
+        if received is not None and received.count:
+            # continue an interrupted download
+            yes_packet["RESUME"] = file_receiver.resume_ranges()
+        elif "DELTA" in features:
+            # download only what changed since our copy of the file
+            yes_packet["DELTA"] = {"BLOCK": file_receiver.delta_block,
+                                   "SIGS": base64.b64encode(signatures).decode("ascii")}
+        self._send_message("TCP", source_ip, json.dumps(yes_packet))
+        if swarm is not None:
+            swarm.add_peer(source_ip, features)
+            self._background(self._find_seeders, swarm, source_ip)
+        return file_receiver
+
+
+    def _accept_batch(self, mes, features):
+        """ Starts the download of the folder offered in an ALLOW_BATCH
+        message and sends YES. Returns the BatchReceiver, None if the
+        manifest is malformed or the folder can't be created.
+        """
+        files = mes.get("FILES")
+        if not batch.is_valid_manifest(files) or \
+                not is_safe_path(mes["PAYLOAD"]) or "/" in mes["PAYLOAD"]:
+            return None
+        # the files are sent one after the other as binary chunks
+        features = [f for f in features if f in batch.FEATURES]
+        if "BINARY" not in features:
+            features.insert(0, "BINARY")
+        try:
+            os.makedirs(download_path(mes["PAYLOAD"]), exist_ok=True)
+            batch_receiver = BatchReceiver(mes["MY_IP"], mes["PAYLOAD"], files, mes["TID"])
+        except OSError:
+            return None # e.g. a file with the name of the folder is in the way
+        if "SACK" in features:
+            batch_receiver.sack_transfers.add(mes["TID"])
+        self._add_download(mes["TID"], batch_receiver)
+
+        yes_packet = self._generate_message("YES")
+        yes_packet["FEATURES"] = features
+        yes_packet["TID"] = mes["TID"]
+        self._send_message("TCP", mes["MY_IP"], json.dumps(yes_packet))
+        return batch_receiver
 
 
     def _generate_message(self, m_type, payload=None):
@@ -246,29 +753,310 @@ class Messenger(object):
         return message
 
 
-    def _update_ip2name(self, update_type, ip, name=None):
-        """ Updates the user dictionary """
+    def _update_ip2name(self, update_type, ip, name=None, framed=False):
+        """ Updates the user dictionary and whether the peer reads TCP
+        frames (the FRAMED flag of its DISCOVER or RESPOND message)
+        """
         if ip == self.my_ip:
             return
         if update_type == "DEL":
             with self.ip2name_lock:
                 if ip in self.ip2name: del self.ip2name[ip]
+                self.framed_peers.discard(ip)
         elif update_type == "ADD":
             with self.ip2name_lock:
                 self.ip2name[ip] = name
+                if framed is True:
+                    self.framed_peers.add(ip)
+                else:
+                    self.framed_peers.discard(ip)
+        self.terminal.notify()
+
+
+    def _presence_message(self, m_type):
+        """ Returns a DISCOVER or RESPOND message. FRAMED tells the peer
+        that we read TCP frames; peers running the original protocol
+        ignore it.
+        """
+        message = self._generate_message(m_type)
+        message["FRAMED"] = True
+        return message
+
+
+    def _add_download(self, key, file_receiver):
+        """ Routes the packets of the transfer id (or uploader ip for JSON
+        chunks) to the file receiver
+        """
+        with self.transfers_lock:
+            self.downloads[key] = file_receiver
+        self._track(file_receiver.stats)
+
+
+    def transfer_stats(self):
+        """ Returns the metrics of the running uploads and downloads
+
+        Returns:
+            list: TransferStats objects, see telemetry.py
+        """
+        with self.transfers_lock:
+            transfers = list(self.uploads.values()) + list(self.downloads.values())
+            transfers += [swarm.file_receiver for swarm in self.swarms.values()]
+        stats = []
+        for transfer in transfers:
+            if all(other is not transfer.stats for other in stats):
+                stats.append(transfer.stats)
+        return stats
+
+
+    def _track(self, stats):
+        """ Writes the metrics of a transfer to the metrics file, if there is one """
+        if self.metrics is not None:
+            self.metrics.track(stats)
+
+
+    def _remove_download(self, key):
+        with self.transfers_lock:
+            self.downloads.pop(key, None)
+
+
+    def _find_download(self, mes):
+        """ Returns the download a DOWNLOAD_SUCCESS or DOWNLOAD_FAIL message
+        belongs to, or None
+        """
+        with self.transfers_lock:
+            file_receiver = self.downloads.get(mes.get("TID"))
+            if file_receiver is None:
+                file_receiver = self.downloads.get(mes["MY_IP"])
+        return file_receiver
 
 
-    def _download_finish(self, last_chunk_id):
-        downloaded_file_str = ""
-        filename = self.current_download[-1]
-        for i in range(last_chunk_id+1):
-            downloaded_file_str += self.current_download[1][i]
-        self.current_download = [None, {}, ""]
-        downloaded_file = base64.b64decode(downloaded_file_str.encode("UTF-8"))
-        os.makedirs('Downloads', exist_ok=True)
-        f = open('./Downloads/'+filename, 'wb')
-        f.write(downloaded_file)
-        f.close()
+    def _is_downloading(self, filename, file_hash=None):
+        """ Whether a file with the same name or content is being downloaded """
+        filename = os.path.basename(filename)
+        with self.transfers_lock:
+            file_receivers = list(self.downloads.values())
+            file_receivers += [swarm.file_receiver for swarm in self.swarms.values()]
+        return any(file_receiver.filename == filename or
+                   (file_hash and file_receiver.file_hash == file_hash)
+                   for file_receiver in file_receivers)
+
+
+    def _end_download(self, file_receiver):
+        """ Stops routing packets to the download. Returns False if it has
+        already ended.
+        """
+        with self.transfers_lock:
+            keys = [key for key, value in self.downloads.items() if value is file_receiver]
+            for key in keys:
+                del self.downloads[key]
+        return bool(keys)
+
+
+    def _download_finish(self, file_receiver, chunk_num, sent_hash=None):
+        """ Saves the download, or removes it if some chunks are missing.
+        sent_hash is the hash in DOWNLOAD_SUCCESS, for an offer without one.
+        """
+        if not self._end_download(file_receiver):
+            return
+        check = None
+        if file_receiver.copying is not None:
+            file_receiver.copying.wait() # the DELTA message came first
+            # the old copy may have changed since its signatures were sent
+            check = lambda path: file_hash(path) == file_receiver.file_hash
+        if not file_receiver.finish(chunk_num, check):
+            file_receiver.close("fail")
+        elif file_receiver.file_hash:
+            self.shared_files[file_receiver.file_hash] = file_receiver.path
+        elif is_valid_hash(sent_hash):
+            self.shared_files[sent_hash] = file_receiver.path
+
+
+    def _transfer_done(self, mes, success):
+        """ Handles DOWNLOAD_SUCCESS and DOWNLOAD_FAIL messages """
+        file_receiver = self._find_download(mes)
+        if file_receiver is None:
+            return
+        swarm = self.swarms.get(file_receiver.file_hash)
+        if swarm is not None and swarm.file_receiver is file_receiver:
+            swarm.transfer_done(mes.get("TID"), success)
+        elif success:
+            self._background(self._download_finish, file_receiver, int(mes["PAYLOAD"] or 0),
+                             mes.get("HASH"))
+        elif self._end_download(file_receiver):
+            file_receiver.close("fail")
+
+
+    def _peer_left(self, peer_ip):
+        """ Stops downloading from a peer that went offline. Single source
+        downloads are kept to be resumed when the peer offers the file again.
+        """
+        with self.transfers_lock:
+            swarms = list(self.swarms.values())
+            file_receivers = set(file_receiver for file_receiver in self.downloads.values()
+                                 if file_receiver.uploader_ip == peer_ip)
+        for swarm in swarms:
+            swarm.peer_left(peer_ip)
+        for file_receiver in file_receivers:
+            if self._end_download(file_receiver):
+                file_receiver.close()
+
+
+    def _peer_unreachable(self, peer_ip):
+        """ Called by the asyncio engine when a message of the event loop
+        couldn't be sent. The swarm downloads get their pieces from the
+        other peers.
+        """
+        with self.transfers_lock:
+            swarms = list(self.swarms.values())
+        for swarm in swarms:
+            swarm.peer_left(peer_ip)
+
+
+    def _background(self, function, *args):
+        """ Runs function(*args) without blocking the listeners """
+        if self.engine is not None:
+            self.engine.run_blocking(function, *args)
+        else:
+            threading.Thread(target=function, args=args).start()
+
+
+    def _apply_delta(self, file_receiver, copies):
+        """ Copies the blocks of a DELTA message from the old copy of the file """
+        try:
+            file_receiver.write_copies(copies)
+        finally:
+            file_receiver.copying.set()
+
+
+    def _find_seeders(self, swarm, uploader_ip):
+        """ Asks every other peer whether it has the file of the swarm download """
+        have_packet = json.dumps(self._generate_message("HAVE", swarm.file_hash))
+        with self.ip2name_lock:
+            peers = [ip for ip in self.ip2name if ip != uploader_ip]
+        for peer_ip in peers:
+            self._send_message("TCP", peer_ip, have_packet)
+
+
+    def _swarm_finished(self, swarm):
+        """ Saves a swarm download if all chunks are received and the content
+        matches the hash, removes it otherwise.
+        """
+        with self.transfers_lock:
+            if self.swarms.get(swarm.file_hash) is not swarm:
+                return
+            del self.swarms[swarm.file_hash]
+        file_receiver = swarm.file_receiver
+        self._end_download(file_receiver)
+        check = lambda path: file_hash(path) == swarm.file_hash
+        if not file_receiver.finish(swarm.chunk_num, check):
+            file_receiver.close("fail")
+        else:
+            self.shared_files[swarm.file_hash] = file_receiver.path
+
+
+    def _send_pull(self, peer_ip, file_hash, transfer_id, start, end):
+        """ Requests the chunks [start, end) of a shared file from a peer """
+        pull_packet = self._generate_message("PULL", file_hash)
+        pull_packet["TID"] = transfer_id
+        pull_packet["START"] = start
+        pull_packet["END"] = end
+        pull_packet["FEATURES"] = ["FEC"]
+        return self._send_message("TCP", peer_ip, json.dumps(pull_packet))
+
+
+    def _send_pull_cancel(self, peer_ip, transfer_id):
+        cancel_packet = self._generate_message("PULL_CANCEL")
+        cancel_packet["TID"] = transfer_id
+        self._send_message("TCP", peer_ip, json.dumps(cancel_packet))
+
+
+    def _serve_pull(self, mes):
+        """ Queues the upload of the requested piece of a shared file (swarm
+        mode). The sender is registered right away so that a PULL_CANCEL
+        also stops a piece that is still waiting for its turn.
+        """
+        peer_ip = mes["MY_IP"]
+        path = self.shared_files.get(mes["PAYLOAD"])
+        if path is None:
+            fail_packet = self._generate_message("DOWNLOAD_FAIL")
+            fail_packet["TID"] = mes["TID"]
+            self._send_message("TCP", peer_ip, json.dumps(fail_packet))
+            return
+        file_sender = FileSender(self.my_ip, self.my_name, self.port, self)
+        file_sender.transfer_id = mes["TID"]
+        file_sender.target_ip = peer_ip
+        file_sender.set_features(["BINARY"] + [f for f in mes.get("FEATURES", [])
+                                               if f in packets.FEATURES])
+        file_sender.stats.name = os.path.basename(path)
+        with self.transfers_lock:
+            self.uploads[file_sender.transfer_id] = file_sender
+        self._track(file_sender.stats)
+        upload = self._upload_piece if self.engine is None else self._upload_piece_async
+        self.scheduler.submit(upload, file_sender, path, mes["START"], mes["END"])
+
+
+    def _upload_piece(self, file_sender, path, start, end):
+        peer_ip = self._continue_pulls(file_sender)
+        try:
+            with file_sender.file_to_chunks(path) as chunks:
+                file_sender.send_file(PieceChunks(chunks, start, end), peer_ip)
+        except PacketLossError:
+            pass # DOWNLOAD_FAIL is already sent
+        finally:
+            self._remove_upload(file_sender)
+
+
+    async def _upload_piece_async(self, file_sender, path, start, end):
+        """ _upload_piece as a coroutine of the asyncio engine """
+        peer_ip = self._continue_pulls(file_sender)
+        try:
+            with file_sender.file_to_chunks(path) as chunks:
+                await file_sender.send_file_async(PieceChunks(chunks, start, end), peer_ip)
+        except PacketLossError:
+            pass # DOWNLOAD_FAIL is already sent
+        finally:
+            self._remove_upload(file_sender)
+
+
+    def _continue_pulls(self, file_sender):
+        """ Continues with the congestion state of the previous piece sent
+        to the same peer. Returns the IP address of the peer.
+        """
+        peer_ip = file_sender.target_ip
+        previous = self.pull_senders.get(peer_ip)
+        if previous is not None:
+            file_sender.rtt = previous.rtt
+            file_sender.congestion = previous.congestion
+        self.pull_senders[peer_ip] = file_sender
+        return peer_ip
+
+
+    def _grant_permission(self, yes_packet):
+        """ Hands the YES message to the offer it answers """
+        with self.transfers_lock:
+            transfer_id = yes_packet.get("TID")
+            if transfer_id is None:
+                # older peers don't send the transfer id back
+                for offer_id, permission in self.permissions.items():
+                    if permission is None and \
+                            self.uploads[offer_id].target_ip == yes_packet["MY_IP"]:
+                        transfer_id = offer_id
+                        break
+            if transfer_id in self.permissions:
+                self.permissions[transfer_id] = yes_packet
+                self.permission_event.notify_all()
+        self.terminal.notify()
+
+
+    def _find_json_upload(self, peer_ip):
+        """ Returns the JSON mode upload to the peer, JSON acks don't carry
+        the transfer id
+        """
+        with self.transfers_lock:
+            for file_sender in self.uploads.values():
+                if not file_sender.binary and file_sender.target_ip == peer_ip:
+                    return file_sender
+        return None
 
 
     def _start_udp_listener(self):
@@ -276,181 +1064,358 @@ class Messenger(object):
 
         with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:            
             s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            s.bind(('', self.port))
+            # chunks acked together by a SACK are answered with a burst
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_BUFFER)
+            s.bind(('' if self.bind_all else self.my_ip, self.port))
             s.setblocking(0)
             
             while True:
                 
                 result = select.select([s], [], [])
-                data = result[0][0].recv(1500).decode("utf-8")
-                
-                mes = _decode_message(data)
-                if not mes or mes["MY_IP"] == self.my_ip:
-                    if mes["TYPE"] == "GOODBYE":
-                        break
-                    continue
+                data, addr = result[0][0].recvfrom(1500)
+                if self._handle_datagram(data):
+                    break
+
+        print("UDP Server killed")
 
-                #print(mes)
-                
-                if mes["TYPE"]=="DISCOVER":
-                    self._update_ip2name("ADD", mes["MY_IP"], mes["NAME"])
-                    message_str = json.dumps(self._generate_message("RESPOND"))
-                    self._send_message("TCP", mes["MY_IP"], message_str)
 
-                elif mes["TYPE"]=="GOODBYE":
-                    self._update_ip2name("DEL", mes["MY_IP"])
+    def _handle_datagram(self, data):
+        """ Handles a UDP datagram. Returns True for our own GOODBYE, which
+        stops the listener.
+        """
+        if packets.is_binary(data):
+            self._handle_binary_packet(data)
+            return False
 
-                elif mes["TYPE"]=="ACK" and not(self.file_sender is None):
-                    self.file_sender.ack_confirm(mes["SERIAL"], mes["RWND"])
+        mes = _decode_message(data.decode("utf-8", "replace"))
+        if not mes or mes["MY_IP"] == self.my_ip:
+            return bool(mes) and mes["TYPE"] == "GOODBYE"
 
+        #print(mes)
 
-                elif mes["TYPE"]=="FILE":
-                    #print(mes, self.current_download)
-                    if self.current_download[0] == mes["MY_IP"]:
-                        with self.ack_buffer_lock:
-                            self.ack_buffer.append(mes)
+        if mes["TYPE"]=="DISCOVER":
+            self._update_ip2name("ADD", mes["MY_IP"], mes["NAME"], mes.get("FRAMED"))
+            message_str = json.dumps(self._presence_message("RESPOND"))
+            self._send_message("TCP", mes["MY_IP"], message_str)
 
-        
-        print("UDP Server killed")
+        elif mes["TYPE"]=="GOODBYE":
+            self._update_ip2name("DEL", mes["MY_IP"])
+            self._peer_left(mes["MY_IP"])
+
+        elif mes["TYPE"]=="ACK":
+            file_sender = self._find_json_upload(mes["MY_IP"])
+            if file_sender is not None:
+                file_sender.ack_confirm(mes["SERIAL"], mes["RWND"])
+
+        elif mes["TYPE"]=="FILE":
+            file_receiver = self.downloads.get(mes["MY_IP"])
+            if file_receiver is not None:
+                self._queue_chunk(file_receiver, mes)
+        return False
+
+
+    def _handle_binary_packet(self, data):
+        """ Handles binary datagrams (see packets.py). Packets are matched to the
+        transfer by transfer id since the source address of a datagram may
+        differ from the MY_IP of the peer on multi-homed hosts.
+        """
+        packet = packets.decode(data)
+        if not packet:
+            return
+        kind, transfer_id, serial, payload = packet
+
+        if kind == packets.ACK:
+            file_sender = self.uploads.get(transfer_id)
+            if file_sender is not None:
+                file_sender.ack_confirm(serial, packets.decode_ack(payload))
+
+        elif kind == packets.SACK:
+            file_sender = self.uploads.get(transfer_id)
+            if file_sender is not None:
+                file_sender.sack_confirm(*packets.decode_sack(serial, payload))
+
+        elif kind in (packets.FILE, packets.ZFILE, packets.REPAIR):
+            file_receiver = self.downloads.get(transfer_id)
+            uploader_ip = None
+            if file_receiver is not None:
+                uploader_ip = file_receiver.uploaders.get(transfer_id)
+            if uploader_ip is not None:
+                m_type = "REPAIR" if kind == packets.REPAIR else "FILE"
+                self._queue_chunk(file_receiver,
+                                  {"TYPE": m_type, "MY_IP": uploader_ip,
+                                   "TID": transfer_id, "SERIAL": serial,
+                                   "PAYLOAD": payload,
+                                   "COMPRESSED": kind == packets.ZFILE})
+
+
+    def _queue_chunk(self, file_receiver, mes):
+        """ Hands a received FILE or REPAIR message to the ack sender thread.
+        The asyncio engine stores and acks it right away.
+        """
+        if self.engine is not None:
+            self._store_chunk(file_receiver, mes)
+            return
+        with self.ack_buffer_lock:
+            if not self.ack_buffer.push((file_receiver, mes)):
+                file_receiver.stats.dropped += 1
+                return # full, dropped like by a full socket buffer, the uploader resends it
+            self.ack_buffer_event.notify()
 
                     
     def _start_tcp_listener(self):
         """ Listens MESSAGE and RESPOND packets """
-        quit_listener = False
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            s.bind((self.my_ip, self.port))
-            s.listen()
-            while True:
-                conn, _ = s.accept()
-                with open(self.db_file, "a") as chatdb_write:
-                    with conn:
-                        while True:
-                            data = conn.recv(1024)
-                            if not data:
-                                break
-                            elif data.decode("utf-8").startswith("QUIT"):
-                                quit_listener = True
-                                break
-                            else:
-                                mes = _decode_message(data.decode("utf-8"))
-                                if not mes:
-                                    continue
-
-                                #print(mes)
-                                if mes["TYPE"] == "RESPOND":
-                                    self._update_ip2name("ADD", mes["MY_IP"], mes["NAME"])
-                                
-                                elif mes["TYPE"] == "MESSAGE":
-                                    chatdb_write.write(data.decode("utf-8"))
-
-                                elif mes["TYPE"]=="YES":
-                                    self.permission_to_send = True
-
-                                elif mes["TYPE"]=="ALLOW":
-                                    self.download_request = mes  
-
-                                elif mes["TYPE"]=="DOWNLOAD_FAIL":
-                                    #print("FAILL")
-                                    #time.sleep(100)
-                                    self.current_download = [None, {}, ""]
- 
-                                elif mes["TYPE"]=="DOWNLOAD_SUCCESS":
-                                    total = int(mes["PAYLOAD"])
-                                    #print("Successs")
-                                    #time.sleep(100)
-                                    if True or len(self.current_download[1]) == total:
-                                        t = threading.Thread(target=self._download_finish,\
-                                                                        args=(total-1,))
-                                        t.start()
-                                    else:
-                                        self.current_download = [None, {}, ""]
-
-
-                        if quit_listener:
-                            break
-        
+        self.tcp_pool.serve(self.my_ip)
         print("TCP Server killed")
-                        
+
+
+    def _handle_tcp_message(self, data):
+        """ Handles a message received over TCP """
+        mes = _decode_message(data.decode("utf-8", "replace"))
+        if not mes:
+            return
+
+        #print(mes)
+        if mes["TYPE"] == "RESPOND":
+            self._update_ip2name("ADD", mes["MY_IP"], mes["NAME"], mes.get("FRAMED"))
+
+        elif mes["TYPE"] == "MESSAGE":
+            self.chat_store.append(mes["MY_IP"], mes)
+            self.terminal.notify()
+
+        elif mes["TYPE"]=="YES":
+            self._grant_permission(mes)
+
+        elif mes["TYPE"] in ("ALLOW", "ALLOW_BATCH"):
+            self.download_requests.append(mes)
+            self.terminal.notify()
+
+        elif mes["TYPE"]=="DOWNLOAD_FAIL":
+            self._transfer_done(mes, False)
+
+        elif mes["TYPE"]=="DOWNLOAD_SUCCESS":
+            self._transfer_done(mes, True)
+
+        elif mes["TYPE"]=="DELTA":
+            file_receiver = self._find_download(mes)
+            if file_receiver is not None and file_receiver.delta_block:
+                file_receiver.copying = threading.Event()
+                self._background(self._apply_delta, file_receiver,
+                                 deltaSync.decode_copies(mes["PAYLOAD"] or ""))
+
+        elif mes["TYPE"]=="HAVE":
+            if mes["PAYLOAD"] in self.shared_files:
+                have_packet = self._generate_message("HAVE_YES", mes["PAYLOAD"])
+                have_packet["FEATURES"] = packets.FEATURES
+                self._send_message("TCP", mes["MY_IP"], json.dumps(have_packet))
+
+        elif mes["TYPE"]=="HAVE_YES":
+            swarm = self.swarms.get(mes["PAYLOAD"])
+            if swarm is not None:
+                swarm.add_peer(mes["MY_IP"], mes.get("FEATURES", []))
+
+        elif mes["TYPE"]=="PULL":
+            self._serve_pull(mes)
+
+        elif mes["TYPE"]=="PULL_CANCEL":
+            file_sender = self.uploads.get(mes.get("TID"))
+            if file_sender is not None:
+                file_sender.cancel()
+
   
-    def _send_message(self, protocol, ip_address, message, filename=None):
-        """ Sends message to given ip address in given protocol type """
+    def _send_message(self, protocol, ip_address, message):
+        """ Sends message to given ip address in given protocol type.
+        Binary datagrams (bytes) are sent over UDP as they are.
+        """
+        if isinstance(message, bytes):
+            self._send_datagram(message, ip_address)
+            return
         message += '\n'
         if protocol == "TCP":
-            if filename:
-                with open(filename, "a") as f:
-                    f.write(ip_address+"|"+message)
-            
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                try:
-                    s.settimeout(2)
-                    s.connect((ip_address, self.port))
-                    s.settimeout(None)
-                    s.sendall(str.encode(message, "utf-8"))
-                except:
-                    return False
-            return True
+            with self.ip2name_lock:
+                framed = ip_address in self.framed_peers
+            if self.engine is not None:
+                return self.engine.send_tcp(ip_address, str.encode(message, "utf-8"), framed)
+            return self.tcp_pool.send(ip_address, str.encode(message, "utf-8"), framed)
 
         elif protocol == "UDP":
             if ip_address == "broadcast":
-                myip = get_my_ip()
-                domain = myip[0:myip.find('.')]
-                if domain == '192':
-                    ip_address = '<broadcast>'
-                else:
-                    ip_address = domain + '.255.255.255'
+                self._broadcast(str.encode(message, "utf-8"))
+                return
+            self._send_datagram(str.encode(message, "utf-8"), ip_address)
+
+
+    def _broadcast(self, data):
+        """ Sends a datagram to every subnet of the host. If a send fails,
+        the interfaces may have changed, they are listed again for the next
+        broadcast.
+        """
+        if self.send_socket is None:
+            # rare enough to open a socket for, the asyncio engine's socket
+            # can't tell which send failed
             with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-                s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST,1)
-                s.sendto(str.encode(message, "utf-8"), (ip_address, self.port))
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+                self._broadcast_from(s, data)
+        else:
+            self._broadcast_from(self.send_socket, data)
 
 
-    def _read_messages(self, ip_addr):
-        """ Reads messages from db to display messages in a chat room.
+    def _broadcast_from(self, sock, data):
+        for address in interfaces.broadcast_addresses():
+            try:
+                sock.sendto(data, (address, self.port))
+            except OSError:
+                interfaces.refresh()
 
-        Args:
-            ip_addr (str): IP address of the peer in the chat room.
 
-        Returns:
-            list: list of messages for the chat room.
-        """
-        res = []
-        with open(self.db_file, "r") as file:
-            lines = file.readlines()
-            for line in lines:
-                try:
-                    mes = json.loads(line)
-                except:
-                    if line.split("|")[0] != ip_addr:
-                        continue
-                    else:
-                        mes = json.loads("|".join(line.split("|")[1:]))
-                        if _validate_packet(mes):
-                            res.append(mes)
-                if mes["TYPE"] == "MESSAGE" and mes["MY_IP"] == ip_addr:
-                    if _validate_packet(mes):
-                        res.append(mes)
-        return res
+    def _send_datagram(self, data, ip_address):
+        """ Sends a unicast datagram, through the test channel if there is one.
+        Datagrams to ourselves (e.g. GOODBYE in kill) always get through.
+        """
+        if self.channel is not None and ip_address != self.my_ip:
+            self.channel.send(data, ip_address, self._sendto)
+        else:
+            self._sendto(data, ip_address)
+
+
+    def _send_datagrams(self, datagrams, ip_address):
+        """ Sends several unicast datagrams to a peer at once, e.g. a round
+        of FileSender. The asyncio engine sends them in one callback of the
+        loop.
+        """
+        if self.channel is not None and ip_address != self.my_ip:
+            for data in datagrams:
+                self.channel.send(data, ip_address, self._sendto)
+        elif self.engine is not None:
+            self.engine.send_datagrams(datagrams, ip_address)
+        else:
+            address = (ip_address, self.port)
+            sendto = self.send_socket.sendto
+            for data in datagrams:
+                sendto(data, address)
+
+
+    def _sendto(self, data, ip_address):
+        if self.engine is not None:
+            self.engine.send_datagram(data, ip_address)
+            return
+        self.send_socket.sendto(data, (ip_address, self.port))
 
 
     def _ack_sender(self):
-        while(not (self.current_download[0] is None)):
-            send_ack = False
+        while True:
             with self.ack_buffer_lock:
-                if self.ack_buffer:
-                    mes = self.ack_buffer.pop(0)
-                    send_ack = True
-            
-            if send_ack:
-                ack_packet = {"NAME":self.my_name, "MY_IP": self.my_ip, 
-                                "TYPE": "ACK", "PAYLOAD": None,
-                                "SERIAL":mes["SERIAL"], "RWND":self._calculate_rwnd()}
-                self._send_message("UDP", mes["MY_IP"], json.dumps(ack_packet))
-                
-                if mes["SERIAL"] != -1:
-                    self.current_download[1][mes["SERIAL"]] = mes["PAYLOAD"]
+                # sleep until a packet arrives, a SACK is due or the
+                # messenger is killed
+                while not self.ack_buffer and not self.stopped:
+                    timeout = self._ack_timeout()
+                    if timeout is not None and timeout <= 0:
+                        break
+                    self.ack_buffer_event.wait(timeout)
+                if self.stopped:
+                    break
+                item = self.ack_buffer.pop() if self.ack_buffer else None
 
+            if item is not None:
+                self._store_chunk(*item)
+            self._send_due_acks()
 
-    def _calculate_rwnd(self):
 
-        buffer_len = len(self.ack_buffer)*1500 # in bytes
-        return 2*1024*1024-buffer_len # our buffer size is 2 mb
+    def _store_chunk(self, file_receiver, mes):
+        """ Stores a received chunk or parity and acks the chunks that it
+        completes
+        """
+        # store the chunk before acking it, the uploader sends
+        # DOWNLOAD_SUCCESS as soon as the last ack arrives
+        if mes["TYPE"] == "REPAIR":
+            serials = file_receiver.add_parity(mes["SERIAL"], mes["PAYLOAD"])
+        elif mes["SERIAL"] != -1:
+            payload = mes["PAYLOAD"]
+            if mes.get("COMPRESSED"):
+                payload = decompress(payload, packets.PAYLOAD_SIZE)
+                if payload is None:
+                    return # not acked, the uploader sends it again
+            rebuilt = file_receiver.write_chunk(mes["SERIAL"], payload)
+            if rebuilt is None:
+                return # not stored, not acked
+            # rebuilt chunks are acked like received ones
+            serials = [mes["SERIAL"]] + rebuilt
+        else:
+            serials = [-1]
+
+        if serials != [-1] and mes.get("TID") in file_receiver.sack_transfers:
+            self._add_acks(file_receiver, mes, serials)
+            return
+        for serial in serials:
+            if "TID" in mes:
+                ack_packet = packets.encode_ack(mes["TID"], serial,
+                                                self._calculate_rwnd(file_receiver))
+            else:
+                ack_packet = json.dumps({"NAME":self.my_name, "MY_IP": self.my_ip, 
+                            "TYPE": "ACK", "PAYLOAD": None,
+                            "SERIAL":serial, "RWND":self._calculate_rwnd(file_receiver)})
+            self._send_message("UDP", mes["MY_IP"], ack_packet)
+            file_receiver.stats.acks_sent += 1
+
+
+    def _add_acks(self, file_receiver, mes, serials):
+        """ Adds stored chunks to the next SACK of their transfer. It is sent
+        when ACK_EVERY chunks are waiting, after ACK_DELAY or when the
+        download is complete.
+        """
+        transfer_id = mes["TID"]
+        entry = self.pending_acks.get(transfer_id)
+        if entry is None:
+            entry = [file_receiver, mes["MY_IP"], [], time.time() + ACK_DELAY]
+            self.pending_acks[transfer_id] = entry
+            if self.engine is not None:
+                self.engine.loop.call_later(ACK_DELAY, self._send_acks, transfer_id, entry)
+        entry[2] += serials
+        if len(entry[2]) >= ACK_EVERY or file_receiver.is_complete():
+            self._send_acks(transfer_id, entry)
+
+
+    def _ack_timeout(self):
+        """ Returns the seconds until the next SACK is due, None if no
+        chunk is waiting for one
+        """
+        if not self.pending_acks:
+            return None
+        return min(entry[3] for entry in self.pending_acks.values()) - time.time()
+
+
+    def _send_due_acks(self):
+        now = time.time()
+        for transfer_id, entry in list(self.pending_acks.items()):
+            if entry[3] <= now:
+                self._send_acks(transfer_id, entry)
+
+
+    def _send_acks(self, transfer_id, entry):
+        if self.pending_acks.get(transfer_id) is not entry:
+            return # already sent
+        del self.pending_acks[transfer_id]
+        file_receiver, uploader_ip, serials, _ = entry
+        rwnd = self._calculate_rwnd(file_receiver)
+        for packet in file_receiver.sack_packets(transfer_id, serials, rwnd):
+            self._send_message("UDP", uploader_ip, packet)
+            file_receiver.stats.acks_sent += 1
+
+
+    def _calculate_rwnd(self, file_receiver):
+        """ Returns the bytes an uploader of the download may still send:
+        its share of the free space in the receive buffer, minus the data
+        the download keeps in memory until it can be written. Downloads
+        written in order can't keep more than PENDING_LIMIT bytes of out of
+        order chunks.
+        """
+        with self.ack_buffer_lock:
+            free = self.ack_buffer.free() * packets.DATAGRAM_SIZE
+        with self.transfers_lock:
+            uploaders = max(len(self.downloads), 1)
+        rwnd = free // uploaders - file_receiver.buffered_bytes()
+        room = file_receiver.pending_room()
+        if room is not None:
+            rwnd = min(rwnd, room)
+        rwnd = max(rwnd, 0)
+        file_receiver.stats.rwnd = rwnd
+        return rwnd
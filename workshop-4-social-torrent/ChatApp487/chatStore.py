@@ -0,0 +1,140 @@
+""" Chat history.
+
+Messages are kept in one append-only log per peer, one JSON record per
+line. Next to every log an index holds the end offset of each record as
+8-byte integers, so the records [start, end) of a peer are read with one
+seek and one read, no matter how long the history is. A chat room reads the
+last page when it opens, then only the records appended after its cursor.
+
+    .db/chats/192.168.1.5.log
+    .db/chats/192.168.1.5.idx
+"""
+import os, re, json, threading
+from array import array
+
+
+class ChatStore(object):
+    def __init__(self, directory=".db/chats"):
+        """
+        Args:
+            directory (str, optional): Directory of the logs
+        """
+        self.directory = directory
+        self.ends = {} # key: peer ip, value: array of record end offsets
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+
+    def append(self, peer_ip, mes):
+        """ Adds a message to the history with a peer
+
+        Args:
+            peer_ip (str): IP address of the peer
+            mes (dict): Message sent to or received from the peer
+        """
+        record = (json.dumps(mes) + "\n").encode("utf-8")
+        with self.lock:
+            ends = self._ends(peer_ip)
+            log_path, index_path = self._paths(peer_ip)
+            with open(log_path, "ab") as log:
+                log.write(record)
+            ends.append((ends[-1] if ends else 0) + len(record))
+            with open(index_path, "ab") as index:
+                index.write(ends[-1:].tobytes())
+
+
+    def import_chat_db(self, path):
+        """ Moves the messages of the single chat file of older versions
+        into the logs of their peers, once. The file is kept renamed as
+        "<path>.imported".
+
+        Args:
+            path (str): Path of the old chat file, ".db/.chat_db"
+        """
+        if not os.path.isfile(path):
+            return
+        with open(path, encoding="utf-8", errors="replace") as file:
+            for line in file:
+                # received messages are stored as they are, sent ones
+                # as "<peer ip>|<message>"
+                peer_ip = None
+                if not line.startswith("{"):
+                    peer_ip, _, line = line.partition("|")
+                try:
+                    mes = json.loads(line)
+                except ValueError:
+                    continue
+                if not isinstance(mes, dict) or mes.get("TYPE") != "MESSAGE" or \
+                        not isinstance(mes.get("MY_IP"), str):
+                    continue
+                self.append(peer_ip or mes["MY_IP"], mes)
+        os.replace(path, path + ".imported")
+
+
+    def count(self, peer_ip):
+        """ Returns the number of messages with a peer """
+        with self.lock:
+            return len(self._ends(peer_ip))
+
+
+    def read(self, peer_ip, start, end=None):
+        """ Returns the messages [start, end) with a peer, oldest first """
+        with self.lock:
+            ends = self._ends(peer_ip)
+            end = len(ends) if end is None else min(end, len(ends))
+            start = max(start, 0)
+            if start >= end:
+                return []
+            first = ends[start - 1] if start else 0
+            with open(self._paths(peer_ip)[0], "rb") as log:
+                log.seek(first)
+                data = log.read(ends[end - 1] - first)
+        return [json.loads(line) for line in data.decode("utf-8", "replace").splitlines()]
+
+
+    def read_since(self, peer_ip, cursor):
+        """ Returns the messages after the cursor and the new cursor """
+        messages = self.read(peer_ip, cursor)
+        return messages, cursor + len(messages)
+
+
+    def _paths(self, peer_ip):
+        # peer ips come from the network, keep them out of the path
+        name = re.sub(r"[^0-9A-Za-z.-]", "_", peer_ip)
+        base = os.path.join(self.directory, name)
+        return base + ".log", base + ".idx"
+
+
+    def _ends(self, peer_ip):
+        """ Loads the index of a peer. Must be called with lock held. """
+        ends = self.ends.get(peer_ip)
+        if ends is not None:
+            return ends
+        log_path, index_path = self._paths(peer_ip)
+        ends = array("Q")
+        if os.path.exists(index_path):
+            with open(index_path, "rb") as index:
+                data = index.read()
+            ends.frombytes(data[:len(data) - len(data) % ends.itemsize])
+        size = os.path.getsize(log_path) if os.path.exists(log_path) else 0
+        if (ends[-1] if ends else 0) != size:
+            # interrupted write, index the log again
+            ends = self._rebuild(log_path, index_path)
+        self.ends[peer_ip] = ends
+        return ends
+
+
+    def _rebuild(self, log_path, index_path):
+        ends = array("Q")
+        offset = 0
+        if os.path.exists(log_path):
+            with open(log_path, "rb+") as log:
+                for line in log:
+                    if not line.endswith(b"\n"):
+                        break # a partial record at the end
+                    offset += len(line)
+                    ends.append(offset)
+                log.truncate(offset)
+        with open(index_path, "wb") as index:
+            index.write(ends.tobytes())
+        return ends
@@ -0,0 +1,165 @@
+""" Transparent compression of file chunks.
+
+When both sides list "ZLIB" in the FEATURES of the ALLOW and YES messages,
+every binary chunk that gets smaller with raw deflate is sent as a ZFILE
+packet instead of a FILE packet. Chunks are compressed one by one, so a lost
+packet only loses its own chunk and the receiver still writes every chunk
+at its offset.
+
+The uploader doesn't offer compression for files that are already
+compressed, recognized by their extension or by compressing a sample of
+their chunks. Inside a file, a run of incompressible chunks pauses the
+compression for a while, so mixed files don't waste CPU on their
+compressed parts. Chunks are compressed ahead of the send window by a
+separate thread; zlib releases the GIL, so it runs next to the send loop.
+"""
+import os, zlib, threading
+
+COMPRESSED_EXTENSIONS = {
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic", ".pdf",
+    ".zip", ".gz", ".tgz", ".bz2", ".xz", ".7z", ".rar", ".zst", ".br", ".lz4",
+    ".docx", ".xlsx", ".pptx", ".odt", ".jar", ".apk", ".epub",
+    ".mp3", ".aac", ".ogg", ".flac", ".mp4", ".m4a", ".mkv", ".avi", ".mov", ".webm",
+}
+LEVEL = 1 # fastest level, most of the gain at a fraction of the CPU time
+MIN_SAVING = 0.1 # a compressed chunk must be at least 10% smaller
+SAMPLE_CHUNKS = 64 # chunks compressed to decide whether a file is compressible
+PAUSE_AFTER = 16 # incompressible chunks in a row that pause the compression
+PAUSE_CHUNKS = 256 # chunks sent as they are during a pause
+
+
+def compress(data, level=LEVEL):
+    """ Returns the raw deflate stream of the data """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress(data, max_size):
+    """ Inflates a chunk. Returns None if the data is invalid or inflates to
+    more than max_size bytes.
+    """
+    decompressor = zlib.decompressobj(-15)
+    try:
+        result = decompressor.decompress(data, max_size)
+    except zlib.error:
+        return None
+    if decompressor.unconsumed_tail or not decompressor.eof:
+        return None
+    return result
+
+
+def is_compressible(path, chunk_size):
+    """ Whether compressing the chunks of the file is worth it. Looks at the
+    extension first, then compresses chunks from all over the file.
+    """
+    if os.path.splitext(path)[1].lower() in COMPRESSED_EXTENSIONS:
+        return False
+    size = os.path.getsize(path)
+    chunk_num = (size + chunk_size - 1) // chunk_size
+    if chunk_num == 0:
+        return False
+    step = max(chunk_num // SAMPLE_CHUNKS, 1)
+    raw = compressed = 0
+    with open(path, "rb") as file:
+        for serial in range(0, chunk_num, step):
+            file.seek(serial*chunk_size)
+            data = file.read(chunk_size)
+            raw += len(data)
+            compressed += min(len(compress(data)), len(data))
+    return compressed < raw * (1 - MIN_SAVING)
+
+
+class CompressedChunks(object):
+    def __init__(self, chunks, read_ahead=256):
+        """ Sequence of binary chunks that adds the compressed payload as
+        "ZPAYLOAD" to the chunks that get smaller. "PAYLOAD" stays the raw
+        data, parity (FEC) is computed over the raw data.
+
+        Args:
+            chunks (sequence): Binary chunks, read in index order
+            read_ahead (int, optional): Chunks compressed ahead of the
+                last requested one
+        """
+        self.chunks = chunks
+        self.read_ahead = read_ahead
+        self.ready = {} # key: index, value: compressed chunk
+        self.next_index = 0 # next index for the compressor thread
+        self.wanted = 0 # one past the highest requested index
+        self.incompressible = 0 # incompressible chunks in a row
+        self.paused = 0 # chunks left to send without compression
+        self.closed = False
+        self.compressing = None # index the compressor thread is working on
+        self.awaited = set() # indexes requested while being compressed
+        self.lock = threading.Lock()
+        self.event = threading.Condition(self.lock)
+
+        self.thread = threading.Thread(target=self._compressor, args=(), daemon=True)
+        self.thread.start()
+
+
+    def __len__(self):
+        return len(self.chunks)
+
+
+    def __getitem__(self, index):
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        with self.lock:
+            self.wanted = max(self.wanted, index + 1)
+            self.event.notify_all()
+            if index == self.compressing:
+                # wait for the compressor instead of compressing it twice
+                self.awaited.add(index)
+                self.event.wait_for(lambda: self.compressing != index)
+                self.awaited.discard(index)
+            chunk = self.ready.pop(index, None)
+        if chunk is None:
+            # the compressor is behind, don't wait for it
+            chunk = self._compress(self.chunks[index])
+        return chunk
+
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.ready.clear()
+            self.event.notify_all()
+
+
+    def _compress(self, chunk):
+        """ Must be called without lock held, zlib runs outside of it """
+        with self.lock:
+            if self.paused:
+                self.paused -= 1
+                return chunk
+        data = compress(chunk["PAYLOAD"])
+        with self.lock:
+            if len(data) > len(chunk["PAYLOAD"]) * (1 - MIN_SAVING):
+                self.incompressible += 1
+                if self.incompressible >= PAUSE_AFTER:
+                    self.incompressible = 0
+                    self.paused = PAUSE_CHUNKS
+                return chunk
+            self.incompressible = 0
+        chunk["ZPAYLOAD"] = data
+        return chunk
+
+
+    def _compressor(self):
+        while True:
+            with self.lock:
+                while True:
+                    if self.closed:
+                        return
+                    index = max(self.next_index, self.wanted)
+                    if index < len(self.chunks) and index < self.wanted + self.read_ahead:
+                        break
+                    self.event.wait()
+                self.next_index = index + 1
+                self.compressing = index
+            chunk = self._compress(self.chunks[index])
+            with self.lock:
+                self.compressing = None
+                if not self.closed and (index >= self.wanted or index in self.awaited):
+                    self.ready[index] = chunk
+                self.event.notify_all()
@@ -0,0 +1,107 @@
+""" Congestion control for file transfers.
+
+RttEstimator keeps the smoothed round trip time and the retransmission
+timeout (RFC 6298). CongestionController grows the congestion window by one
+chunk per ack in slow start and by one chunk per window afterwards, and
+halves it at most once per round trip when packets are lost (AIMD).
+Pacer spreads the window over a round trip so that the window isn't sent
+as a single burst.
+"""
+
+
+class RttEstimator(object):
+    def __init__(self, initial_rto=1.0, min_rto=0.2, max_rto=60.0):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial_rto
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+
+
+    def sample(self, rtt):
+        """ Updates the estimation with a measured round trip time.
+        Retransmitted chunks must not be sampled (Karn's algorithm).
+        """
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75*self.rttvar + 0.25*abs(self.srtt - rtt)
+            self.srtt = 0.875*self.srtt + 0.125*rtt
+        self.rto = min(max(self.srtt + 4*self.rttvar, self.min_rto), self.max_rto)
+
+
+class CongestionController(object):
+    def __init__(self, initial_window=10, min_window=2, max_window=1024):
+        """ Window is counted in chunks """
+        self.cwnd = float(initial_window)
+        self.ssthresh = float(max_window)
+        self.min_window = min_window
+        self.max_window = max_window
+        self.recovery_until = 0 # losses before this time belong to the same event
+
+
+    @property
+    def window(self):
+        return int(self.cwnd)
+
+
+    def in_slow_start(self):
+        return self.cwnd < self.ssthresh
+
+
+    def on_ack(self):
+        if self.in_slow_start():
+            self.cwnd += 1
+        else:
+            self.cwnd += 1 / self.cwnd
+        self.cwnd = min(self.cwnd, self.max_window)
+
+
+    def on_loss(self, now, srtt):
+        """ Halves the window. Returns False if the loss belongs to a loss
+        event that has already been reacted to.
+        """
+        if now < self.recovery_until:
+            return False
+        self.ssthresh = max(self.cwnd / 2, self.min_window)
+        self.cwnd = self.ssthresh
+        self.recovery_until = now + (srtt or 0)
+        return True
+
+
+class Pacer(object):
+    def __init__(self, burst=16):
+        """ Token bucket that releases at most `burst` packets at once """
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = None
+
+
+    def refill(self, now, rate):
+        """ Adds the tokens earned since the last refill.
+
+        Args:
+            now (float): Current time
+            rate (float or None): Packets per second, None for no pacing
+        """
+        if rate is None:
+            self.tokens = float(self.burst)
+        elif self.last is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.last)*rate)
+        self.last = now
+
+
+    def take(self):
+        """ Consumes a token if one is available """
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+    def delay(self, rate):
+        """ Returns the seconds until the next token """
+        if rate is None or self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / rate
@@ -0,0 +1,367 @@
+""" Persistent TCP connections between messengers.
+
+TCP messages to peers that read frames are sent as a frame: a 4-byte
+big-endian length followed by the message. A ConnectionPool keeps one
+connection open to every such peer and reuses it for the next messages, so
+a chat or control message costs one write instead of a TCP handshake.
+Peers say that they read frames with the FRAMED flag of their DISCOVER or
+RESPOND message. The others get the message as newline-terminated JSON on
+a connection of its own, like in the original protocol. All accepted and
+outgoing connections are watched by a single selector thread, so a peer
+that keeps its connection open doesn't block the others. Connections that
+are not used for `idle_timeout` seconds are closed.
+
+Peers running the original protocol open a connection per message and send
+it as newline-terminated JSON. Their connections are recognized by the "{"
+they start with, while a frame starts with a zero byte.
+
+Received messages are handled by a few worker threads, so a handler that
+waits (e.g. to connect to a peer) doesn't hold up the other connections.
+The messages of one connection are handled one by one, in order.
+"""
+import socket, selectors, struct, threading, time, traceback
+from collections import deque
+
+from scheduler import TransferScheduler
+
+HEADER = struct.Struct("!I") # length of the message
+MAX_FRAME = 1024*1024 # longer messages close the connection
+
+
+class MessageParser(object):
+    def __init__(self, max_size=MAX_FRAME):
+        """ Incremental parser of the bytes received on a connection. Both
+        frames and newline-terminated messages may be split over several
+        reads or arrive several in one read.
+
+        Args:
+            max_size (int, optional): Max length of a message
+        """
+        self.max_size = max_size
+        self.buffer = bytearray()
+        self.lines = None # whether the peer sends lines, unknown until the first byte
+        self.scanned = 0 # bytes of the buffer known to have no newline
+
+
+    def feed(self, data):
+        """ Adds received data.
+
+        Returns:
+            list: Complete messages (bytes), lines keep their newline
+
+        Raises:
+            ValueError: If a message is longer than max_size
+        """
+        buffer = self.buffer
+        buffer += data
+        if self.lines is None and buffer:
+            self.lines = buffer[:1] == b"{"
+        messages = []
+        if self.lines:
+            while True:
+                end = buffer.find(b"\n", self.scanned)
+                if end < 0:
+                    self.scanned = len(buffer)
+                    if len(buffer) > self.max_size:
+                        raise ValueError("line too long")
+                    break
+                messages.append(bytes(buffer[:end + 1]))
+                del buffer[:end + 1]
+                self.scanned = 0
+        else:
+            while len(buffer) >= HEADER.size:
+                length, = HEADER.unpack_from(buffer)
+                if length > self.max_size:
+                    raise ValueError("frame too long")
+                if len(buffer) < HEADER.size + length:
+                    break
+                messages.append(bytes(buffer[HEADER.size:HEADER.size + length]))
+                del buffer[:HEADER.size + length]
+        return messages
+
+
+class Connection(object):
+    def __init__(self, sock, ip, outgoing):
+        """ An open TCP connection of a ConnectionPool
+
+        Args:
+            sock (socket): Connected socket
+            ip (str): IP address of the peer
+            outgoing (bool): Whether we opened it to send messages, peers
+                only send messages on the connections they opened
+        """
+        self.sock = sock
+        self.ip = ip
+        self.outgoing = outgoing
+        self.parser = MessageParser()
+        self.messages = deque() # received messages waiting for a worker
+        self.dispatching = False # whether a worker handles the messages
+        self.last_used = time.time()
+        self.lock = threading.Lock() # held while a frame is written
+
+
+class ConnectionPool(object):
+    def __init__(self, port, handler, idle_timeout=60, connect_timeout=2, send_timeout=2,
+                 workers=4):
+        """ serve() must be running in a thread to receive messages and to
+        notice the connections closed by the peers.
+
+        Args:
+            port (int): TCP port of the messengers
+            handler (function): Called as handler(data) with every received
+                message, from a worker thread
+            idle_timeout (float, optional): Seconds after an unused
+                connection is closed
+            connect_timeout (float, optional): Seconds to wait for a new
+                connection
+            send_timeout (float, optional): Seconds to wait for a frame to
+                be written, the connection is closed after
+            workers (int, optional): Number of threads that handle the
+                received messages
+        """
+        self.port = port
+        self.handler = handler
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.send_timeout = send_timeout
+        self.workers = TransferScheduler(workers)
+
+        self.connections = {} # key: peer ip, value: outgoing Connection
+        self.new_connections = [] # outgoing Connections for the selector thread
+        self.closed = False
+        self.lock = threading.Lock()
+        self.selector = selectors.DefaultSelector()
+        # wakes the selector thread up when there is a new connection or on close
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+
+
+    def send(self, ip, data, framed=True):
+        """ Sends the data as one frame over the connection to the peer,
+        opening one if there is none. A broken connection is replaced once.
+
+        Args:
+            ip (str): IP address of the peer
+            data (bytes): Message, newline-terminated if not framed
+            framed (bool, optional): Whether the peer reads frames,
+                otherwise the data is sent on a connection of its own
+
+        Returns:
+            bool: Whether the message was written
+        """
+        if not framed:
+            return self._send_once(ip, data)
+        frame = HEADER.pack(len(data)) + data
+        for _ in range(2):
+            connection, reused = self._connection(ip)
+            if connection is None:
+                return False
+            with connection.lock:
+                try:
+                    connection.sock.sendall(frame)
+                    connection.last_used = time.time()
+                    return True
+                except OSError:
+                    pass
+            self._discard(connection)
+            if not reused:
+                break
+        return False
+
+
+    def _send_once(self, ip, data):
+        """ Sends the data on a new connection and closes it """
+        try:
+            with socket.create_connection((ip, self.port), timeout=self.connect_timeout) as sock:
+                sock.settimeout(self.send_timeout)
+                sock.sendall(data)
+        except OSError:
+            return False
+        return True
+
+
+    def serve(self, ip):
+        """ Accepts the connections of the peers on ip:port and reads all
+        connections until close() is called. Blocks the calling thread.
+        """
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as listener:
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind((ip, self.port))
+            listener.listen()
+            listener.setblocking(False)
+            self.selector.register(listener, selectors.EVENT_READ, "listener")
+            self.selector.register(self.wakeup_reader, selectors.EVENT_READ, "wakeup")
+            try:
+                while not self.closed:
+                    for key, _ in self.selector.select(timeout=1):
+                        if key.data == "listener":
+                            self._accept(listener)
+                        elif key.data == "wakeup":
+                            self._drain_wakeup()
+                        else:
+                            self._read(key.data)
+                    self._register_new()
+                    self._evict_idle()
+            finally:
+                for key in list(self.selector.get_map().values()):
+                    if isinstance(key.data, Connection):
+                        self._close(key.data)
+                self.selector.close()
+                self.wakeup_reader.close()
+                self.wakeup_writer.close()
+                self.workers.stop()
+
+
+    def close(self):
+        """ Stops serve() and closes all connections """
+        with self.lock:
+            self.closed = True
+        self._wakeup()
+
+
+    def _connection(self, ip):
+        """ Returns the connection to the peer and whether it was already
+        open, or (None, False) if the peer can't be reached
+        """
+        with self.lock:
+            connection = self.connections.get(ip)
+        if connection is not None:
+            return connection, True
+
+        try:
+            sock = socket.create_connection((ip, self.port), timeout=self.connect_timeout)
+        except OSError:
+            return None, False
+        sock.settimeout(self.send_timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection = Connection(sock, ip, True)
+        with self.lock:
+            existing = self.connections.get(ip)
+            if self.closed or existing is not None:
+                # another thread connected first
+                sock.close()
+                return existing, existing is not None
+            self.connections[ip] = connection
+            self.new_connections.append(connection)
+        self._wakeup()
+        return connection, False
+
+
+    def _discard(self, connection):
+        """ Stops using a connection. The selector thread closes it when it
+        sees the shutdown.
+        """
+        with self.lock:
+            if self.connections.get(connection.ip) is connection:
+                del self.connections[connection.ip]
+        try:
+            connection.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+    def _close(self, connection):
+        """ Closes a connection, called from the selector thread only """
+        with self.lock:
+            if self.connections.get(connection.ip) is connection:
+                del self.connections[connection.ip]
+        try:
+            self.selector.unregister(connection.sock)
+        except (KeyError, ValueError):
+            pass
+        # wait for a frame that is being written
+        with connection.lock:
+            connection.sock.close()
+
+
+    def _wakeup(self):
+        try:
+            self.wakeup_writer.send(b"\0")
+        except OSError:
+            pass # already pending or closed
+
+
+    def _drain_wakeup(self):
+        try:
+            while self.wakeup_reader.recv(4096):
+                pass
+        except OSError:
+            pass
+
+
+    def _register_new(self):
+        with self.lock:
+            new_connections = self.new_connections
+            self.new_connections = []
+        for connection in new_connections:
+            self.selector.register(connection.sock, selectors.EVENT_READ, connection)
+
+
+    def _accept(self, listener):
+        try:
+            sock, address = listener.accept()
+        except OSError:
+            return
+        sock.setblocking(False)
+        connection = Connection(sock, address[0], False)
+        self.selector.register(sock, selectors.EVENT_READ, connection)
+
+
+    def _read(self, connection):
+        try:
+            data = connection.sock.recv(65536)
+        except (BlockingIOError, socket.timeout):
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self._close(connection)
+            return
+        connection.last_used = time.time()
+        if connection.outgoing:
+            return # peers don't send on our connections
+
+        try:
+            messages = connection.parser.feed(data)
+        except ValueError:
+            self._close(connection)
+            return
+        if not messages:
+            return
+        with self.lock:
+            connection.messages.extend(messages)
+            if connection.dispatching:
+                return
+            connection.dispatching = True
+        self.workers.submit(self._handle_messages, connection)
+
+
+    def _handle_messages(self, connection):
+        """ Handles the received messages of a connection in order """
+        while True:
+            with self.lock:
+                if not connection.messages:
+                    connection.dispatching = False
+                    return
+                message = connection.messages.popleft()
+            try:
+                self.handler(message)
+            except Exception:
+                traceback.print_exc()
+
+
+    def _evict_idle(self):
+        now = time.time()
+        for key in list(self.selector.get_map().values()):
+            connection = key.data
+            if not isinstance(connection, Connection):
+                continue
+            if now - connection.last_used < self.idle_timeout:
+                continue
+            if connection.outgoing:
+                # don't evict a connection while a frame is being written
+                if not connection.lock.acquire(blocking=False):
+                    continue
+                connection.lock.release()
+            self._close(connection)
@@ -0,0 +1,144 @@
+""" rsync-style delta transfers against an older copy of a file, see the README """
+import math, struct, base64, hashlib
+from itertools import accumulate, chain, compress, count, islice, repeat
+from operator import sub, mul
+
+SIGNATURE = struct.Struct("!Q8s") # weak checksum, strong hash of a block
+COPY = struct.Struct("!QII") # offset in the new file, first block, number of blocks
+MIN_BLOCK = 2048
+MAX_BLOCKS = 32768 # keeps the signatures of a file in one YES message
+SEGMENT = 256*1024 # bytes searched for a match at a time
+SEARCH_LIMIT = 4*1024*1024 # bytes searched since the last match before giving up
+
+
+def block_size(size):
+    """ Returns the block size for a file: about the square root of its
+    size, rounded up to a multiple of 1 KB
+    """
+    block = max(MIN_BLOCK, int(math.sqrt(size)) // 1024 * 1024 + 1024)
+    return max(block, -(-size // MAX_BLOCKS))
+
+
+def weak_checksum(block):
+    return sum(accumulate(block))
+
+
+def strong_hash(block):
+    return hashlib.blake2b(block, digest_size=8).digest()
+
+
+def signatures(path, block):
+    """ Returns the signatures of the full blocks of a file, packed """
+    sigs = bytearray()
+    with open(path, "rb") as file:
+        for data in iter(lambda: file.read(block), b""):
+            if len(data) < block:
+                break # the last block is only matched as a literal
+            sigs += SIGNATURE.pack(weak_checksum(data), strong_hash(data))
+    return bytes(sigs)
+
+
+def find_copies(path, block, sigs):
+    """ Finds the blocks of the receiver's copy in the new file
+
+    Args:
+        path (str): Path of the new file
+        block (int): Block size of the signatures
+        sigs (bytes): Packed signatures of the receiver's blocks
+
+    Returns:
+        list: (offset in the new file, first block, number of blocks)
+            triples, sorted by offset
+    """
+    blocks = {} # key: strong hash, value: block index
+    weak_table = set()
+    for index in range(len(sigs) // SIGNATURE.size):
+        weak, strong = SIGNATURE.unpack_from(sigs, index * SIGNATURE.size)
+        blocks.setdefault(strong, index)
+        weak_table.add(weak)
+
+    copies = []
+    with open(path, "rb") as file:
+        buffer, buffer_start = b"", 0 # holds the file from buffer_start on
+        pos = 0
+        last_match = 0
+        while pos - last_match < SEARCH_LIMIT:
+            if buffer_start + len(buffer) - pos < SEGMENT + block:
+                buffer = buffer[pos - buffer_start:] + file.read(2*SEGMENT)
+                buffer_start = pos
+            start = pos - buffer_start
+            if len(buffer) - start < block:
+                break
+            index = blocks.get(strong_hash(memoryview(buffer)[start:start + block]))
+            offset = 0
+            if index is None:
+                data = buffer[start:start + SEGMENT + block - 1]
+                offset, index = _search(data, block, weak_table, blocks)
+                if index is None:
+                    pos += len(data) - block + 1
+                    continue
+            pos += offset
+            if copies and copies[-1][0] + copies[-1][2] * block == pos and \
+                    copies[-1][1] + copies[-1][2] == index:
+                copies[-1][2] += 1
+            else:
+                copies.append([pos, index, 1])
+            pos += block
+            last_match = pos
+    return [tuple(copy) for copy in copies]
+
+
+def _search(data, block, weak_table, blocks):
+    """ Returns the first offset in data where a block of the receiver
+    starts and the index of the block, (None, None) if there is none
+    """
+    # with sums[m] = x[0] + ... + x[m-1] and totals[m] = sums[0] + ... +
+    # sums[m-1], the checksum of the window at k is
+    # totals[k+block+1] - totals[k+1] - block * sums[k]
+    sums = list(chain([0], accumulate(data)))
+    totals = list(chain([0], accumulate(sums)))
+    weaks = map(sub, map(sub, islice(totals, block + 1, None), islice(totals, 1, None)),
+                map(mul, islice(sums, len(data) - block + 1), repeat(block)))
+    view = memoryview(data)
+    for offset in compress(count(), map(weak_table.__contains__, weaks)):
+        index = blocks.get(strong_hash(view[offset:offset + block]))
+        if index is not None:
+            return offset, index
+    return None, None
+
+
+def covered_chunks(copies, block, size, chunk_size):
+    """ Returns the chunks of the new file that the copies fill completely,
+    as [start, end) serial ranges like the RESUME ranges of a YES message
+    """
+    chunk_num = -(-size // chunk_size)
+    ranges = []
+    for start, end in _merge(copies, block):
+        first = -(-start // chunk_size)
+        last = chunk_num if end >= size else end // chunk_size
+        if first < last:
+            ranges.append([first, last])
+    return ranges
+
+
+def _merge(copies, block):
+    """ Yields the byte ranges covered by the copies, adjacent ones joined """
+    start = end = None
+    for offset, _, blocks in copies:
+        if start is not None and offset > end:
+            yield start, end
+            start = None
+        if start is None:
+            start = offset
+        end = offset + blocks * block
+    if start is not None:
+        yield start, end
+
+
+def encode_copies(copies):
+    return base64.b64encode(b"".join(COPY.pack(*copy) for copy in copies)).decode("ascii")
+
+
+def decode_copies(text):
+    data = base64.b64decode(text)
+    return [COPY.unpack_from(data, i) for i in range(0, len(data) - COPY.size + 1, COPY.size)]
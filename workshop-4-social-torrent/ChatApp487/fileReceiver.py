@@ -0,0 +1,509 @@
+import os, threading, base64, json, struct, time, zlib
+from collections import OrderedDict
+
+import packets, deltaSync
+from telemetry import TransferStats
+
+MANIFEST_DIR = ".manifests" # in the download folder
+MANIFEST_SAVE_INTERVAL = 2 # seconds
+DIGEST = struct.Struct("!I") # CRC-32 of a chunk
+POPCOUNT = [bin(byte).count("1") for byte in range(256)]
+PARITY_LIMIT = 256 # REPAIR packets kept while their group misses more than one chunk
+PENDING_LIMIT = 2*1024*1024 # bytes of out of order chunks kept in memory
+COPY_BUFFER = 1024*1024 # bytes copied from the old file at a time
+MAX_CHUNKS = 2**28 # chunks of a download of known size, keeps its bitmap at 32 MB
+
+
+def download_path(filename, download_dir="Downloads"):
+    """ Returns the path that a download of the file is saved to """
+    return os.path.join(download_dir, os.path.basename(filename))
+
+
+def is_valid_size(size, chunk_size):
+    """ Whether the file size and the chunk size of an offer can be used to
+    preallocate the file and its chunk bitmap
+    """
+    return type(size) is int and type(chunk_size) is int and size >= 0 and \
+        0 < chunk_size <= packets.DATAGRAM_SIZE and size <= chunk_size * MAX_CHUNKS
+
+
+class ChunkBitmap(object):
+    def __init__(self, size):
+        """ Compact set of received chunk serials, one bit per chunk.
+
+        Args:
+            size (int): Number of chunks
+        """
+        self.size = size
+        self.bits = bytearray((size + 7) // 8)
+        self.count = 0 # number of set bits
+
+
+    def add(self, serial):
+        """ Marks the serial as received. Returns False if it already was. """
+        byte, mask = serial >> 3, 1 << (serial & 7)
+        if self.bits[byte] & mask:
+            return False
+        self.bits[byte] |= mask
+        self.count += 1
+        return True
+
+
+    def discard(self, serial):
+        byte, mask = serial >> 3, 1 << (serial & 7)
+        if self.bits[byte] & mask:
+            self.bits[byte] &= ~mask
+            self.count -= 1
+
+
+    @classmethod
+    def from_bytes(cls, size, data):
+        bitmap = cls(size)
+        if len(data) == len(bitmap.bits):
+            bitmap.bits[:] = data
+            bitmap.count = sum(POPCOUNT[byte] for byte in bitmap.bits)
+        return bitmap
+
+
+    def ranges(self):
+        """ Yields the runs of set serials as (start, end) pairs """
+        start = None
+        for serial in range(self.size):
+            if serial in self:
+                if start is None:
+                    start = serial
+            elif start is not None:
+                yield start, serial
+                start = None
+        if start is not None:
+            yield start, self.size
+
+
+    def window(self, start, count):
+        """ Returns the bits of the serials [start, start + count) as bytes,
+        bit i is serial start + i
+        """
+        end = min(start + count, self.size)
+        if start >= end:
+            return b""
+        bits = int.from_bytes(self.bits[start >> 3:(end + 7) >> 3], "little") >> (start & 7)
+        return (bits & ((1 << (end - start)) - 1)).to_bytes((end - start + 7) // 8, "little")
+
+
+    def __contains__(self, serial):
+        return 0 <= serial < self.size and bool(self.bits[serial >> 3] & (1 << (serial & 7)))
+
+
+    def is_full(self):
+        return self.count == self.size
+
+
+    def missing(self, start, end):
+        """ Returns the number of serials in [start, end) that are not set """
+        return sum(1 for serial in range(start, end) if serial not in self)
+
+
+class FileReceiver(object):
+    def __init__(self, uploader_ip, filename, transfer_id=None, binary=False,
+                 size=None, chunk_size=None, download_dir="Downloads", file_hash=None):
+        """ FileReceiver writes the chunks of a download directly to the
+        file at their offsets. The file is preallocated as "<filename>.part"
+        in the download folder and renamed when the download succeeds.
+
+        Chunks may come from several uploaders (swarm mode), each with its
+        own transfer id in `uploaders`.
+
+        If the file hash is known, a manifest with the received chunk bitmap
+        and a CRC-32 per chunk is kept in "<download_dir>/.manifests", so an
+        interrupted download resumes from the missing chunks when the same
+        file is offered again. Chunks whose CRC doesn't match the partial
+        file anymore are downloaded again.
+
+        A lost chunk is rebuilt from the REPAIR packet of its group and the
+        other chunks of the group, which are read back from the file.
+
+        If an older copy of the file is in the download folder, the blocks
+        of it that the new file still contains are copied instead of being
+        downloaded (delta transfer, see deltaSync.py).
+
+        If the uploader didn't tell the file size (older peers), chunks are
+        base64 decoded and appended in serial order instead; only the
+        chunks that arrive out of order are kept in memory.
+
+        Args:
+            uploader_ip (str): IP address of the uploader, None in swarm mode
+            filename (str): Name of the file
+            transfer_id (int, optional): Transfer ID given in the ALLOW message
+            binary (bool, optional): Whether payloads are raw bytes
+            size (int, optional): File size in bytes
+            chunk_size (int, optional): Number of file bytes in a chunk
+            download_dir (str, optional): Folder to save the file in
+            file_hash (str, optional): SHA-256 hash of the file
+        """
+        self.uploader_ip = uploader_ip
+        self.filename = os.path.basename(filename)
+        self.uploaders = {} # key: transfer id, value: uploader ip
+        if transfer_id is not None:
+            self.uploaders[transfer_id] = uploader_ip
+        self.sack_transfers = set() # transfer ids whose uploaders accept SACK packets
+        self.delta_block = None # block size of the signatures of a delta transfer
+        self.copying = None # Event set when the blocks of a DELTA message are copied
+        self.stats = TransferStats("download", transfer_id, uploader_ip, self.filename)
+        self.binary = binary
+        self.file_hash = file_hash
+        self.size = size
+        self.chunk_size = chunk_size
+
+        os.makedirs(download_dir, exist_ok=True)
+        self.path = download_path(self.filename, download_dir)
+        self.part_path = self.path + ".part"
+
+        self.manifest_path = None
+        self.digest_file = None
+        self.last_save = time.time()
+        if size is not None:
+            chunk_num = (size + chunk_size - 1) // chunk_size
+            if file_hash:
+                manifest_dir = os.path.join(download_dir, MANIFEST_DIR)
+                os.makedirs(manifest_dir, exist_ok=True)
+                self.manifest_path = os.path.join(manifest_dir, file_hash + ".json")
+                self.digest_path = os.path.join(manifest_dir, file_hash + ".crc")
+            if not self._load_manifest(chunk_num):
+                self.file = open(self.part_path, "wb+")
+                self.file.truncate(size) # preallocate
+                self.received = ChunkBitmap(chunk_num)
+                if self.manifest_path:
+                    self.digest_file = open(self.digest_path, "wb+")
+                    self.digest_file.truncate(chunk_num * DIGEST.size)
+        else:
+            self.file = open(self.part_path, "wb+")
+            self.received = None
+            self.next_serial = 0 # next serial to be appended
+            self.pending = {} # out of order chunks, key: serial no
+            self.pending_bytes = 0
+            self.base64_tail = "" # undecoded base64 characters
+
+        self.parities = OrderedDict() # key: first serial of a group, value: its parity
+        self.file_lock = threading.Lock()
+
+
+    def _load_manifest(self, chunk_num):
+        """ Continues an interrupted download of the same file if there is a
+        manifest for it. Returns False if there is none.
+        """
+        if not self.manifest_path:
+            return False
+        try:
+            with open(self.manifest_path) as file:
+                manifest = json.load(file)
+            if manifest["SIZE"] != self.size or manifest["CHUNK"] != self.chunk_size:
+                return False
+            part_file = open(manifest["PART"], "rb+")
+        except (OSError, ValueError, KeyError):
+            return False
+        try:
+            digest_file = open(self.digest_path, "rb+")
+        except OSError:
+            part_file.close()
+            return False
+        self.file = part_file
+        self.digest_file = digest_file
+        self.part_path = manifest["PART"]
+        self.received = ChunkBitmap.from_bytes(chunk_num, base64.b64decode(manifest["RECEIVED"]))
+
+        # drop the chunks that didn't make it to the disk intact
+        for start, end in list(self.received.ranges()):
+            for serial in range(start, end):
+                self.file.seek(serial*self.chunk_size)
+                data = self.file.read(self.chunk_size)
+                self.digest_file.seek(serial*DIGEST.size)
+                digest = DIGEST.unpack(self.digest_file.read(DIGEST.size))[0]
+                if zlib.crc32(data) != digest:
+                    self.received.discard(serial)
+        return True
+
+
+    def _save_manifest(self):
+        """ Must be called with file_lock held """
+        if not self.manifest_path:
+            return
+        manifest = {"HASH": self.file_hash, "NAME": self.filename, "SIZE": self.size,
+                    "CHUNK": self.chunk_size, "PART": self.part_path,
+                    "RECEIVED": base64.b64encode(self.received.bits).decode("utf-8")}
+        self.file.flush()
+        self.digest_file.flush()
+        with open(self.manifest_path + ".tmp", "w") as file:
+            json.dump(manifest, file)
+        os.replace(self.manifest_path + ".tmp", self.manifest_path)
+        self.last_save = time.time()
+
+
+    def _remove_manifest(self):
+        if not self.manifest_path:
+            return
+        self.digest_file.close()
+        for path in (self.manifest_path, self.digest_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+    def resume_ranges(self, limit=24):
+        """ Returns the largest runs of already received chunks as
+        [start, end] pairs, at most `limit` of them so that they fit in a
+        YES message. The uploader skips these chunks.
+        """
+        if self.received is None:
+            return []
+        with self.file_lock:
+            ranges = sorted(self.received.ranges(), key=lambda r: r[0] - r[1])[:limit]
+        return sorted([start, end] for start, end in ranges)
+
+
+    def delta_signatures(self):
+        """ Returns the signatures of the old copy of the file for a delta
+        transfer, None if there is no copy to start from or the download
+        is resumed
+        """
+        if not self.binary or self.received is None or self.received.count or \
+                not os.path.isfile(self.path):
+            return None
+        size = os.path.getsize(self.path)
+        if size < deltaSync.MIN_BLOCK:
+            return None
+        self.delta_block = deltaSync.block_size(size)
+        return deltaSync.signatures(self.path, self.delta_block)
+
+
+    def write_copies(self, copies):
+        """ Copies the blocks of the old copy that the new file contains
+        and marks the chunks they fill as received
+
+        Args:
+            copies (list): (offset in the new file, first block, number of
+                blocks) triples of the DELTA message
+        """
+        block = self.delta_block
+        copies = [copy for copy in copies if copy[0] + copy[2]*block <= self.size]
+        with open(self.path, "rb") as old_file:
+            for offset, first, count in copies:
+                old_file.seek(first*block)
+                for pos in range(offset, offset + count*block, COPY_BUFFER):
+                    data = old_file.read(min(COPY_BUFFER, offset + count*block - pos))
+                    # the lock is released between reads so that the
+                    # chunks being received are not held up for long
+                    with self.file_lock:
+                        if self.file.closed:
+                            return
+                        self.file.seek(pos)
+                        self.file.write(data)
+        for start, end in deltaSync.covered_chunks(copies, block, self.size, self.chunk_size):
+            with self.file_lock:
+                if self.file.closed:
+                    return
+                for serial in range(start, end):
+                    if serial not in self.received:
+                        self.file.seek(serial*self.chunk_size)
+                        self._store(serial, self.file.read(self.chunk_size))
+
+
+    def sack_packets(self, transfer_id, serials, rwnd):
+        """ Returns the SACK packets that ack the given serials (see packets.py) """
+        with self.file_lock:
+            return packets.encode_sacks(transfer_id, serials, rwnd, self.received)
+
+
+    def write_chunk(self, serial, payload):
+        """ Writes the payload of the chunk with the given serial no.
+
+        Args:
+            serial (int): Serial No of the chunk
+            payload (bytes or str): Raw bytes or base64 string
+
+        Returns:
+            list: Serials of the chunks rebuilt with the help of this chunk,
+                None if the chunk is not stored (it must not be acked): the
+                download is closed, the payload is too large or the out of
+                order chunks fill PENDING_LIMIT
+        """
+        with self.file_lock:
+            if self.file.closed:
+                return None
+            if self.received is None:
+                return [] if self._append_in_order(serial, payload) else None
+            if serial in self.received or serial >= self.received.size:
+                self.stats.duplicates += 1
+                return []
+            if not self.binary:
+                payload = base64.b64decode(payload)
+            if len(payload) > self.chunk_size:
+                return None # would overwrite the next chunk
+            self._store(serial, payload)
+            self.stats.received(1, len(payload))
+            first = serial - serial % packets.FEC_GROUP
+            if first in self.parities:
+                return self._repair(first)
+            return []
+
+
+    def add_parity(self, first, parity):
+        """ Rebuilds the missing chunk of the group starting at `first` from
+        its REPAIR packet. If more than one chunk of the group is missing,
+        the parity is kept until the others arrive.
+
+        Returns:
+            list: Serials of the rebuilt chunks
+        """
+        with self.file_lock:
+            if self.file.closed or self.received is None or not self.binary or \
+                    first % packets.FEC_GROUP or first + packets.FEC_GROUP > self.received.size:
+                return []
+            self.parities[first] = parity
+            if len(self.parities) > PARITY_LIMIT:
+                self.parities.popitem(last=False)
+            return self._repair(first)
+
+
+    def _repair(self, first):
+        """ Must be called with file_lock held """
+        group = range(first, first + packets.FEC_GROUP)
+        missing = [serial for serial in group if serial not in self.received]
+        if len(missing) > 1:
+            return []
+        parity = self.parities.pop(first)
+        if not missing:
+            return []
+        payloads = [parity]
+        for serial in group:
+            if serial != missing[0]:
+                self.file.seek(serial*self.chunk_size)
+                payloads.append(self.file.read(self.chunk_size))
+        payload = packets.parity(payloads, self.chunk_size)
+        self._store(missing[0], payload)
+        self.stats.rebuilt += 1
+        self.stats.received(1, len(payload))
+        return missing
+
+
+    def _store(self, serial, payload):
+        """ Must be called with file_lock held """
+        self.file.seek(serial*self.chunk_size)
+        self.file.write(payload)
+        self.received.add(serial)
+        if self.digest_file:
+            self.digest_file.seek(serial*DIGEST.size)
+            self.digest_file.write(DIGEST.pack(zlib.crc32(payload)))
+            if time.time() - self.last_save > MANIFEST_SAVE_INTERVAL:
+                self._save_manifest()
+
+
+    def _append_in_order(self, serial, payload):
+        """ Returns False if the chunk can't be kept """
+        if serial < self.next_serial or serial in self.pending:
+            self.stats.duplicates += 1
+            return True
+        if serial != self.next_serial and self.pending_bytes + len(payload) > PENDING_LIMIT:
+            return False
+        self.pending[serial] = payload
+        self.pending_bytes += len(payload)
+        self.stats.received(1, len(payload) if self.binary else len(payload) * 3 // 4)
+        while self.next_serial in self.pending:
+            data = self.pending.pop(self.next_serial)
+            self.pending_bytes -= len(data)
+            self.next_serial += 1
+            if self.binary:
+                self.file.write(data)
+                continue
+            data = self.base64_tail + data
+            cut = len(data) // 4 * 4
+            self.file.write(base64.b64decode(data[:cut]))
+            self.base64_tail = data[cut:]
+        return True
+
+
+    def buffered_bytes(self):
+        """ Returns the bytes of received data held in memory: out of order
+        chunks and parities waiting for their groups
+        """
+        with self.file_lock:
+            pending = self.pending_bytes if self.received is None else 0
+            return pending + len(self.parities) * (self.chunk_size or 0)
+
+
+    def pending_room(self):
+        """ Returns the bytes of out of order chunks that can still be kept,
+        None if chunks are written at their offsets right away
+        """
+        if self.received is not None:
+            return None
+        with self.file_lock:
+            return PENDING_LIMIT - self.pending_bytes
+
+
+    def is_complete(self):
+        return self.received is not None and self.received.is_full()
+
+
+    def finish(self, chunk_num, check=None):
+        """ Completes the download if all chunks are written.
+
+        Args:
+            chunk_num (int): Number of chunks the uploader sent, only used
+                if the file size is unknown
+            check (function, optional): Called with the path of the
+                complete partial file before it replaces the file in the
+                download folder; the partial file is removed if it returns
+                False
+
+        Returns:
+            bool: True if the file is saved.
+        """
+        with self.file_lock:
+            if self.file.closed:
+                return False
+            if self.received is None:
+                complete = self.next_serial == chunk_num and not self.base64_tail
+            else:
+                complete = self.received.is_full()
+            if not complete:
+                return False
+            self.file.close()
+            self._remove_manifest()
+        if check is not None and not check(self.part_path):
+            os.remove(self.part_path)
+            self.stats.finish("fail")
+            return False
+        os.replace(self.part_path, self.path)
+        self.stats.finish("success")
+        return True
+
+
+    def close(self, result="stopped"):
+        """ Stops an unfinished download. The partial file and its manifest
+        are kept for a later resume if the file hash is known, otherwise
+        the partial file is removed.
+
+        Args:
+            result (str, optional): Result of the transfer in its metrics,
+                "stopped" or "fail"
+        """
+        with self.file_lock:
+            if self.file.closed:
+                return
+            if self.manifest_path:
+                self._save_manifest()
+                self.digest_file.close()
+                self.file.close()
+                self.stats.finish(result)
+                return
+        self.abort(result)
+
+
+    def abort(self, result="fail"):
+        """ Closes and removes the partially downloaded file """
+        with self.file_lock:
+            if self.file.closed:
+                return
+            self.file.close()
+            self._remove_manifest()
+        os.remove(self.part_path)
+        self.stats.finish(result)
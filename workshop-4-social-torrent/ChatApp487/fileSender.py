@@ -1,4 +1,15 @@
-import threading, time, copy, json, math, base64, sys
+import os, threading, time, copy, json, base64, sys, heapq, random, bisect, asyncio
+
+import packets
+from fileReceiver import ChunkBitmap
+from congestion import RttEstimator, CongestionController, Pacer
+from compression import CompressedChunks
+from telemetry import TransferStats
+
+RECEIVER_BUFFER = 2*1024*1024 # buffer size of the receiver until its first ack
+RECEIVER_PACKET_SIZE = 1500 # bytes the receiver reserves in its buffer per packet
+DUP_ACKS = 3 # later chunks acked after which a chunk in flight is resent
+FEC_CLEAN_CHUNKS = 1024 # acked chunks without a loss after which parity stops
 
 class PacketLossError(Exception):
     def __init__(self, serial):
@@ -6,15 +17,134 @@ class PacketLossError(Exception):
         super().__init__("Packet Loss with Serial No: {}".format(serial))
 
 
+class FileChunks(object):
+    def __init__(self, path, chunk_size, make_chunk):
+        """ Sequence of the chunks of a file that reads each chunk from the
+        disk when it is requested. Memory use doesn't depend on the file size
+        and the first chunk can be sent without reading the whole file.
+
+        Args:
+            path (str): Path of the file
+            chunk_size (int): Number of file bytes in a chunk
+            make_chunk (function): Converts (serial, bytes) to a chunk
+        """
+        self.file = open(path, "rb")
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.chunk_size = chunk_size
+        self.make_chunk = make_chunk
+        self.chunk_num = (self.size + chunk_size - 1) // chunk_size
+        self.file_lock = threading.Lock()
+
+
+    def __len__(self):
+        return self.chunk_num
+
+
+    def __getitem__(self, serial):
+        if not 0 <= serial < self.chunk_num:
+            raise IndexError(serial)
+        with self.file_lock:
+            self.file.seek(serial*self.chunk_size)
+            data = self.file.read(self.chunk_size)
+        return self.make_chunk(serial, data)
+
+
+    def close(self):
+        self.file.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ResumeChunks(object):
+    def __init__(self, chunks, received_ranges):
+        """ Chunks that the receiver is missing, skipping the given ranges
+
+        Args:
+            chunks (FileChunks): All chunks of the file
+            received_ranges (list): [start, end] serial ranges the receiver has
+        """
+        self.chunks = chunks
+        self.starts = [] # first serial of each missing range
+        self.offsets = [] # number of missing chunks before each missing range
+        missing_num = 0
+        next_serial = 0
+        for start, end in sorted(received_ranges) + [[len(chunks), len(chunks)]]:
+            start, end = min(start, len(chunks)), min(end, len(chunks))
+            if start > next_serial:
+                self.starts.append(next_serial)
+                self.offsets.append(missing_num)
+                missing_num += start - next_serial
+            next_serial = max(next_serial, end)
+        self.missing_num = missing_num
+
+
+    def __len__(self):
+        return self.missing_num
+
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.missing_num:
+            raise IndexError(index)
+        i = bisect.bisect_right(self.offsets, index) - 1
+        return self.chunks[self.starts[i] + index - self.offsets[i]]
+
+
 class FileSender(object):
-    def __init__(self, my_ip, my_name, comm_port, chat_api):
+    def __init__(self, my_ip, my_name, comm_port, chat_api, max_window=1024):
+        """ FileSender uploads a file to a peer with a selective-repeat
+        sliding window. Every in-flight chunk (sent but not acknowledged) has
+        a deadline in a single retransmission timer queue and only the expired
+        chunks are resent, so a lost packet doesn't stall the chunks behind it.
+
+        The window is the smaller of the congestion window and the buffer
+        space advertised by the receiver in its acks. The congestion window
+        follows AIMD, the retransmission timeout follows the measured RTT
+        and packets are paced over the RTT.
+
+        Args:
+            my_ip (str): IPv4 address of the user
+            my_name (str): Username of the user
+            comm_port (str): Communication port
+            chat_api (Messenger): Messenger object used to send packets
+            max_window (int, optional): Max number of unacknowledged chunks.
+        """
         self.my_ip = my_ip
         self.my_name = my_name
         self.comm_port = comm_port
 
-        self.resend_packets = [] # serial no of packets to be resent
-        self.received_acks = {} # key: serial no, value: remaining rwnd
-        self.suspend = False
+        self.rtt = RttEstimator()
+        self.congestion = CongestionController(max_window=max_window)
+        self.pacer = Pacer()
+        self.max_resend = 10 # resend attempts before giving up on a chunk
+        self.max_probes = 5 # unanswered empty packets before giving up
+
+        # key: serial no, value: [chunk, number of resends, send time, index,
+        # later chunks acked since it was sent]
+        self.in_flight = {}
+        self.timers = [] # heap of (deadline, serial no, resends), the retransmission timers
+        self.lost = [] # serials to resend before their timers expire
+        self.tail_deadline = None # resend of the oldest chunk in flight if no ack comes
+        self.acked = None # ChunkBitmap of the acknowledged chunks, by index in chunks
+        self.rwnd = RECEIVER_BUFFER # remaining buffer space of the receiver in bytes
+        self.probe_deadline = None # next empty packet while the receiver's window is closed
+        self.probes_unanswered = 0
+        self.cancelled = False
+
+        self.transfer_id = random.getrandbits(32)
+        self.target_ip = None # IP address of the receiver
+        self.binary = False # whether the receiver accepted binary packets
+        self.fec = False # whether the receiver accepted REPAIR packets
+        self.compress = False # whether the receiver accepted ZFILE packets
+        self.file_hash = None # SHA-256 hash of the file, sent with DOWNLOAD_SUCCESS
+        self.fec_first = None # first serial of the current parity group
+        self.fec_group = [] # payloads of the current parity group
+        self.stats = TransferStats("upload", self.transfer_id) # see telemetry.py
 
         self.chat_api = chat_api  # we need chat api to send packets
         
@@ -22,50 +152,179 @@ class FileSender(object):
                                  "PAYLOAD": "", "SERIAL":None}
     
         self.received_acks_lock = threading.Lock()
-        self.resend_packets_lock = threading.Lock()
-
-    
-    def _wait(self, sec):
-        """ Busy wait for given seconds """
-        t1 = time.time()
-        t2 = time.time()
-        while(t2-t1<sec):
-            t2 = time.time()
+        self.ack_event = threading.Condition(self.received_acks_lock)
+        # set by send_file_async, the coroutine waits on wakeup instead of ack_event
+        self.loop = None
+        self.loop_thread = None
+        self.wakeup = None
 
 
     def ack_confirm(self, serial, rwnd):
         with self.received_acks_lock:
-            self.received_acks[serial] = int(rwnd)
+            self.rwnd = int(rwnd)
+            self.stats.rwnd = self.rwnd
+            if serial == -1: # ack of an empty packet
+                self.probes_unanswered = 0
+                self.probe_deadline = time.time() + self.rtt.rto
+            else:
+                self._ack_chunks([serial])
+            self._notify()
 
 
-    def _check_ack(self, chunk):
-        serial_no = chunk["SERIAL"]
-        ack_success = False
-        t1 = time.time()
-        while(True): # for 1 second
-            with self.received_acks_lock:
-                if serial_no in self.received_acks:
-                    ack_success = True
-                    remaining_rwnd = self.received_acks[serial_no]
-                    if remaining_rwnd < 1024*1024:
-                        self.suspend = True
-                    return
-            if time.time() - t1 > 1:
+    def sack_confirm(self, serials, rwnd):
+        """ Handles a SACK packet, which acks several chunks at once """
+        with self.received_acks_lock:
+            self.rwnd = int(rwnd)
+            self.stats.rwnd = self.rwnd
+            self._ack_chunks(serials)
+            self._notify()
+
+
+    def _ack_chunks(self, serials):
+        """ Removes the acked chunks from the window. The RTT is sampled
+        once per ack, from the chunk sent last: the receiver held the
+        others back to ack them together. Must be called with
+        received_acks_lock held.
+        """
+        newest = None
+        acked = [] # (index, send time) of the newly acked chunks
+        chunks = size = 0
+        for serial in serials:
+            entry = self.in_flight.pop(serial, None)
+            if entry is None:
+                continue # acked before or not sent by us
+            chunk, resends, sent_time, index, _ = entry
+            if resends == 0 and (newest is None or sent_time > newest):
+                newest = sent_time
+            acked.append((index, sent_time))
+            self.congestion.on_ack()
+            self.acked.add(index)
+            chunks += 1
+            # base64 payloads of JSON chunks are 4/3 of the file bytes
+            size += len(chunk["PAYLOAD"]) if self.binary else len(chunk["PAYLOAD"]) * 3 // 4
+        if chunks:
+            self.stats.acked(chunks, size)
+            self.tail_deadline = None
+        if newest is not None:
+            rtt = time.time() - newest
+            self.rtt.sample(rtt)
+            self.stats.add_rtt(rtt, self.rtt.srtt, self.congestion.window)
+        if acked:
+            self._detect_losses(acked)
+
+
+    def _detect_losses(self, acked):
+        """ Counts the newly acked chunks that were sent after each chunk
+        still in flight before them. A chunk is taken as lost once DUP_ACKS
+        later chunks are acked and is resent by the next round without
+        waiting for its timer (fast retransmit). Must be called with
+        received_acks_lock held.
+
+        Args:
+            acked (list): (index, send time) pairs of the newly acked chunks
+        """
+        acked.sort()
+        last_index = acked[-1][0]
+        # early retransmit: a small window can't bring DUP_ACKS later acks
+        threshold = max(1, min(DUP_ACKS, len(self.in_flight) + len(acked) - 1))
+        # in_flight is in the order the chunks were admitted
+        for serial, entry in self.in_flight.items():
+            if entry[3] > last_index:
                 break
+            if entry[4] >= threshold:
+                continue # already found lost
+            # chunks acked after this one in the window, sent after its last send
+            later = bisect.bisect(acked, (entry[3],))
+            entry[4] += sum(1 for _, sent_time in acked[later:] if sent_time > entry[2])
+            if entry[4] >= threshold:
+                self.lost.append(serial)
+
+
+    def _notify(self):
+        """ Wakes the send loop up. Must be called with received_acks_lock held. """
+        self.ack_event.notify()
+        if self.wakeup is None:
+            return
+        if threading.get_ident() == self.loop_thread:
+            self.wakeup.set()
+        else:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
 
-        if not ack_success:
-            with self.resend_packets_lock:
-                self.resend_packets.append(chunk)
+
+    def set_features(self, features):
+        """ Applies the features the receiver accepted in its YES message """
+        self.binary = "BINARY" in features
+        self.fec = self.binary and "FEC" in features
+        self.compress = self.binary and "ZLIB" in features
 
 
     def _send_packet(self, packet, target_ip):
         """ Sends given packet to target ip 
         Args:
-            packet (str): JSON-like string to be sent (packet is in file type)
+            packet (str or bytes): JSON-like string or binary datagram to be
+                sent (packet is in file type)
         """
         self.chat_api._send_message("UDP", target_ip, packet)
 
 
+    def _send_packets(self, datagrams, target_ip):
+        """ Sends the packets of a round together. JSON packets go one by
+        one through _send_packet.
+        """
+        if not datagrams:
+            return
+        if self.binary:
+            self.chat_api._send_datagrams(datagrams, target_ip)
+        else:
+            for packet in datagrams:
+                self._send_packet(packet, target_ip)
+
+
+    def _chunk_packet(self, chunk):
+        """ Converts a chunk to the wire format agreed with the receiver """
+        if "ZPAYLOAD" in chunk:
+            packet = packets.encode(packets.ZFILE, self.transfer_id, chunk["SERIAL"],
+                                    chunk["ZPAYLOAD"])
+        elif self.binary:
+            packet = packets.encode(packets.FILE, self.transfer_id, chunk["SERIAL"],
+                                    chunk["PAYLOAD"])
+        else:
+            packet = json.dumps(chunk)
+        self.stats.bytes_sent += len(packet)
+        return packet
+
+
+    def _repair_packets(self, new_chunks):
+        """ Adds the new chunks to their parity groups and returns the REPAIR
+        packets of the completed groups. Parity is sent from the start, so
+        a short transfer doesn't lose a whole RTO to its first loss, and
+        stops after FEC_CLEAN_CHUNKS chunks are acked without any loss, so
+        clean links don't pay for it for long. A group must be full and
+        made of consecutive serials, which excludes the last chunks of the
+        file and the gaps of a resumed download.
+        """
+        repairs = []
+        if not self.fec or \
+                (not self.stats.retransmits and self.stats.chunks_acked >= FEC_CLEAN_CHUNKS):
+            return repairs
+        for chunk in new_chunks:
+            serial, payload = chunk["SERIAL"], chunk["PAYLOAD"]
+            if serial % packets.FEC_GROUP == 0:
+                self.fec_first, self.fec_group = serial, []
+            if self.fec_first is None or serial != self.fec_first + len(self.fec_group) \
+                    or len(payload) != packets.PAYLOAD_SIZE:
+                self.fec_first = None # broken group, wait for the next one
+                continue
+            self.fec_group.append(payload)
+            if len(self.fec_group) == packets.FEC_GROUP:
+                repairs.append(packets.encode(packets.REPAIR, self.transfer_id,
+                                              self.fec_first,
+                                              packets.parity(self.fec_group)))
+                self.fec_first = None
+        self.stats.repairs += len(repairs)
+        return repairs
+
+
     def _generate_message(self, serial, payload=None):
         """ Generates a message packet in json format according to given 
         message type and the payload.
@@ -75,8 +334,12 @@ class FileSender(object):
             payload (str, optional): Message content.
 
         Returns:
-            dict: Ready-to-send JSON-like packet in str format.
+            str or bytes: Ready-to-send JSON-like packet in str format, or a
+                binary datagram if the receiver accepted binary packets.
         """
+        if self.binary:
+            return packets.encode(packets.FILE, self.transfer_id, serial,
+                                  payload or b"")
         message = copy.deepcopy(self.message_template)
         message["SERIAL"] = serial
         if payload:
@@ -88,133 +351,335 @@ class FileSender(object):
             if success:
                 finish_mes = self.chat_api._generate_message("DOWNLOAD_SUCCESS", \
                                                         payload=chunk_num)
+                if self.file_hash:
+                    finish_mes["HASH"] = self.file_hash
             else:
                 finish_mes = self.chat_api._generate_message("DOWNLOAD_FAIL")
+            finish_mes["TID"] = self.transfer_id
             self.chat_api._send_message("TCP", target_ip, json.dumps(finish_mes))
+            self.stats.finish("success" if success else "fail")
 
     def file_to_chunks(self, path):
-        packet_wo_payload = self._generate_message(2147483647) # max serial no
-        packet_size_wo_payload = len(packet_wo_payload.encode("UTF-8"))
-        payload_space = 1500 - packet_size_wo_payload # in bytes
-        
-        with open(path, "rb") as file:
-            base64_encoded = base64.b64encode(file.read())
-        filesize = len(base64_encoded)
-        chunk_num = math.ceil(float(filesize)/payload_space)
-        base64_encoded_str = base64_encoded.decode("utf-8")
-        
-        chunks = []
-        
-        for i in range(chunk_num):
-            chunk_start = i*payload_space
-            chunk_end = min((i+1)*payload_space, len(base64_encoded_str))
-            chunk = {"NAME":self.my_name, "MY_IP": self.my_ip, "TYPE": "FILE",
-                     "PAYLOAD": base64_encoded_str[chunk_start:chunk_end], "SERIAL":i}
-            chunks.append(chunk)
-        return chunks
-
+        """ Opens the file as a lazy sequence of chunks. Payloads are raw
+        bytes if the receiver accepted binary packets and base64 strings
+        otherwise. Chunks are read from the disk only when they are sent.
 
-    def send_file(self, chunks, target_ip):
-        """ Starts sending process of a file given in list of chunks
-        Args: 
-            chunks (list): List of chunks that constitute the file to be sent 
-                Each chunk is a dict and must contain following fields.
-                NAME, MY_IP, TYPE(=FILE), PAYLOAD, SERIAL
+        Returns:
+            FileChunks: Sequence of chunks, must be closed after sending.
         """
-        total = len(chunks)
-        received_acks_num = 0
-        while(received_acks_num != total):
-            #print(len(chunks))
-            received_acks_num = len(self.received_acks) if -1 not in self.received_acks else \
-                                                            len(self.received_acks) -1
-            if self.suspend:
-                print("Uploading suspended for 1 minute, because of the low buffer space of the receiver")
-                self._wait(60)
-                for _ in range(3):
-                    empty_packet = self._generate_message(-1)
-                    self._send_packet(empty_packet, target_ip)
-                
-                    empty_packet_sent_success = False
-                    t1 = time.time()
-                    while(True): # for 1 second
-                        with self.received_acks_lock:
-                            if -1 in self.received_acks: # check if empty ack received
-                                empty_packet_sent_success = True
-                                remaining_rwnd = self.received_acks[-1]
-                                del self.received_acks[-1]
-                                if remaining_rwnd > 1024*1024:
-                                    self.suspend = False
-                                break
-                        if time.time() - t1 > 1:
-                            break
-                    if empty_packet_sent_success:
-                        break
-
-                if not empty_packet_sent_success:
-                    self._dowload_finish(target_ip, 0, total)
-                    raise PacketLossError("-1 (empty packet)")
-                    
-                time.sleep(2) # just to make sure that we got all empty acks
-                if -1 in self.received_acks:
-                    del self.received_acks[-1]
-                continue
+        if self.binary:
+            return FileChunks(path, packets.PAYLOAD_SIZE,
+                              lambda serial, data: {"SERIAL": serial, "PAYLOAD": data})
+
+        return FileChunks(path, self.json_chunk_size(path), self._base64_chunk)
+
+
+    def json_chunk_size(self, path):
+        """ Returns the number of file bytes in a JSON packet for the file """
+        # a serial no can't have more digits than the file size
+        max_serial = int("9"*len(str(os.path.getsize(path))))
+        packet_wo_payload = json.dumps(dict(self.message_template, SERIAL=max_serial))
+        packet_size_wo_payload = len(packet_wo_payload.encode("UTF-8")) + 1 # newline
+        payload_space = 1500 - packet_size_wo_payload # in bytes
+        # base64 of each chunk has no padding except the last one, so the
+        # receiver can still concatenate the payloads before decoding
+        return payload_space // 4 * 3
 
-            if chunks:
-                chunk = chunks.pop(0)
-                self._send_packet(json.dumps(chunk), target_ip)
-                ## start checking ack (non-blocking)
-                checking_ack_thread = threading.Thread(target=self._check_ack, \
-                                                        args=(chunk,))
-                checking_ack_thread.start()
-            
-            ## resend packets that might lost
-            with self.resend_packets_lock:
-                while(self.resend_packets):
-                    chunk = self.resend_packets.pop(0)
-                    # resend
-                    for _ in range(3):
-                        self._send_packet(json.dumps(chunk), target_ip)
-                        # wait for ack for 1 sec (blocking)
-                        resend_success = False
-                        t1 = time.time()
-                        while(True):
-                            with self.received_acks_lock:
-                                if chunk["SERIAL"] in self.received_acks:
-                                    resend_success = True
-                                    remaining_rwnd = self.received_acks[chunk["SERIAL"]]
-                                    if remaining_rwnd < 1024*1024:
-                                        self.suspend = True
-                                    break
-                            if time.time() - t1 > 1:
-                                break
-                        if resend_success:
-                            break
-                    if not resend_success:
-                        #print(chunk)
-                        #time.sleep(100)
-                        self._dowload_finish(target_ip, 0, total)
-                        raise PacketLossError(chunk["SERIAL"])
-
-        print()
-        self._dowload_finish(target_ip, 1, total)
 
+    def _base64_chunk(self, serial, data):
+        return {"NAME":self.my_name, "MY_IP": self.my_ip, "TYPE": "FILE",
+                "PAYLOAD": base64.b64encode(data).decode("utf-8"), "SERIAL":serial}
 
 
-            
+    def _window(self):
+        """ Returns the number of chunks that may be in flight """
+        return min(self.congestion.window, max(self.rwnd, 0) // RECEIVER_PACKET_SIZE)
 
 
+    def _send_rate(self):
+        """ Returns the pacing rate in packets per second, None before the
+        first RTT sample. The window is sent in one RTT, a bit faster in slow
+        start so that the pacing doesn't limit the window growth.
+        """
+        if not self.rtt.srtt:
+            return None
+        gain = 2 if self.congestion.in_slow_start() else 1.25
+        return gain * self.congestion.window / self.rtt.srtt
 
-                
 
+    def _fill_window(self, chunks, next_idx, now):
+        """ Moves chunks into the window as long as there is free space and
+        the pacer allows. Must be called with received_acks_lock held.
 
+        Returns:
+            list: Newly admitted chunks that must be sent.
+            int: Index of the next chunk to be admitted.
+        """
+        to_send = []
+        self.pacer.refill(now, self._send_rate())
+        window = self._window()
+        while next_idx < len(chunks) and len(self.in_flight) < window:
+            if not self.pacer.take():
+                break
+            chunk = chunks[next_idx]
+            self.in_flight[chunk["SERIAL"]] = [chunk, 0, now, next_idx, 0]
+            next_idx += 1
+            heapq.heappush(self.timers, (now + self.rtt.rto, chunk["SERIAL"], 0))
+            to_send.append(chunk)
+        return to_send, next_idx
+
+
+    def _expired_chunks(self, now):
+        """ Pops the expired retransmission timers and re-arms them with
+        exponential backoff, up to the max RTO. Only the timer of the lost
+        chunk backs off: backing off the RTO of the whole transfer as well
+        stalled it under heavy loss, since the chunks that could bring a new
+        RTT sample don't fit in the window. Must be called with
+        received_acks_lock held.
 
+        Returns:
+            list: Chunks whose acks timed out and must be resent.
+            int or None: Serial No of a chunk that ran out of resends.
+        """
+        to_send = []
+        while self.timers and self.timers[0][0] <= now:
+            _, serial, resends = heapq.heappop(self.timers)
+            entry = self.in_flight.get(serial)
+            if entry is None or entry[1] != resends:
+                continue # acked or resent in the meantime
+            if entry[1] == self.max_resend:
+                return to_send, serial
+            self.congestion.on_loss(now, self.rtt.srtt)
+            self._resend(entry, serial, now, min(self.rtt.rto * 2**(entry[1] + 1),
+                                                 self.rtt.max_rto))
+            to_send.append(entry[0])
+        return to_send, None
+
+
+    def _lost_chunks(self, now):
+        """ Re-arms the timers of the chunks found lost by _detect_losses.
+        Must be called with received_acks_lock held.
 
+        Returns:
+            list: Chunks that must be resent.
+        """
+        to_send = []
+        for serial in self.lost:
+            entry = self.in_flight.get(serial)
+            if entry is None or entry[1] == self.max_resend:
+                continue # acked in the meantime, or left to its timer
+            self.congestion.on_loss(now, self.rtt.srtt)
+            self._resend(entry, serial, now, self.rtt.rto)
+            to_send.append(entry[0])
+        self.lost = []
+        return to_send
+
+
+    def _tail_probe(self, now):
+        """ Resends the oldest chunk in flight when no ack arrived for two
+        round trips. A lost SACK would otherwise leave the chunks it acked
+        to their timers once the window is full; the SACK of the resent
+        chunk acks the chunks stored after it as well. Must be called with
+        received_acks_lock held.
 
+        Returns:
+            list: The chunk to resend, if any.
+        """
+        if not self.in_flight or self.rtt.srtt is None:
+            self.tail_deadline = None
+            return []
+        if self.tail_deadline is None:
+            self.tail_deadline = now + 2*self.rtt.srtt
+        if now < self.tail_deadline:
+            return []
+        # the next probe waits for an ack or the RTO
+        self.tail_deadline = now + self.rtt.rto
+        serial, entry = next(iter(self.in_flight.items()))
+        if entry[1] == self.max_resend or entry[2] == now:
+            return [] # left to its timer, or resent by this round
+        self._resend(entry, serial, now, self.rtt.rto)
+        return [entry[0]]
+
+
+    def _resend(self, entry, serial, now, timeout):
+        """ Must be called with received_acks_lock held """
+        entry[1] += 1
+        entry[2] = now
+        entry[4] = 0
+        heapq.heappush(self.timers, (now + timeout, serial, entry[1]))
+
+
+    def _probe_due(self, now):
+        """ Checks if an empty packet must be sent to learn whether the
+        receiver's window opened again. Empty packets are sent only while
+        nothing is in flight, with exponential backoff up to a minute.
+        Must be called with received_acks_lock held.
 
+        Returns:
+            bool: True if an empty packet must be sent.
+        """
+        if self.in_flight or self._window() > 0:
+            self.probe_deadline = None
+            return False
+        if self.probe_deadline is None:
+            # the window just closed, the upload waits for the receiver
+            self.stats.suspends += 1
+            self.probe_deadline = now + self.rtt.rto
+        if now < self.probe_deadline:
+            return False
+        self.probes_unanswered += 1
+        self.probe_deadline = now + min(self.rtt.rto * 2**self.probes_unanswered, 60)
+        return True
+
+
+    def _next_event(self, next_idx, total):
+        """ Returns the time of the next timer, tail probe, pacing token or
+        empty packet.
+        Must be called with received_acks_lock held.
+        """
+        events = []
+        if self.timers:
+            events.append(self.timers[0][0])
+        if self.probe_deadline is not None:
+            events.append(self.probe_deadline)
+        if self.tail_deadline is not None:
+            events.append(self.tail_deadline)
+        if next_idx < total and len(self.in_flight) < self._window():
+            events.append(time.time() + self.pacer.delay(self._send_rate()))
+        return min(events) if events else time.time() + self.rtt.rto
+
+
+    def cancel(self):
+        """ Stops send_file without notifying the receiver """
+        with self.received_acks_lock:
+            self.cancelled = True
+            self._notify()
 
 
+    def send_file(self, chunks, target_ip):
+        """ Starts sending process of a file given in list of chunks
+        Args: 
+            chunks (FileChunks or list): Chunks that constitute the file to
+                be sent, indexed by serial no. Each chunk is a dict and must contain following fields.
+                NAME, MY_IP, TYPE(=FILE), PAYLOAD, SERIAL
+                (only PAYLOAD and SERIAL in binary mode)
+        """
+        if not self.compress:
+            self._send_chunks(chunks, target_ip)
+            return
+        chunks = CompressedChunks(chunks)
+        try:
+            self._send_chunks(chunks, target_ip)
+        finally:
+            chunks.close()
+
+
+    async def send_file_async(self, chunks, target_ip):
+        """ Coroutine version of send_file for the asyncio engine. Acks
+        must be passed to ack_confirm from the thread of the event loop or
+        any other thread.
+        """
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.wakeup = asyncio.Event()
+        if not self.compress:
+            await self._send_chunks_async(chunks, target_ip)
+            return
+        chunks = CompressedChunks(chunks)
+        try:
+            await self._send_chunks_async(chunks, target_ip)
+        finally:
+            chunks.close()
+
+
+    def _send_chunks(self, chunks, target_ip):
+        total, next_idx = self._start_sending(chunks, target_ip)
+        while True:
+            next_idx, done = self._send_round(chunks, next_idx, target_ip)
+            if done is not None:
+                break
+            ## sleep until an ack arrives or the next timer expires
+            with self.received_acks_lock:
+                timeout = self._wait_time(next_idx, total)
+                if timeout > 0:
+                    self.ack_event.wait(timeout)
+        if done:
+            self._finish_sending(target_ip, total)
+
+
+    async def _send_chunks_async(self, chunks, target_ip):
+        total, next_idx = self._start_sending(chunks, target_ip)
+        while True:
+            next_idx, done = self._send_round(chunks, next_idx, target_ip)
+            if done is not None:
+                break
+            with self.received_acks_lock:
+                timeout = self._wait_time(next_idx, total)
+                self.wakeup.clear()
+            if timeout > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        if done:
+            self._finish_sending(target_ip, total)
+
+
+    def _start_sending(self, chunks, target_ip):
+        self.target_ip = target_ip
+        self.stats.start(self.transfer_id, target_ip)
+        with self.received_acks_lock:
+            self.acked = ChunkBitmap(len(chunks))
+        return len(chunks), 0
 
 
+    def _send_round(self, chunks, next_idx, target_ip):
+        """ Sends the expired, newly admitted and repair packets and the
+        empty packet if one is due.
 
+        Returns:
+            int: Index of the next chunk to be admitted.
+            bool or None: True when all chunks are acked, False when the
+                upload is cancelled, None otherwise.
+        """
+        total = len(chunks)
+        with self.received_acks_lock:
+            if self.cancelled:
+                self.stats.finish("cancelled")
+                return next_idx, False
+            if self.acked.is_full():
+                return next_idx, True
+            now = time.time()
+            resend, lost_serial = self._expired_chunks(now)
+            resend += self._lost_chunks(now)
+            resend += self._tail_probe(now)
+            new_chunks, next_idx = self._fill_window(chunks, next_idx, now)
+            send_probe = self._probe_due(now)
+            self.stats.chunks_sent += len(resend) + len(new_chunks)
+            self.stats.retransmits += len(resend)
+            if self.probes_unanswered > self.max_probes:
+                lost_serial = "-1 (empty packet)"
+
+        if lost_serial is not None:
+            self._dowload_finish(target_ip, 0, total)
+            raise PacketLossError(lost_serial)
+
+        datagrams = [self._chunk_packet(chunk) for chunk in resend + new_chunks]
+        datagrams += self._repair_packets(new_chunks)
+        if send_probe:
+            datagrams.append(self._generate_message(-1))
+        self._send_packets(datagrams, target_ip)
+        return next_idx, None
+
+
+    def _wait_time(self, next_idx, total):
+        """ Returns the seconds until the next event, 0 if the loop must not
+        wait. Must be called with received_acks_lock held.
+        """
+        if self.acked.is_full() or self.cancelled or self.lost:
+            return 0
+        return self._next_event(next_idx, total) - time.time()
 
 
+    def _finish_sending(self, target_ip, total):
+        self._dowload_finish(target_ip, 1, total)
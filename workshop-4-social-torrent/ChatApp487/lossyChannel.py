@@ -0,0 +1,130 @@
+""" Emulation of a lossy network for testing.
+
+A LossyChannel sits under the unicast UDP sends of a Messenger and drops,
+duplicates, delays and reorders datagrams, and limits the bandwidth like a
+bottleneck link with a drop-tail queue. All random decisions come from one
+seeded generator and every datagram consumes the same amount of random
+numbers, so the same seed gives the same decisions for the same sequence of
+datagrams. No root permission or netem is needed.
+
+    channel = LossyChannel(loss=0.05, delay=0.02, seed=1)
+    messenger = Messenger(my_ip, my_name, port, channel=channel)
+"""
+import threading, heapq, random, time
+
+
+class LossyChannel(object):
+    def __init__(self, loss=0.0, reorder=0.0, duplicate=0.0, delay=0.0, jitter=0.0,
+                 rate=None, queue_size=64*1024, reorder_delay=0.01, seed=None):
+        """
+        Args:
+            loss (float, optional): Probability that a datagram is dropped
+            reorder (float, optional): Probability that a datagram is held
+                back for `reorder_delay` seconds, so later ones overtake it
+            duplicate (float, optional): Probability that a datagram is
+                delivered twice
+            delay (float, optional): One way delay in seconds
+            jitter (float, optional): Max random extra delay in seconds
+            rate (float, optional): Bandwidth in bytes per second, None for
+                unlimited
+            queue_size (int, optional): Bytes waiting for the bandwidth
+                limit, datagrams that don't fit are dropped
+            reorder_delay (float, optional): Extra delay of reordered datagrams
+            seed (int, optional): Seed of the random decisions
+        """
+        self.loss = loss
+        self.reorder = reorder
+        self.duplicate = duplicate
+        self.delay = delay
+        self.jitter = jitter
+        self.rate = rate
+        self.queue_size = queue_size
+        self.reorder_delay = reorder_delay
+        self.random = random.Random(seed)
+
+        self.queue = [] # heap of (delivery time, sequence no, data, address, transmit)
+        self.sequence = 0 # keeps the order of datagrams with the same delivery time
+        self.link_free = 0.0 # time the bottleneck finishes sending the queued bytes
+        self.stats = {"sent": 0, "dropped": 0, "duplicated": 0, "reordered": 0}
+        self.closed = False
+        self.lock = threading.Lock()
+        self.queue_event = threading.Condition(self.lock)
+
+        self.thread = threading.Thread(target=self._deliver, args=(), daemon=True)
+        self.thread.start()
+
+
+    def send(self, data, address, transmit):
+        """ Passes a datagram through the channel.
+
+        Args:
+            data (bytes): Datagram
+            address (str): Destination IP address
+            transmit (function): Sends the datagram for real, called as
+                transmit(data, address) when it is delivered
+        """
+        deliver_now = 0 # copies that don't have to wait
+        with self.lock:
+            now = time.time()
+            # the same numbers are drawn for every datagram
+            draws = [self.random.random() for _ in range(6)]
+            self.stats["sent"] += 1
+            if draws[0] < self.loss:
+                self.stats["dropped"] += 1
+                return
+
+            departure = now
+            if self.rate:
+                start = max(now, self.link_free)
+                if (start - now) * self.rate > self.queue_size:
+                    self.stats["dropped"] += 1
+                    return
+                self.link_free = start + len(data) / self.rate
+                departure = self.link_free
+
+            copies = 1
+            if draws[1] < self.duplicate:
+                copies = 2
+                self.stats["duplicated"] += 1
+            for i in range(copies):
+                due = departure + self.delay + draws[2 + 2*i] * self.jitter
+                if draws[3 + 2*i] < self.reorder:
+                    due += self.reorder_delay
+                    self.stats["reordered"] += 1
+                if due <= now and not self.queue:
+                    deliver_now += 1
+                    continue
+                heapq.heappush(self.queue, (due, self.sequence, data, address, transmit))
+                self.sequence += 1
+            self.queue_event.notify()
+
+        for _ in range(deliver_now):
+            transmit(data, address)
+
+
+    def close(self):
+        """ Stops the channel, the queued datagrams are dropped """
+        with self.lock:
+            self.closed = True
+            self.queue = []
+            self.queue_event.notify()
+
+
+    def _deliver(self):
+        while True:
+            with self.lock:
+                while not self.closed:
+                    if not self.queue:
+                        self.queue_event.wait()
+                        continue
+                    timeout = self.queue[0][0] - time.time()
+                    if timeout <= 0:
+                        break
+                    self.queue_event.wait(timeout)
+                if self.closed:
+                    return
+                _, _, data, address, transmit = heapq.heappop(self.queue)
+            try:
+                transmit(data, address)
+            except OSError:
+                pass # the datagram is lost
@@ -1,31 +1,37 @@
-import os, socket
+import os, argparse
 
 from chatAPI import Messenger, get_my_ip
-from inputimeout import inputimeout, TimeoutOccurred
 
 COMM_PORT = 12345
 
-def display_lobby(messenger, local_ip, name):
-    os.system('cls' if os.name == 'nt' else 'clear')
-    print("ChatApp487\n")
-    print("My IP:", local_ip)
-    print("My Name:", name, '\n')
-    print("CHAT ROOMS (refreshed every 3 seconds)")
+def lobby_lines(messenger, local_ip, name):
+    lines = ["ChatApp487", "", "My IP: " + local_ip, "My Name: " + name, "",
+             "CHAT ROOMS"]
     # List all users in the LAN
     with messenger.ip2name_lock:
         for i, ip_addr in enumerate(messenger.ip2name):
-            print("{}- {} at {}".format(i+1, messenger.ip2name[ip_addr],\
-                                        ip_addr))
-    print()
+            lines.append("{}- {} at {}".format(i+1, messenger.ip2name[ip_addr],\
+                                               ip_addr))
+    return lines
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ChatApp487")
+    parser.add_argument("--asyncio", action="store_true",
+                        help="serve the sockets and uploads from one asyncio event loop")
+    parser.add_argument("--metrics", metavar="PATH",
+                        help="append the metrics of the transfers to a JSON lines file")
+    parser.add_argument("--ip", metavar="INTERFACE",
+                        help="name or address of the network interface to use, e.g. ham0")
+    args = parser.parse_args()
+    try:
+        local_ip = get_my_ip(args.ip)
+    except ValueError as e:
+        parser.error(str(e))
+
     # We need try-except to kill the listener if something goes wrong.
     try:    
-        # Create DB file
+        # Create DB directory
         os.makedirs(".db", exist_ok=True)
-        with open(".db/.chat_db", "w+") as _:
-            pass
-        local_ip = get_my_ip()
 
         # Start UI
         os.system('cls' if os.name == 'nt' else 'clear')
@@ -33,22 +39,28 @@ if __name__ == "__main__":
         name = input("Your Name?\n")
 
         # Create the messenger api object
-        messenger = Messenger(local_ip, name, COMM_PORT)
+        messenger = Messenger(local_ip, name, COMM_PORT, use_asyncio=args.asyncio,
+                              metrics_path=args.metrics)
         messenger.init()
 
+        terminal = messenger.terminal
+        terminal.start_view(lobby_lines(messenger, local_ip, name))
+
+        def refresh():
+            """ Updates the user list, stops the prompt for a download request """
+            terminal.set_lines(lobby_lines(messenger, local_ip, name))
+            return bool(messenger.download_requests)
+
         while True:
-            display_lobby(messenger, local_ip, name)
-            if messenger.download_request:
-                mes = messenger.download_request
-                messenger.download_request = False
-                messenger.download_request_display(mes)
-                continue
-            # Waits for an input in every iteration. If no input is given in 3
-            # seconds, it runs the next iteration and updates the user list.
-            try:
-                key = inputimeout(prompt="Enter the number of the chat room "
-                        "you want to enter\nEnter (q) to exit\n", timeout=3)
-            except TimeoutOccurred:
+            # Waits until a line is entered, the user list is updated
+            # whenever it changes
+            key = terminal.prompt("Enter the number of the chat room you want to "
+                                  "enter, (q) to exit", refresh)
+            if key is None:
+                mes = messenger.next_download_request()
+                if mes:
+                    messenger.download_request_display(mes)
+                    terminal.start_view(lobby_lines(messenger, local_ip, name))
                 continue
            
             if key == 'q':  
@@ -65,8 +77,10 @@ if __name__ == "__main__":
                     continue
 
                 messenger.enter_chat_room(peer_ip, peer_name)
+                terminal.start_view(lobby_lines(messenger, local_ip, name))
 
     except Exception as e:
         # Kill the listener before exiting
+        messenger.terminal.close()
         messenger.kill()
         print(e)
@@ -0,0 +1,145 @@
+""" Binary datagram format for file transfers.
+
+Every FILE and ACK datagram starts with a fixed header followed by raw
+payload bytes:
+
+    magic (2s) | kind (B) | transfer id (I) | serial (Q) | length (H)
+
+The magic bytes can never start a JSON packet, so binary and JSON packets
+can share the same UDP port. Peers agree on the binary format by listing
+"BINARY" in the FEATURES field of the ALLOW and YES messages; older peers
+ignore the field and keep using JSON packets.
+
+With the "FEC" feature the uploader also sends a REPAIR packet after every
+group of FEC_GROUP consecutive chunks, starting at a serial that is a
+multiple of FEC_GROUP. Its serial is the first serial of the group and its
+payload is the XOR of the chunk payloads, so the receiver can rebuild any
+single lost chunk of the group without waiting for a retransmission.
+
+With the "ZLIB" feature, chunks that get smaller with raw deflate are sent
+as ZFILE packets (see compression.py).
+
+With the "SACK" feature the receiver acks several chunks with one SACK
+packet instead of an ACK per chunk. Its serial is the first serial of a
+bitmap that follows the rwnd in the payload; bit i (least significant bit
+of the first byte first) is set if serial + i has been received. The bitmap
+covers every chunk between the first and the last one of the batch, so
+chunks received earlier are acked once more in case their SACK was lost.
+"""
+import struct
+
+MAGIC = b"\x87T"
+HEADER = struct.Struct("!2sBIQH")
+ACK_PAYLOAD = struct.Struct("!q") # remaining rwnd of the receiver
+
+# packet kinds
+FILE = 1
+ACK = 2
+REPAIR = 3 # parity of a group of FILE packets
+ZFILE = 4 # FILE packet with a deflated payload
+SACK = 5 # ACK of a bitmap of chunks
+
+# largest datagram that fits into one Ethernet frame without IP fragmentation
+DATAGRAM_SIZE = 1500 - 20 - 8
+PAYLOAD_SIZE = DATAGRAM_SIZE - HEADER.size
+
+PROBE_SERIAL = 2**64 - 1 # serial -1 (empty packet) on the wire
+
+FEC_GROUP = 8 # chunks protected by one REPAIR packet
+
+SACK_BITS = 1024 # max serials covered by one SACK packet
+
+# features this version understands, exchanged in ALLOW/YES
+FEATURES = ["BINARY", "SWARM", "FEC", "ZLIB", "SACK", "DELTA"]
+
+
+def is_binary(data):
+    """ Returns True if the given datagram is in binary format """
+    return data[:2] == MAGIC
+
+
+def encode(kind, transfer_id, serial, payload=b""):
+    """ Packs a datagram.
+
+    Args:
+        kind (int): FILE, ACK, REPAIR or ZFILE
+        transfer_id (int): Transfer ID agreed in the ALLOW message
+        serial (int): Serial No of the chunk, -1 for the empty packet
+        payload (bytes, optional): Raw payload
+
+    Returns:
+        bytes: Ready-to-send datagram
+    """
+    if serial == -1:
+        serial = PROBE_SERIAL
+    return HEADER.pack(MAGIC, kind, transfer_id, serial, len(payload)) + payload
+
+
+def encode_ack(transfer_id, serial, rwnd):
+    return encode(ACK, transfer_id, serial, ACK_PAYLOAD.pack(rwnd))
+
+
+def decode(data):
+    """ Unpacks a datagram. Returns False if it is not a valid binary packet.
+
+    Returns:
+        tuple: (kind, transfer id, serial, payload)
+    """
+    if len(data) < HEADER.size or not is_binary(data):
+        return False
+    _, kind, transfer_id, serial, length = HEADER.unpack_from(data)
+    payload = data[HEADER.size:HEADER.size+length]
+    if len(payload) != length:
+        return False
+    if serial == PROBE_SERIAL:
+        serial = -1
+    return kind, transfer_id, serial, payload
+
+
+def decode_ack(payload):
+    return ACK_PAYLOAD.unpack(payload)[0]
+
+
+def encode_sacks(transfer_id, serials, rwnd, received):
+    """ Packs the acks of the given serials into as few SACK packets as
+    possible.
+
+    Args:
+        transfer_id (int): Transfer ID agreed in the ALLOW message
+        serials (list): Serials of the chunks to ack
+        rwnd (int): Remaining buffer space of the receiver
+        received (ChunkBitmap): Received chunks of the download
+
+    Returns:
+        list: Ready-to-send datagrams
+    """
+    datagrams = []
+    serials = sorted(serials)
+    i = 0
+    while i < len(serials):
+        first = serials[i]
+        while i < len(serials) and serials[i] - first < SACK_BITS:
+            i += 1
+        bitmap = received.window(first, serials[i - 1] + 1 - first)
+        datagrams.append(encode(SACK, transfer_id, first, ACK_PAYLOAD.pack(rwnd) + bitmap))
+    return datagrams
+
+
+def decode_sack(serial, payload):
+    """ Returns the acked serials and the rwnd of a SACK packet """
+    rwnd, = ACK_PAYLOAD.unpack_from(payload)
+    bits = int.from_bytes(payload[ACK_PAYLOAD.size:], "little")
+    serials = []
+    while bits:
+        low = bits & -bits
+        serials.append(serial + low.bit_length() - 1)
+        bits ^= low
+    return serials, rwnd
+
+
+def parity(payloads, size=PAYLOAD_SIZE):
+    """ Returns the XOR of the payloads, each padded with zeros to `size` bytes """
+    result = 0
+    for payload in payloads:
+        result ^= int.from_bytes(payload, "little")
+    return result.to_bytes(size, "little")
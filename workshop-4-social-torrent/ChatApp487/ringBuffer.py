@@ -0,0 +1,46 @@
+""" Fixed-capacity FIFO queue of the received chunks, the caller holds the lock """
+
+
+class RingBuffer(object):
+    def __init__(self, capacity):
+        """
+        Args:
+            capacity (int): Max number of items
+        """
+        self.slots = [None] * capacity
+        self.capacity = capacity
+        self.head = 0 # index of the oldest item
+        self.count = 0
+
+
+    def __len__(self):
+        return self.count
+
+
+    def free(self):
+        """ Returns the number of items that can still be pushed """
+        return self.capacity - self.count
+
+
+    def push(self, item):
+        """ Adds an item at the end. Returns False if the buffer is full. """
+        if self.count == self.capacity:
+            return False
+        self.slots[(self.head + self.count) % self.capacity] = item
+        self.count += 1
+        return True
+
+
+    def pop(self):
+        """ Removes and returns the oldest item
+
+        Raises:
+            IndexError: If the buffer is empty
+        """
+        if not self.count:
+            raise IndexError("pop from an empty RingBuffer")
+        item = self.slots[self.head]
+        self.slots[self.head] = None # don't keep the chunk alive
+        self.head = (self.head + 1) % self.capacity
+        self.count -= 1
+        return item
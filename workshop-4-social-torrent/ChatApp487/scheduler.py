@@ -0,0 +1,72 @@
+""" Background execution of uploads.
+
+Uploads run as jobs on a fixed pool of worker threads so that a node can
+upload to several peers at once while the UI keeps running. Jobs that don't
+fit in the pool wait in the order they were submitted.
+"""
+import threading, traceback
+from collections import deque
+
+
+class TransferScheduler(object):
+    def __init__(self, workers=4):
+        """ TransferScheduler runs at most `workers` jobs at the same time.
+
+        Args:
+            workers (int, optional): Number of worker threads
+        """
+        self.jobs = deque() # (function, args) waiting for a worker
+        self.active = 0 # number of running jobs
+        self.stopped = False
+        self.lock = threading.Lock()
+        self.job_event = threading.Condition(self.lock)
+
+        self.workers = []
+        for _ in range(workers):
+            # a running upload must not keep the application alive on exit,
+            # the receiver keeps the partial file to resume later
+            worker = threading.Thread(target=self._worker, args=(), daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+
+    def submit(self, function, *args):
+        """ Queues function(*args) to be run on a worker thread """
+        with self.lock:
+            if self.stopped:
+                return False
+            self.jobs.append((function, args))
+            self.job_event.notify()
+        return True
+
+
+    def pending(self):
+        """ Returns the number of running and waiting jobs """
+        with self.lock:
+            return self.active + len(self.jobs)
+
+
+    def stop(self):
+        """ Drops the waiting jobs, the running ones are not interrupted """
+        with self.lock:
+            self.stopped = True
+            self.jobs.clear()
+            self.job_event.notify_all()
+
+
+    def _worker(self):
+        while True:
+            with self.lock:
+                self.job_event.wait_for(lambda: self.jobs or self.stopped)
+                if self.stopped:
+                    break
+                function, args = self.jobs.popleft()
+                self.active += 1
+            try:
+                function(*args)
+            except Exception:
+                # a failed job must not take the worker down
+                traceback.print_exc()
+            finally:
+                with self.lock:
+                    self.active -= 1
@@ -0,0 +1,222 @@
+""" Multi-source (swarm) downloads.
+
+A file is identified by the SHA-256 hash of its content. When both sides of
+an ALLOW/YES handshake support the "SWARM" feature, the receiver asks every
+known peer whether it has the file (HAVE/HAVE_YES) and downloads the file
+piece by piece from all peers that have it. A peer gets its next piece
+(PULL) only when it finishes the previous one, so faster peers download
+more pieces. When no piece is left, an idle peer also downloads the
+slowest unfinished piece (end game) so that a slow peer doesn't delay the
+end of the download.
+"""
+import hashlib, threading, time, random
+from collections import deque
+
+import packets
+from fileReceiver import FileReceiver
+
+PIECE_SIZE = 1024 # chunks in a piece, about 1.5 MB
+
+
+def file_hash(path):
+    """ Returns the SHA-256 hash of the file content in hex """
+    sha = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1024*1024), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def is_valid_hash(value):
+    """ Whether a HASH field is a SHA-256 hash in hex, it names manifest files """
+    return isinstance(value, str) and len(value) == 64 and \
+        all(c in "0123456789abcdef" for c in value)
+
+
+class PieceChunks(object):
+    def __init__(self, chunks, start, end):
+        """ Chunks of a piece, the serials [start, end) of the given chunks """
+        self.chunks = chunks
+        self.start = start
+        self.end = min(end, len(chunks))
+
+
+    def __len__(self):
+        return max(self.end - self.start, 0)
+
+
+    def __getitem__(self, index):
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self.chunks[self.start + index]
+
+
+class SwarmDownload(object):
+    def __init__(self, messenger, file_hash, filename, size, piece_size=PIECE_SIZE):
+        """ SwarmDownload assigns the pieces of a file to the peers that
+        have it and collects the chunks in a single FileReceiver.
+
+        Args:
+            messenger (Messenger): Messenger object used to send PULL messages
+            file_hash (str): SHA-256 hash of the file
+            filename (str): Name of the file
+            size (int): File size in bytes
+            piece_size (int, optional): Number of chunks in a piece
+        """
+        self.messenger = messenger
+        self.file_hash = file_hash
+        self.file_receiver = FileReceiver(None, filename, binary=True, size=size,
+                                          chunk_size=packets.PAYLOAD_SIZE,
+                                          file_hash=file_hash)
+        self.chunk_num = self.file_receiver.received.size
+        self.piece_size = piece_size
+
+        self.pieces = deque(range((self.chunk_num + piece_size - 1) // piece_size))
+        self.transfers = {} # key: transfer id, value: [peer ip, piece, start time]
+        self.rates = {} # key: peer ip, value: chunks per second in its last piece
+        self.sack_peers = set() # peers that accept SACK packets
+        self.finished = False
+        self.lock = threading.Lock()
+
+
+    def piece_range(self, piece):
+        start = piece * self.piece_size
+        return start, min(start + self.piece_size, self.chunk_num)
+
+
+    def _piece_done(self, piece):
+        return self.file_receiver.received.missing(*self.piece_range(piece)) == 0
+
+
+    def add_peer(self, peer_ip, features=()):
+        """ Starts downloading from a peer that has the file
+
+        Args:
+            peer_ip (str): IP address of the peer
+            features (list, optional): Features the peer supports
+        """
+        with self.lock:
+            if peer_ip in self.rates or self.finished:
+                return
+            self.rates[peer_ip] = None
+            if "SACK" in features:
+                self.sack_peers.add(peer_ip)
+            pulls = self._assign(peer_ip)
+        self._send(pulls, [])
+
+
+    def _assign(self, peer_ip):
+        """ Picks the next piece for the peer. Must be called with lock held.
+
+        Returns:
+            list: PULL requests to be sent as (peer ip, transfer id, start, end).
+        """
+        while self.pieces and self._piece_done(self.pieces[0]):
+            self.pieces.popleft()
+        if self.pieces:
+            piece = self.pieces.popleft()
+        else:
+            piece = self._end_game_piece(peer_ip)
+            if piece is None:
+                return []
+
+        transfer_id = random.getrandbits(32)
+        self.transfers[transfer_id] = [peer_ip, piece, time.time()]
+        self.file_receiver.uploaders[transfer_id] = peer_ip
+        if peer_ip in self.sack_peers:
+            self.file_receiver.sack_transfers.add(transfer_id)
+        self.messenger._add_download(transfer_id, self.file_receiver)
+        return [(peer_ip, transfer_id) + self.piece_range(piece)]
+
+
+    def _end_game_piece(self, peer_ip):
+        """ Returns the unfinished piece that is expected to finish last,
+        or None if the peer is not expected to finish it earlier.
+        """
+        my_rate = self.rates.get(peer_ip)
+        serving = [entry[1] for entry in self.transfers.values() if entry[0] == peer_ip]
+        best, best_time = None, 0
+        for uploader_ip, piece, _ in self.transfers.values():
+            if piece in serving:
+                continue
+            missing = self.file_receiver.received.missing(*self.piece_range(piece))
+            rate = self.rates.get(uploader_ip)
+            remaining_time = missing / rate if rate else float("inf")
+            if my_rate and missing / my_rate >= remaining_time:
+                continue
+            if best is None or remaining_time > best_time:
+                best, best_time = piece, remaining_time
+        return best
+
+
+    def peer_left(self, peer_ip):
+        """ Gives the pieces of a peer that went offline to the others """
+        with self.lock:
+            transfer_ids = [transfer_id for transfer_id, entry in self.transfers.items()
+                            if entry[0] == peer_ip]
+        for transfer_id in transfer_ids:
+            self.transfer_done(transfer_id, False)
+
+
+    def transfer_done(self, transfer_id, success):
+        """ Handles DOWNLOAD_SUCCESS or DOWNLOAD_FAIL of a piece """
+        cancels = []
+        with self.lock:
+            if transfer_id not in self.transfers:
+                return
+            peer_ip, piece, start_time = self.transfers.pop(transfer_id)
+            del self.file_receiver.uploaders[transfer_id]
+            self.file_receiver.sack_transfers.discard(transfer_id)
+            self.messenger._remove_download(transfer_id)
+
+            if success:
+                start, end = self.piece_range(piece)
+                self.rates[peer_ip] = (end - start) / max(time.time() - start_time, 1e-3)
+            else:
+                # the peer doesn't serve the file anymore
+                self.rates.pop(peer_ip, None)
+                if not self._piece_done(piece) and \
+                        all(entry[1] != piece for entry in self.transfers.values()):
+                    self.pieces.appendleft(piece)
+
+            if self.file_receiver.received.is_full():
+                cancels = list(self.transfers.items())
+                self.transfers.clear()
+                for other_id, _ in cancels:
+                    del self.file_receiver.uploaders[other_id]
+                    self.file_receiver.sack_transfers.discard(other_id)
+                    self.messenger._remove_download(other_id)
+                pulls = []
+                finish = True
+            else:
+                # duplicates of a finished piece are not needed anymore
+                for other_id, entry in list(self.transfers.items()):
+                    if self._piece_done(entry[1]):
+                        cancels.append((other_id, entry))
+                        del self.transfers[other_id]
+                        del self.file_receiver.uploaders[other_id]
+                        self.file_receiver.sack_transfers.discard(other_id)
+                        self.messenger._remove_download(other_id)
+                idle = [ip for ip in self.rates
+                        if all(entry[0] != ip for entry in self.transfers.values())]
+                pulls = []
+                for ip in idle:
+                    pulls += self._assign(ip)
+                # no peer is left to download from
+                finish = not self.transfers and not pulls
+            finish = finish and not self.finished
+            self.finished = self.finished or finish
+
+        self._send(pulls, cancels)
+        if finish:
+            # hashing the file takes a while, don't block the listener
+            self.messenger._background(self.messenger._swarm_finished, self)
+
+
+    def _send(self, pulls, cancels):
+        for peer_ip, transfer_id, start, end in pulls:
+            if not self.messenger._send_pull(peer_ip, self.file_hash, transfer_id,
+                                             start, end):
+                self.transfer_done(transfer_id, False)
+        for transfer_id, entry in cancels:
+            self.messenger._send_pull_cancel(entry[0], transfer_id)
@@ -0,0 +1,184 @@
+""" Live metrics of file transfers and a JSON lines log of them, see the
+README for the fields
+"""
+import json, threading, time
+from collections import deque
+
+RATE_WINDOW = 1.0 # seconds the instantaneous throughput is measured over
+RATE_STEP = 0.1 # seconds between the progress samples of the throughput
+RTT_SAMPLES = 16 # recent RTT samples in a snapshot
+METRICS_INTERVAL = 1.0 # seconds between the lines of a transfer in the log
+
+UPLOAD_FIELDS = ("chunks_sent", "bytes_sent", "chunks_acked", "bytes_acked", "retransmits",
+                 "repairs", "suspends", "rwnd")
+DOWNLOAD_FIELDS = ("chunks_received", "bytes_received", "duplicates", "rebuilt", "dropped",
+                   "acks_sent", "rwnd")
+
+
+class TransferStats(object):
+    def __init__(self, direction, transfer_id=None, peer_ip=None, name=None):
+        """
+        Args:
+            direction (str): "upload" or "download"
+            transfer_id (int, optional): Transfer ID
+            peer_ip (str, optional): IP address of the other side
+            name (str, optional): Name of the file or folder
+        """
+        self.direction = direction
+        self.transfer_id = transfer_id
+        self.peer_ip = peer_ip
+        self.name = name
+        self.started = time.time()
+        self.ended = None
+        self.result = None
+
+        # uploads
+        self.chunks_sent = 0 # including the resent ones
+        self.bytes_sent = 0 # size of the sent chunk packets
+        self.chunks_acked = 0
+        self.bytes_acked = 0 # file bytes
+        self.retransmits = 0
+        self.repairs = 0 # REPAIR packets sent
+        self.suspends = 0
+        self.srtt = None
+        self.cwnd = None
+        # downloads
+        self.chunks_received = 0 # new chunks, including the rebuilt ones
+        self.bytes_received = 0 # file bytes
+        self.duplicates = 0
+        self.rebuilt = 0 # chunks rebuilt from REPAIR packets
+        self.dropped = 0 # chunks dropped because the receive buffer was full
+        self.acks_sent = 0 # ACK and SACK packets
+        # both, sent by the receiver
+        self.rwnd = None
+
+        self.rtt_samples = deque(maxlen=RTT_SAMPLES)
+        self.progress = deque([(self.started, 0)]) # (time, file bytes done) samples
+        self.lock = threading.Lock()
+
+
+    def start(self, transfer_id, peer_ip):
+        """ Restarts the clock when the first chunk of an upload is sent """
+        with self.lock:
+            self.transfer_id = transfer_id
+            self.peer_ip = peer_ip
+            self.started = time.time()
+            self.progress = deque([(self.started, self.bytes_acked)])
+
+
+    def acked(self, chunks, size):
+        """ Counts chunks of an upload that the receiver acked """
+        with self.lock:
+            self.chunks_acked += chunks
+            self.bytes_acked += size
+            self._add_progress(self.bytes_acked)
+
+
+    def received(self, chunks, size):
+        """ Counts new chunks of a download """
+        with self.lock:
+            self.chunks_received += chunks
+            self.bytes_received += size
+            self._add_progress(self.bytes_received)
+
+
+    def add_rtt(self, rtt, srtt, cwnd):
+        with self.lock:
+            self.rtt_samples.append(rtt)
+            self.srtt = srtt
+            self.cwnd = cwnd
+
+
+    def _add_progress(self, done):
+        """ Must be called with lock held """
+        now = time.time()
+        if now - self.progress[-1][0] < RATE_STEP:
+            return
+        self.progress.append((now, done))
+        # keep one sample older than the window to measure from
+        while len(self.progress) > 2 and self.progress[1][0] <= now - RATE_WINDOW:
+            self.progress.popleft()
+
+
+    def finish(self, result):
+        """ Marks the end of the transfer, only the first result counts """
+        with self.lock:
+            if self.result is None:
+                self.result = result
+                self.ended = time.time()
+
+
+    def snapshot(self):
+        """ Returns the metrics as a dict, see the README for the fields """
+        with self.lock:
+            now = self.ended or time.time()
+            upload = self.direction == "upload"
+            done = self.bytes_acked if upload else self.bytes_received
+            since, done_since = self.progress[0]
+            if self.ended is None and now - self.progress[-1][0] > RATE_WINDOW:
+                since, done_since = self.progress[-1] # stalled
+            elapsed = now - self.started
+            snapshot = {"time": round(time.time(), 3), "direction": self.direction,
+                        "tid": self.transfer_id, "peer": self.peer_ip, "name": self.name,
+                        "elapsed": round(elapsed, 3),
+                        "throughput": round((done - done_since) / max(now - since, 1e-3), 1),
+                        "avg_throughput": round(done / max(elapsed, 1e-3), 1)}
+            for field in UPLOAD_FIELDS if upload else DOWNLOAD_FIELDS:
+                snapshot[field] = getattr(self, field)
+            if upload:
+                rtt_samples = [round(rtt, 6) for rtt in self.rtt_samples]
+                snapshot["rtt"] = rtt_samples[-1] if rtt_samples else None
+                snapshot["srtt"] = None if self.srtt is None else round(self.srtt, 6)
+                snapshot["rtt_samples"] = rtt_samples
+                snapshot["cwnd"] = self.cwnd
+            snapshot["result"] = self.result
+            return snapshot
+
+
+class MetricsLog(object):
+    def __init__(self, path, interval=METRICS_INTERVAL):
+        """ Appends the snapshots of the tracked transfers to a JSON lines
+        file from a thread of its own
+
+        Args:
+            path (str): Path of the file
+            interval (float, optional): Seconds between the lines of a transfer
+        """
+        self.file = open(path, "a")
+        self.interval = interval
+        self.tracked = [] # TransferStats
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+
+    def track(self, stats):
+        """ Writes the snapshots of a transfer until it ends """
+        with self.lock:
+            if all(other is not stats for other in self.tracked):
+                self.tracked.append(stats)
+
+
+    def write(self):
+        """ Writes a line per tracked transfer, forgets the ended ones """
+        with self.lock:
+            if self.file.closed:
+                return
+            for stats in self.tracked:
+                self.file.write(json.dumps(stats.snapshot()) + "\n")
+            self.tracked = [stats for stats in self.tracked if stats.result is None]
+            self.file.flush()
+
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        self.write()
+        with self.lock:
+            self.file.close()
+
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
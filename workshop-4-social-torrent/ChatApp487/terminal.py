@@ -0,0 +1,210 @@
+""" Terminal user interface.
+
+A view is a few fixed lines at the top of the screen, a scrolling area for
+chat messages below them and the prompt on the last two rows. Only the
+fixed lines that changed are redrawn and new messages are appended to the
+scrolling area with ANSI escape codes, so the screen is never cleared while
+a view is open and the line being typed is left alone.
+
+Input is read by a thread. prompt() waits for the entered line or for
+notify(), which the Messenger calls when peers, messages or requests
+change, instead of refreshing on a timer.
+
+If the output is not a terminal, lines are printed as they are.
+"""
+import os, sys, shutil, threading, queue
+
+ESC = "\x1b["
+
+
+def _enable_ansi():
+    """ Windows 10 consoles understand ANSI escape codes once asked to """
+    try:
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.GetStdHandle(-11) # standard output
+        mode = ctypes.c_uint32()
+        if kernel32.GetConsoleMode(handle, ctypes.byref(mode)):
+            kernel32.SetConsoleMode(handle, mode.value | 0x4) # virtual terminal processing
+    except (ImportError, AttributeError, OSError):
+        pass
+
+
+class Terminal(object):
+    def __init__(self, stream=None):
+        """
+        Args:
+            stream (file, optional): Output, sys.stdout by default
+        """
+        self.stream = stream or sys.stdout
+        self.ansi = self.stream.isatty()
+        if self.ansi and os.name == "nt":
+            _enable_ansi()
+        self.rows, self.columns = 24, 80
+        self.lines = [] # fixed lines as they are drawn
+        self.scroll = False # whether the view has a scrolling area
+        self.view = False # whether a view is open
+        self.prompt_text = ""
+
+        self.event = threading.Event() # input or a change to show
+        self.inputs = queue.Queue() # entered lines, None at the end of the input
+        self.reader = None
+        self.lock = threading.Lock() # other threads write notices
+
+
+    def notify(self):
+        """ Wakes up prompt() to refresh the view """
+        self.event.set()
+
+
+    def start_view(self, lines, scroll=False):
+        """ Clears the screen and shows the fixed lines. Lines given to
+        set_lines() later must be as many as these if there is a
+        scrolling area.
+
+        Args:
+            lines (list): Fixed lines at the top
+            scroll (bool, optional): Whether there is a scrolling area for
+                append() below the fixed lines
+        """
+        with self.lock:
+            self.view = True
+            self.scroll = scroll
+            self.lines = []
+            self.prompt_text = ""
+            if not self.ansi:
+                self.lines = list(lines)
+                self._write("\n".join(lines) + "\n")
+                return
+            self.columns, self.rows = shutil.get_terminal_size()
+            top = len(lines) + 1 if scroll else 1
+            # the prompt rows are out of the scrolling region, a newline
+            # typed there doesn't scroll the screen
+            self._write("{0}r{0}2J{0}H{0}{1};{2}r".format(ESC, min(top, self.rows - 2),
+                                                          self.rows - 2))
+            self._draw_lines(lines)
+            self._draw_prompt()
+
+
+    def set_lines(self, lines):
+        """ Redraws the fixed lines that changed """
+        with self.lock:
+            if not self.ansi:
+                if lines != self.lines:
+                    self.lines = list(lines)
+                    self._write("\n".join(lines) + "\n")
+                return
+            self._draw_lines(lines)
+
+
+    def append(self, text):
+        """ Adds text at the bottom of the scrolling area """
+        with self.lock:
+            if not self.ansi or not self.scroll:
+                self._write(text + "\n")
+                return
+            rows = []
+            for line in text.split("\n"):
+                rows += [line[i:i + self.columns]
+                         for i in range(0, max(len(line), 1), self.columns)]
+            self._write("\x1b7{}{};1H".format(ESC, self.rows - 2) +
+                        "".join("\n" + row for row in rows) + "\x1b8")
+
+
+    def notice(self, text):
+        """ Shows a status text of a background job """
+        if self.view and self.scroll:
+            self.append(text)
+            return
+        with self.lock:
+            if self.view and self.ansi:
+                # the row above the prompt
+                self._write("\x1b7{}{};1H{}{}K\x1b8".format(ESC, self.rows - 2,
+                                                           text[:self.columns], ESC))
+            else:
+                self._write(text + "\n")
+
+
+    def prompt(self, text, refresh=None):
+        """ Asks for a line. refresh() is called before waiting and after
+        every notify(); if it returns True, the prompt gives up and returns
+        None.
+
+        Raises:
+            EOFError: If the input is closed
+        """
+        self._start_reader()
+        with self.lock:
+            self.prompt_text = text
+            self._draw_prompt()
+        while True:
+            if refresh is not None and refresh():
+                return None
+            try:
+                line = self.inputs.get_nowait()
+            except queue.Empty:
+                self.event.wait()
+                self.event.clear()
+                continue
+            if line is None:
+                self.inputs.put(None)
+                raise EOFError("input is closed")
+            with self.lock:
+                if self.ansi:
+                    # clear the entered line
+                    self._write("{}{};1H{}K".format(ESC, self.rows, ESC))
+            return line
+
+
+    def close(self):
+        """ Gives the whole screen back to the shell """
+        with self.lock:
+            self.view = False
+            if self.ansi:
+                self._write("{}r{}{};1H\n".format(ESC, ESC, self.rows))
+
+
+    def _start_reader(self):
+        if self.reader is None:
+            self.reader = threading.Thread(target=self._read_input, args=(), daemon=True)
+            self.reader.start()
+
+
+    def _read_input(self):
+        while True:
+            line = sys.stdin.readline()
+            if not line:
+                self.inputs.put(None)
+                self.event.set()
+                return
+            self.inputs.put(line.rstrip("\r\n"))
+            self.event.set()
+
+
+    def _draw_lines(self, lines):
+        """ Must be called with lock held """
+        out = []
+        last_row = self.rows - 2 # rows below are the prompt
+        for i in range(min(max(len(lines), len(self.lines)), last_row)):
+            new = lines[i] if i < len(lines) else ""
+            old = self.lines[i] if i < len(self.lines) else None
+            if new != old:
+                out.append("{}{};1H{}{}K".format(ESC, i + 1, new[:self.columns], ESC))
+        self.lines = list(lines)
+        if out:
+            self._write("\x1b7" + "".join(out) + "\x1b8")
+
+
+    def _draw_prompt(self):
+        """ Must be called with lock held """
+        if not self.ansi:
+            if self.prompt_text:
+                self._write(self.prompt_text + "\n")
+            return
+        self._write("{0}{1};1H{2}{0}K{0}{3};1H{0}K".format(
+            ESC, self.rows - 1, self.prompt_text[:self.columns], self.rows))
+
+
+    def _write(self, text):
+        self.stream.write(text)
+        self.stream.flush()
@@ -0,0 +1,254 @@
+""" Tests of the serial and offset arithmetic of file transfers """
+import os, random, shutil, tempfile, unittest
+
+import packets, deltaSync, batch
+from fileReceiver import ChunkBitmap, is_valid_size
+from fileSender import FileChunks
+from swarm import is_valid_hash
+
+
+def bitmap(size, serials):
+    received = ChunkBitmap(size)
+    for serial in serials:
+        received.add(serial)
+    return received
+
+
+class SackTest(unittest.TestCase):
+    def roundtrip(self, serials, received, rwnd=1234):
+        """ Returns the (first serial, acked serials, rwnd) of every SACK packet """
+        result = []
+        for datagram in packets.encode_sacks(7, serials, rwnd, received):
+            kind, transfer_id, first, payload = packets.decode(datagram)
+            self.assertEqual((kind, transfer_id), (packets.SACK, 7))
+            self.assertLessEqual(len(datagram), packets.DATAGRAM_SIZE)
+            acked, acked_rwnd = packets.decode_sack(first, payload)
+            result.append((first, acked, acked_rwnd))
+        return result
+
+    def test_single_serial(self):
+        received = bitmap(100, [42])
+        self.assertEqual(self.roundtrip([42], received), [(42, [42], 1234)])
+
+    def test_full_window(self):
+        serials = list(range(5, 5 + packets.SACK_BITS))
+        received = bitmap(2*packets.SACK_BITS, serials)
+        self.assertEqual(self.roundtrip(serials, received), [(5, serials, 1234)])
+
+    def test_window_split(self):
+        # the serial SACK_BITS after the first one needs a second packet
+        serials = [3, 3 + packets.SACK_BITS - 1, 3 + packets.SACK_BITS]
+        received = bitmap(3*packets.SACK_BITS, serials)
+        self.assertEqual(self.roundtrip(serials, received),
+                         [(3, serials[:2], 1234), (serials[2], serials[2:], 1234)])
+
+    def test_earlier_chunks_acked_again(self):
+        # chunks received before the batch are acked once more, missing
+        # ones are not
+        received = bitmap(64, [9, 10, 12, 13, 17, 20])
+        self.assertEqual(self.roundtrip([20, 9], received), [(9, [9, 10, 12, 13, 17, 20], 1234)])
+
+    def test_last_serial(self):
+        received = bitmap(13, range(13))
+        self.assertEqual(self.roundtrip([12, 0], received), [(0, list(range(13)), 1234)])
+
+    def test_unsorted_many_windows(self):
+        serials = list(range(0, 5*packets.SACK_BITS, 3))
+        received = bitmap(5*packets.SACK_BITS, serials)
+        result = self.roundtrip(list(reversed(serials)), received)
+        self.assertEqual(sum((acked for _, acked, _ in result), []), serials)
+        for first, acked, _ in result:
+            self.assertEqual(acked[0], first)
+            self.assertLess(acked[-1] - first, packets.SACK_BITS)
+
+    def test_negative_rwnd(self):
+        received = bitmap(8, [0])
+        self.assertEqual(self.roundtrip([0], received, rwnd=-1), [(0, [0], -1)])
+
+
+class OfferSizeTest(unittest.TestCase):
+    def test_valid(self):
+        self.assertTrue(is_valid_size(0, packets.PAYLOAD_SIZE))
+        self.assertTrue(is_valid_size(10**9, packets.PAYLOAD_SIZE))
+        self.assertTrue(is_valid_size(100, 50))
+
+    def test_invalid(self):
+        for size, chunk_size in ((10, None), (None, 10), (10, 0), (-1, 10), ("1", 10),
+                                 (10, 1.5), (True, 10), (10, packets.DATAGRAM_SIZE + 1),
+                                 (10**15, 1)):
+            self.assertFalse(is_valid_size(size, chunk_size), (size, chunk_size))
+
+
+class OfferHashTest(unittest.TestCase):
+    def test_valid(self):
+        self.assertTrue(is_valid_hash("0123456789abcdef"*4))
+
+    def test_invalid(self):
+        for value in (None, 12, "", "0123456789abcdef"*3, "0123456789ABCDEF"*4,
+                      "../../../../etc/passwd" + "0"*42, "0123456789abcdef"*4 + "/"):
+            self.assertFalse(is_valid_hash(value), value)
+
+
+class CoveredChunksTest(unittest.TestCase):
+    # 10-byte chunks, 4-byte blocks, a 25-byte file: chunks [0, 10),
+    # [10, 20) and the short last one [20, 25)
+    def covered(self, copies, size=25):
+        return deltaSync.covered_chunks(copies, 4, size, 10)
+
+    def test_no_copies(self):
+        self.assertEqual(self.covered([]), [])
+
+    def test_whole_file(self):
+        # the last block may reach past the end of the file
+        self.assertEqual(self.covered([(0, 0, 7)]), [[0, 3]])
+
+    def test_last_chunk(self):
+        self.assertEqual(self.covered([(20, 0, 2)]), [[2, 3]])
+        self.assertEqual(self.covered([(20, 0, 1)]), []) # ends at 24
+        self.assertEqual(self.covered([(21, 0, 1)]), []) # starts inside the chunk
+
+    def test_first_chunk(self):
+        self.assertEqual(self.covered([(0, 0, 3)]), [[0, 1]])
+        self.assertEqual(self.covered([(0, 0, 2)]), [])
+        self.assertEqual(self.covered([(1, 0, 3)]), [])
+
+    def test_partial_chunks_rounded_in(self):
+        self.assertEqual(self.covered([(3, 0, 2)]), [])
+        self.assertEqual(self.covered([(6, 0, 4)]), [[1, 2]])
+
+    def test_adjacent_copies_joined(self):
+        self.assertEqual(self.covered([(0, 0, 1), (4, 5, 1), (8, 2, 1)]), [[0, 1]])
+        self.assertEqual(self.covered([(0, 0, 3), (12, 1, 2)]), [[0, 2]])
+
+    def test_gap(self):
+        self.assertEqual(self.covered([(0, 0, 3), (13, 0, 2)]), [[0, 1]])
+        self.assertEqual(self.covered([(0, 0, 3), (13, 0, 3)]), [[0, 1], [2, 3]])
+
+    def test_size_multiple_of_chunk(self):
+        self.assertEqual(self.covered([(10, 0, 3)], size=20), [[1, 2]])
+        self.assertEqual(self.covered([(10, 0, 2)], size=20), [])
+
+
+class FindCopiesTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.block = deltaSync.MIN_BLOCK
+        self.old = random.Random(1).getrandbits(8*10*self.block).to_bytes(10*self.block, "little")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def find_copies(self, new):
+        old_path = os.path.join(self.folder, "old")
+        new_path = os.path.join(self.folder, "new")
+        with open(old_path, "wb") as file:
+            file.write(self.old)
+        with open(new_path, "wb") as file:
+            file.write(new)
+        sigs = deltaSync.signatures(old_path, self.block)
+        return deltaSync.find_copies(new_path, self.block, sigs)
+
+    def rebuild(self, new, copies):
+        """ Returns the new file with only the copied bytes taken from the old one """
+        data = bytearray(len(new))
+        for offset, first, count in copies:
+            data[offset:offset + count*self.block] = \
+                self.old[first*self.block:(first + count)*self.block]
+        return data
+
+    def test_same_file(self):
+        self.assertEqual(self.find_copies(self.old), [(0, 0, 10)])
+
+    def test_insert(self):
+        new = b"xyz" + self.old[:4*self.block + 5] + b"-"*77 + self.old[4*self.block + 5:]
+        copies = self.find_copies(new)
+        self.assertEqual(copies, [(3, 0, 4), (3 + 5*self.block + 77, 5, 5)])
+        rebuilt = self.rebuild(new, copies)
+        for offset, _, count in copies:
+            end = offset + count*self.block
+            self.assertEqual(rebuilt[offset:end], new[offset:end])
+
+    def test_block_at_the_end(self):
+        new = b"a"*(self.block + 1) + self.old[-self.block:]
+        self.assertEqual(self.find_copies(new), [(self.block + 1, 9, 1)])
+
+    def test_too_short(self):
+        self.assertEqual(self.find_copies(self.old[:self.block - 1]), [])
+
+
+class BatchSerialsTest(unittest.TestCase):
+    P = packets.PAYLOAD_SIZE
+    G = packets.FEC_GROUP
+    # empty files at the start, in the middle and at the end
+    FILES = [["a", 0], ["b", 1], ["c/d", G*P + 1], ["c/e", 0], ["f", P], ["g", 0]]
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.source = os.path.join(self.folder, "source")
+        for relative, size in self.FILES:
+            path = os.path.join(self.source, *relative.split("/"))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as file:
+                file.write(os.urandom(size))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_serial_bases(self):
+        self.assertEqual(batch.serial_bases([], self.P), ([], 0))
+        self.assertEqual(batch.serial_bases([0, 0], self.P), ([0, 0], 0))
+        self.assertEqual(batch.serial_bases([size for _, size in self.FILES], self.P),
+                         ([0, 0, self.G, 3*self.G, 3*self.G, 4*self.G], 4*self.G))
+
+    def test_locate(self):
+        receiver = batch.BatchReceiver("127.0.0.1", "dest", self.FILES, 5,
+                                       download_dir=self.folder)
+        self.assertEqual(receiver._locate(0), (1, 0))
+        self.assertEqual(receiver._locate(1), (None, None))
+        self.assertEqual(receiver._locate(self.G), (2, 0))
+        self.assertEqual(receiver._locate(2*self.G), (2, self.G))
+        self.assertEqual(receiver._locate(2*self.G + 1), (None, None))
+        self.assertEqual(receiver._locate(3*self.G), (4, 0))
+        self.assertEqual(receiver._locate(4*self.G - 1), (None, None))
+        self.assertEqual(receiver._locate(4*self.G), (None, None))
+        receiver.close()
+
+    def test_chunk_serials(self):
+        make_chunk = lambda serial, data: {"SERIAL": serial, "PAYLOAD": data}
+        open_chunks = lambda path: FileChunks(path, self.P, make_chunk)
+        with batch.BatchChunks(self.source, self.FILES, open_chunks) as chunks:
+            serials = [chunk["SERIAL"] for chunk in chunks]
+        self.assertEqual(serials, [0] + list(range(self.G, 2*self.G + 1)) + [3*self.G])
+
+    def test_transfer(self):
+        make_chunk = lambda serial, data: {"SERIAL": serial, "PAYLOAD": data}
+        open_chunks = lambda path: FileChunks(path, self.P, make_chunk)
+        receiver = batch.BatchReceiver("127.0.0.1", "dest", self.FILES, 5,
+                                       download_dir=self.folder)
+        # the empty files are saved right away
+        self.assertTrue(os.path.isfile(os.path.join(self.folder, "dest", "a")))
+        with batch.BatchChunks(self.source, self.FILES, open_chunks) as chunks:
+            for chunk in reversed(list(chunks)):
+                self.assertFalse(receiver.is_complete())
+                self.assertEqual(receiver.write_chunk(chunk["SERIAL"], chunk["PAYLOAD"]), [])
+        self.assertTrue(receiver.finish(len(chunks)))
+        for relative, size in self.FILES:
+            path = relative.split("/")
+            with open(os.path.join(self.source, *path), "rb") as file:
+                expected = file.read()
+            with open(os.path.join(self.folder, "dest", *path), "rb") as file:
+                self.assertEqual(file.read(), expected)
+        # a chunk of a saved file is a duplicate, acked again
+        self.assertEqual(receiver.write_chunk(0, b"x"), [])
+        receiver.close()
+        self.assertIsNone(receiver.write_chunk(0, b"x"))
+
+    def test_manifest(self):
+        self.assertTrue(batch.is_valid_manifest(self.FILES))
+        for files in ({"a": 1}, [["a"]], [["a", 1, 2]], [["a", -1]], [["a", True]],
+                      [["a", 1], ["a", 2]], [["c", 1], ["c/d", 1]], [["../a", 1]]):
+            self.assertFalse(batch.is_valid_manifest(files), files)
+
+
+if __name__ == "__main__":
+    unittest.main()